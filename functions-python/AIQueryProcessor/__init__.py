@@ -2,55 +2,82 @@ import azure.functions as func
 import logging
 import os
 import json
+import time
 from datetime import datetime
-from azure.storage.blob import BlobServiceClient
-from azure.search.documents import SearchClient
-from azure.core.credentials import AzureKeyCredential
-from openai import AzureOpenAI
 import re
+from shared_code import answer_cache, clients, context_packing, lifecycle_index, local_search, metrics, rate_limit, retrieval_cache, single_flight, telemetry, tracing, warmup
 
-def main(req: func.HttpRequest) -> func.HttpResponse:
+# Largest top a request may ask for
+MAX_TOP_K = 50
+
+SYSTEM_PROMPT = """You are a helpful AI assistant that answers questions based on the provided document content. 
+        Always provide accurate information based on the documents. If the documents don't contain relevant information, 
+        say so clearly. Cite specific documents when possible."""
+
+@tracing.traced("ai_query")
+async def main(req: func.HttpRequest) -> func.HttpResponse:
     """
     Process AI queries against document content using Azure OpenAI
     """
     logging.info('AI Query Processor function processed a request.')
-    
+
     try:
         # Parse request body
         req_body = req.get_json()
         query = req_body.get('query', '')
         user_id = req_body.get('user_id', 'anonymous')
-        
+
         if not query:
             return func.HttpResponse(
                 json.dumps({"error": "Query is required"}),
                 status_code=400,
                 mimetype="application/json"
             )
-        
-        # Search for relevant documents
-        relevant_docs = search_documents(query)
-        
-        # Generate AI response
-        ai_response = generate_ai_response(query, relevant_docs)
-        
-        # Track query
+
+        try:
+            top = int(req_body.get('top', search_top_k()))
+            skip = int(req_body.get('skip', 0))
+        except (TypeError, ValueError):
+            top, skip = -1, -1
+        if not 1 <= top <= MAX_TOP_K or skip < 0:
+            return func.HttpResponse(
+                json.dumps({"error": f"top must be between 1 and {MAX_TOP_K} and skip must not be negative"}),
+                status_code=400,
+                mimetype="application/json"
+            )
+
+        # Identical questions in flight at the same time share one search and one answer
+        flight_key = (answer_cache.normalize_query(query), top, skip)
+
+        # Search for relevant document chunks
+        query_embedding, relevant_docs = await single_flight.run(
+            ("search",) + flight_key, lambda: retrieve(query, top, skip)
+        )
+
+        # Track query - only buffered here, so it never delays the response
         track_query(query, user_id, relevant_docs)
-        
+
+        # Generate AI response
+        with metrics.timer("generate"):
+            ai_response = await single_flight.run(
+                ("answer",) + flight_key, lambda: generate_ai_response_async(query, relevant_docs, query_embedding)
+            )
+        metrics.maybe_log_summary()
+
         # Return response
         response_data = {
             "query": query,
             "response": ai_response,
-            "sources": [doc.get('filename', '') for doc in relevant_docs],
+            "sources": source_names(relevant_docs),
             "timestamp": datetime.utcnow().isoformat()
         }
-        
+
         return func.HttpResponse(
             json.dumps(response_data),
             status_code=200,
             mimetype="application/json"
         )
-        
+
     except Exception as e:
         logging.error(f"Error processing query: {str(e)}")
         return func.HttpResponse(
@@ -59,142 +86,336 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
             mimetype="application/json"
         )
 
-def search_documents(query):
-    """Search for relevant documents using Azure Cognitive Search"""
+@tracing.traced()
+async def retrieve(query, top, skip):
+    """Embed the query once for both hybrid search and the answer cache, then search"""
+    query_embedding = await embed_query_async(query)
+    relevant_docs = await search_documents_async(query, query_embedding, top=top, skip=skip)
+    return query_embedding, relevant_docs
+
+@tracing.traced()
+def search_documents(query, query_vector=None, top=None, skip=0, filter=None):
+    """Search for relevant document chunks using Azure Cognitive Search"""
+    options = search_options(query, query_vector, top, skip, filter)
+    cache = retrieval_cache.get_retrieval_cache()
+    key, cached = lookup_cached_results(cache, query, options)
+    if cached is not None:
+        return cached
+
     try:
-        endpoint = os.environ.get("SEARCH_ENDPOINT")
-        key = os.environ.get("SEARCH_API_KEY")
-        
-        if not endpoint or not key:
-            logging.warning("Search service not configured")
-            return []
-        
-        search_client = SearchClient(
-            endpoint=endpoint,
-            index_name="documents",
-            credential=AzureKeyCredential(key)
-        )
-        
-        # Perform semantic search
-        search_results = search_client.search(
-            search_text=query,
-            select=["filename", "content", "upload_date"],
-            top=5,
-            query_type="semantic",
-            query_language="en-us",
-            semantic_configuration_name="default"
-        )
-        
-        relevant_docs = []
-        for result in search_results:
-            relevant_docs.append({
-                "filename": result.get("filename", ""),
-                "content": result.get("content", ""),
-                "upload_date": result.get("upload_date", ""),
-                "score": result.get("@search.score", 0)
-            })
-        
+        search_client = clients.get_search_client("documents")
+
+        if search_client is None or local_search.is_primary():
+            return search_locally(query, query_vector, options)
+
+        start = time.perf_counter()
+        search_results = search_client.search(**options)
+
+        relevant_docs = [to_relevant_doc(result) for result in search_results]
+        store_search_results(cache, key, relevant_docs, start)
+        tracing.annotate(results=len(relevant_docs))
+
         logging.info(f"Found {len(relevant_docs)} relevant documents")
         return relevant_docs
-        
+
+    except Exception as e:
+        logging.error(f"Error searching documents: {str(e)}")
+        return search_locally(query, query_vector, options, fallback=True)
+
+@tracing.traced("search_documents")
+async def search_documents_async(query, query_vector=None, top=None, skip=0, filter=None):
+    """Search for relevant document chunks using the aio Azure Cognitive Search client"""
+    options = search_options(query, query_vector, top, skip, filter)
+    cache = retrieval_cache.get_retrieval_cache()
+    key, cached = await answer_cache.offload(cache, lookup_cached_results, cache, query, options)
+    if cached is not None:
+        return cached
+
+    try:
+        search_client = clients.get_async_search_client("documents")
+
+        if search_client is None or local_search.is_primary():
+            return search_locally(query, query_vector, options)
+
+        start = time.perf_counter()
+        search_results = await search_client.search(**options)
+
+        relevant_docs = [to_relevant_doc(result) async for result in search_results]
+        await answer_cache.offload(cache, store_search_results, cache, key, relevant_docs, start)
+        tracing.annotate(results=len(relevant_docs))
+
+        logging.info(f"Found {len(relevant_docs)} relevant documents")
+        return relevant_docs
+
     except Exception as e:
         logging.error(f"Error searching documents: {str(e)}")
+        return search_locally(query, query_vector, options, fallback=True)
+
+@tracing.traced()
+def search_locally(query, query_vector, options, fallback=False):
+    """Search the embedded index, when search is not configured, failed, or LOCAL_SEARCH_MODE is primary"""
+    try:
+        index = local_search.get_index()
+
+        if index is None:
+            if not fallback:
+                logging.warning("Search service not configured")
+            return []
+
+        start = time.perf_counter()
+        relevant_docs = index.search(
+            query, query_vector, options["top"], options.get("skip", 0), options.get("filter")
+        )
+        metrics.observe("search_local", (time.perf_counter() - start) * 1000)
+        tracing.annotate(results=len(relevant_docs), fallback=fallback)
+
+        logging.info(f"Found {len(relevant_docs)} relevant documents in the local index")
+        return relevant_docs
+
+    except Exception as e:
+        logging.error(f"Error searching the local index: {str(e)}")
         return []
 
+def lookup_cached_results(cache, query, options):
+    """(cache key, cached relevant docs or None); the key is None when caching is off"""
+    if cache is None:
+        return None, None
+
+    start = time.perf_counter()
+    key = cache.results_key(
+        query, options["top"], options.get("skip", 0), options.get("filter"), "vector_queries" in options
+    )
+    entry = cache.get_results(key)
+    if entry is None:
+        return key, None
+
+    metrics.observe("search_cached", (time.perf_counter() - start) * 1000)
+    tracing.annotate(cached=True, results=len(entry["docs"]))
+    metrics.record_saved("search_cached", entry["search_ms"])
+    logging.info(f"Retrieval cache hit, {entry['search_ms']:.0f}ms of search saved")
+    return key, entry["docs"]
+
+def store_search_results(cache, key, relevant_docs, start):
+    """Record the search latency and cache the results under the key read before searching"""
+    search_ms = (time.perf_counter() - start) * 1000
+    metrics.observe("search", search_ms)
+    if cache is not None:
+        cache.store_results(key, relevant_docs, search_ms)
+
+def search_top_k():
+    return int(os.environ.get("SEARCH_TOP_K", "5"))
+
+def search_options(query, query_vector=None, top=None, skip=0, filter=None):
+    """Semantic search parameters shared by the sync and async clients, hybrid when a query vector is given"""
+    options = {
+        "search_text": query,
+        "select": ["filename", "content", "upload_date", "chunk_index"],
+        "top": top or search_top_k(),
+        "query_type": "semantic",
+        "semantic_configuration_name": "default"
+    }
+    if skip:
+        options["skip"] = skip
+    if filter:
+        options["filter"] = filter
+
+    if query_vector is not None:
+        from azure.search.documents.models import VectorizedQuery
+        # Enough nearest neighbours to fill every page up to this one
+        options["vector_queries"] = [
+            VectorizedQuery(vector=query_vector, k_nearest_neighbors=options["top"] + skip, fields="content_vector")
+        ]
+
+    return options
+
+def to_relevant_doc(result):
+    """Convert a search result into the document shape used for context and sources"""
+    return {
+        "filename": result.get("filename", ""),
+        "content": result.get("content", ""),
+        "upload_date": result.get("upload_date", ""),
+        "chunk_index": result.get("chunk_index", 0),
+        "score": result.get("@search.score", 0)
+    }
+
+def source_names(relevant_docs):
+    """Distinct filenames of the retrieved chunks, in rank order"""
+    return list(dict.fromkeys(doc.get('filename', '') for doc in relevant_docs))
+
+@tracing.traced()
 def generate_ai_response(query, relevant_docs):
     """Generate AI response using Azure OpenAI"""
     try:
-        endpoint = os.environ.get("OPENAI_ENDPOINT")
-        key = os.environ.get("OPENAI_API_KEY")
-        
-        if not endpoint or not key:
-            return "AI service not configured. Please contact administrator."
-        
-        client = AzureOpenAI(
-            azure_endpoint=endpoint,
-            api_key=key,
-            api_version="2024-02-15-preview"
-        )
-        
-        # Prepare context from relevant documents
-        context = prepare_context(relevant_docs)
-        
-        # Create system prompt
-        system_prompt = """You are a helpful AI assistant that answers questions based on the provided document content. 
-        Always provide accurate information based on the documents. If the documents don't contain relevant information, 
-        say so clearly. Cite specific documents when possible."""
-        
-        # Create user message
-        user_message = f"""Based on the following document content, please answer this question: {query}
+        client = clients.get_openai_client()
 
-Document Content:
-{context}
+        if client is None:
+            return "AI service not configured. Please contact administrator."
 
-Please provide a comprehensive answer based on the document content above."""
-        
         # Generate response
-        response = client.chat.completions.create(
-            model="gpt-4",
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": user_message}
-            ],
-            max_tokens=1000,
-            temperature=0.3
-        )
-        
+        response = client.chat.completions.create(**completion_options(query, relevant_docs))
+        usage = getattr(response, "usage", None)
+        if usage is not None:
+            tracing.annotate(tokens=usage.total_tokens)
+
         return response.choices[0].message.content
-        
+
+    except Exception as e:
+        logging.error(f"Error generating AI response: {str(e)}")
+        return f"Sorry, I encountered an error while processing your query: {str(e)}"
+
+@tracing.traced("generate_ai_response")
+async def generate_ai_response_async(query, relevant_docs, query_embedding=None):
+    """Generate AI response using the async Azure OpenAI client, serving repeat questions from the answer cache"""
+    cache = answer_cache.get_answer_cache()
+    cached = await answer_cache.offload(cache, lookup_cached_answer, cache, query, relevant_docs, query_embedding)
+    if cached is not None:
+        return cached
+
+    try:
+        # The rate limiter retries, so the SDK does not
+        client = clients.get_async_openai_client(max_retries=0)
+
+        if client is None:
+            return "AI service not configured. Please contact administrator."
+
+        # Generate response, queued until the deployment's quota allows it
+        start = time.perf_counter()
+        response = await rate_limit.create_chat_completion(client, **completion_options(query, relevant_docs))
+        ai_response = response.choices[0].message.content
+
+        if cache is not None:
+            await answer_cache.offload(
+                cache, cache.store, query, relevant_docs, ai_response, (time.perf_counter() - start) * 1000,
+                query_embedding
+            )
+
+        return ai_response
+
     except Exception as e:
         logging.error(f"Error generating AI response: {str(e)}")
         return f"Sorry, I encountered an error while processing your query: {str(e)}"
 
-def prepare_context(relevant_docs):
-    """Prepare context from relevant documents"""
+def lookup_cached_answer(cache, query, relevant_docs, query_embedding):
+    """Return a cached answer for this query and document set, or None"""
+    if cache is None:
+        return None
+
+    entry = cache.lookup(query, relevant_docs, query_embedding)
+    if entry is None:
+        return None
+
+    tracing.annotate(cached=True)
+    stats = cache.metrics()
+    logging.info(
+        f"Answer cache hit (hit rate {stats['hit_rate']:.1%}, "
+        f"{stats['latency_saved_ms']:.0f}ms of generation saved)"
+    )
+    return entry["response"]
+
+@tracing.traced("embed_query")
+async def embed_query_async(query):
+    """Embed the query for hybrid search and the answer cache, or None if embeddings are not configured"""
+    deployment = os.environ.get("OPENAI_EMBEDDING_DEPLOYMENT")
+    if not deployment:
+        return None
+
+    cache = retrieval_cache.get_retrieval_cache()
+    if cache is not None:
+        start = time.perf_counter()
+        entry = await answer_cache.offload(cache, cache.get_embedding, query, deployment)
+        if entry is not None:
+            metrics.observe("embed_cached", (time.perf_counter() - start) * 1000)
+            metrics.record_saved("embed_cached", entry["embed_ms"])
+            return entry["embedding"]
+
+    try:
+        client = clients.get_async_openai_client()
+
+        if client is None:
+            return None
+
+        start = time.perf_counter()
+        response = await client.embeddings.create(model=deployment, input=[answer_cache.normalize_query(query)])
+        embedding = response.data[0].embedding
+        embed_ms = (time.perf_counter() - start) * 1000
+        metrics.observe("embed", embed_ms)
+        if cache is not None:
+            await answer_cache.offload(cache, cache.store_embedding, query, deployment, embedding, embed_ms)
+        return embedding
+
+    except Exception as e:
+        logging.warning(f"Failed to embed query: {str(e)}")
+        return None
+
+def completion_options(query, relevant_docs):
+    """Chat completion parameters shared by the sync and async clients"""
+    # Prepare context from relevant documents
+    context = prepare_context(relevant_docs, query)
+
+    # Create user message
+    user_message = f"""Based on the following document content, please answer this question: {query}
+
+Document Content:
+{context}
+
+Please provide a comprehensive answer based on the document content above."""
+
+    return {
+        "model": "gpt-4",
+        "messages": [
+            {"role": "system", "content": SYSTEM_PROMPT},
+            {"role": "user", "content": user_message}
+        ],
+        "max_tokens": 1000,
+        "temperature": 0.3
+    }
+
+@tracing.traced()
+def prepare_context(relevant_docs, query=""):
+    """Prepare context from the most relevant passages that fit the token budget"""
     if not relevant_docs:
         return "No relevant documents found."
-    
-    context_parts = []
-    for i, doc in enumerate(relevant_docs, 1):
-        content = doc.get('content', '')
-        filename = doc.get('filename', 'Unknown')
-        
-        # Truncate content if too long
-        if len(content) > 2000:
-            content = content[:2000] + "..."
-        
-        context_parts.append(f"Document {i} ({filename}):\n{content}\n")
-    
-    return "\n".join(context_parts)
 
+    context, stats = context_packing.pack_context(query, relevant_docs)
+    tracing.annotate(tokens=stats['context_tokens'], passages=stats['passages_selected'])
+
+    logging.info(
+        f"Packed {stats['passages_selected']}/{stats['passages_considered']} passages into "
+        f"{stats['context_tokens']} tokens ({stats['candidate_tokens']} available, "
+        f"{stats['duplicates_removed']} duplicates removed) in {stats['packing_ms']:.1f}ms"
+    )
+    return context
+
+@tracing.traced()
 def track_query(query, user_id, relevant_docs):
     """Track query for analytics"""
     try:
-        connection_string = os.environ.get("STORAGE_CONNECTION_STRING")
-        blob_service_client = BlobServiceClient.from_connection_string(connection_string)
-        
-        container_name = os.environ.get("METADATA_CONTAINER_NAME", "metadata")
-        container_client = blob_service_client.get_container_client(container_name)
-        
-        # Create container if it doesn't exist
-        try:
-            container_client.get_container_properties()
-        except:
-            blob_service_client.create_container(container_name)
-        
-        # Store query metadata
-        query_data = {
-            "query": query,
-            "user_id": user_id,
-            "timestamp": datetime.utcnow().isoformat(),
-            "documents_found": len(relevant_docs),
-            "document_names": [doc.get('filename', '') for doc in relevant_docs]
-        }
-        
-        blob_name = f"queries/{user_id}_{datetime.utcnow().strftime('%Y%m%d_%H%M%S')}.json"
-        blob_client = container_client.get_blob_client(blob_name)
-        blob_client.upload_blob(json.dumps(query_data).encode('utf-8'))
-        
+        # Buffered and appended to the hourly query log in batches
+        telemetry.write(telemetry.QUERY_STREAM, query_record(query, user_id, relevant_docs))
+
+        # Retrieved documents count as accessed for the lifecycle index
+        lifecycle_index.record_events("access", source_names(relevant_docs))
+
     except Exception as e:
         logging.warning(f"Failed to track query: {str(e)}")
-        # Don't raise here - tracking failure shouldn't fail the whole process 
\ No newline at end of file
+        # Don't raise here - tracking failure shouldn't fail the whole process
+
+def query_record(query, user_id, relevant_docs):
+    """Query metadata stored for analytics"""
+    return {
+        "query": query,
+        "user_id": user_id,
+        "timestamp": datetime.utcnow().isoformat(),
+        "documents_found": len(relevant_docs),
+        "document_names": source_names(relevant_docs)
+    }
+
+# SDKs, the tokenizer and the local index loaded ahead of the first query when WARMUP_ENABLED is true.
+# The aio clients belong to the request's event loop, so only their modules are loaded here.
+warmup.start({
+    "sdks": lambda: warmup.import_modules("openai", "httpx", "aiohttp", "azure.search.documents.aio",
+                                          "azure.search.documents.models", "azure.storage.blob.aio"),
+    "blob": clients.get_blob_service_client,
+    "tokenizer": context_packing.get_encoding,
+    "local_search": local_search.get_index
+})
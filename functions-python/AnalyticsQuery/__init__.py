@@ -0,0 +1,45 @@
+import azure.functions as func
+import logging
+import json
+from shared_code import analytics
+
+def main(req: func.HttpRequest) -> func.HttpResponse:
+    """
+    Usage reports over the compacted query and access events:
+    GET /api/analytics?report=top_documents|queries_per_user|zero_result_queries&days=7&limit=10
+    """
+    logging.info('Analytics query function processed a request.')
+    
+    report = req.params.get('report', 'top_documents')
+    if report not in analytics.REPORTS:
+        return func.HttpResponse(
+            json.dumps({"error": f"Unknown report, expected one of: {', '.join(analytics.REPORTS)}"}),
+            status_code=400,
+            mimetype="application/json"
+        )
+    
+    try:
+        days = float(req.params.get('days', '7'))
+        limit = int(req.params.get('limit', '10'))
+    except ValueError:
+        return func.HttpResponse(
+            json.dumps({"error": "days and limit must be numbers"}),
+            status_code=400,
+            mimetype="application/json"
+        )
+    
+    try:
+        rows = analytics.REPORTS[report](days=days, limit=limit)
+        return func.HttpResponse(
+            json.dumps({"report": report, "days": days, "rows": [list(row) for row in rows]}),
+            status_code=200,
+            mimetype="application/json"
+        )
+    
+    except Exception as e:
+        logging.error(f"Error running analytics report {report}: {str(e)}")
+        return func.HttpResponse(
+            json.dumps({"error": "Internal server error"}),
+            status_code=500,
+            mimetype="application/json"
+        )
@@ -3,9 +3,10 @@ import logging
 import os
 import json
 from datetime import datetime, timedelta
-from azure.storage.blob import BlobServiceClient, BlobServiceClient
 from azure.core.exceptions import ResourceNotFoundError
+from shared_code import access_stats, analytics, clients, lifecycle, lifecycle_index, local_search, telemetry, tiering, tracing, warmup
 
+@tracing.traced("access_tracker")
 def main(timer: func.TimerRequest):
     """
     Track document access patterns and manage lifecycle (runs every 5 minutes)
@@ -13,14 +14,23 @@ def main(timer: func.TimerRequest):
     logging.info("Running document access tracker")
     
     try:
-        # Process document lifecycle management
+        # Process document lifecycle management, including retention deletes
         process_document_lifecycle()
         
         # Move documents between tiers based on access patterns
-        move_documents_between_tiers()
+        stats = move_documents_between_tiers()
         
-        # Clean up old documents
-        cleanup_old_documents()
+        # Roll the event hours the access statistics have read into Parquet
+        compact_event_logs(stats)
+        
+        # Drop exported trace spans past their retention
+        prune_traces()
+        
+        # Seed the local search index from documents processed before it existed
+        seed_local_search()
+        
+        # Journal the moves now rather than leave them to the background flush
+        telemetry.flush()
         
         logging.info("Document access tracker completed successfully")
         
@@ -28,49 +38,72 @@ def main(timer: func.TimerRequest):
         logging.error(f"Error in document access tracker: {str(e)}")
         raise
 
+@tracing.traced()
 def process_document_lifecycle():
-    """Process document lifecycle based on access patterns"""
+    """
+    Process document lifecycle based on access patterns: tier moves and
+    retention deletes for every container in one paginated, resumable scan
+    """
     try:
-        connection_string = os.environ.get("STORAGE_CONNECTION_STRING")
-        blob_service_client = BlobServiceClient.from_connection_string(connection_string)
+        policy = lifecycle_policy()
+        if policy is not None and os.environ.get("LIFECYCLE_INDEX_ENABLED", "true").lower() == "true":
+            # Only blobs whose transition is due are touched
+            stats = lifecycle_index.tick(policy)
+            logging.info(
+                f"Lifecycle index: {stats['events']} events, {stats['due']} due, moved {stats['moved']}, "
+                f"deleted {stats['deleted']}, failed {stats['failed']}"
+                + (", reconciled with a full listing" if stats["reconciled"] else "")
+            )
+            return
         
-        # Get access threshold days
-        access_threshold = int(os.environ.get("ACCESS_THRESHOLD_DAYS", "30"))
-        archive_threshold = int(os.environ.get("ARCHIVE_THRESHOLD_DAYS", "90"))
-        
-        # Process hot documents
-        hot_container_name = os.environ.get("HOT_CONTAINER_NAME", "hot-documents")
-        try:
-            hot_container = blob_service_client.get_container_client(hot_container_name)
-            for blob in hot_container.list_blobs():
-                if should_move_to_cool(blob, access_threshold):
-                    move_blob_between_containers(
-                        blob_service_client, 
-                        hot_container_name, 
-                        "documents", 
-                        blob.name
-                    )
-                    logging.info(f"Moved {blob.name} from hot to cool tier")
-        except ResourceNotFoundError:
-            logging.info(f"Hot container {hot_container_name} does not exist")
-        
-        # Process cool documents
-        documents_container = blob_service_client.get_container_client("documents")
-        for blob in documents_container.list_blobs():
-            if should_move_to_archive(blob, archive_threshold):
-                archive_container_name = os.environ.get("ARCHIVE_CONTAINER_NAME", "archive")
-                move_blob_between_containers(
-                    blob_service_client,
-                    "documents",
-                    archive_container_name,
-                    blob.name
-                )
-                logging.info(f"Moved {blob.name} from cool to archive tier")
+        results = lifecycle.run(lifecycle_rules())
+        for container, stats in results.items():
+            logging.info(
+                f"Lifecycle {container}: listed {stats['listed']} in {stats['pages']} pages, "
+                f"moved {stats['moved']}, deleted {stats['deleted']}, failed {stats['failed']}"
+                + ("" if stats["complete"] else ", resuming next run")
+            )
                 
     except Exception as e:
         logging.error(f"Error processing document lifecycle: {str(e)}")
         raise
 
+def lifecycle_policy():
+    """
+    (action, target container, threshold days) per container for the lifecycle
+    index, or None when containers are shared and tiers change in place
+    """
+    hot_container_name = os.environ.get("HOT_CONTAINER_NAME", "hot-documents")
+    archive_container_name = os.environ.get("ARCHIVE_CONTAINER_NAME", "archive")
+    if len({hot_container_name, "documents", archive_container_name}) < 3:
+        return None
+    
+    return {
+        hot_container_name: ("move", "documents", int(os.environ.get("ACCESS_THRESHOLD_DAYS", "30"))),
+        "documents": ("move", archive_container_name, int(os.environ.get("ARCHIVE_THRESHOLD_DAYS", "90"))),
+        archive_container_name: ("delete", None, int(os.environ.get("DELETE_THRESHOLD_DAYS", "365")))
+    }
+
+def lifecycle_rules():
+    """Rules per container, coldest first, so a blob due for several moves takes the coldest"""
+    access_threshold = int(os.environ.get("ACCESS_THRESHOLD_DAYS", "30"))
+    archive_threshold = int(os.environ.get("ARCHIVE_THRESHOLD_DAYS", "90"))
+    delete_threshold = int(os.environ.get("DELETE_THRESHOLD_DAYS", "365"))
+    hot_container_name = os.environ.get("HOT_CONTAINER_NAME", "hot-documents")
+    archive_container_name = os.environ.get("ARCHIVE_CONTAINER_NAME", "archive")
+    
+    rules = {}
+    rules.setdefault(archive_container_name, []).append(
+        lambda blob: ("delete", None) if should_delete_document(blob, delete_threshold) else None
+    )
+    rules.setdefault("documents", []).append(
+        lambda blob: ("move", archive_container_name) if should_move_to_archive(blob, archive_threshold) else None
+    )
+    rules.setdefault(hot_container_name, []).append(
+        lambda blob: ("move", "documents") if should_move_to_cool(blob, access_threshold) else None
+    )
+    return rules
+
 def should_move_to_cool(blob, threshold_days):
     """Check if document should be moved from hot to cool tier"""
     if not blob.last_modified:
@@ -87,84 +120,106 @@ def should_move_to_archive(blob, threshold_days):
     days_since_access = (datetime.utcnow() - blob.last_modified.replace(tzinfo=None)).days
     return days_since_access > threshold_days
 
+@tracing.traced()
 def move_blob_between_containers(blob_service_client, source_container, target_container, blob_name):
-    """Move a blob from one container to another"""
+    """
+    Move a blob from one container to another, or change its tier in place
+    when both are the same container
+    """
+    result = tiering.move_blobs([tiering.plan_move(blob_name, source_container, target_container)])[0]
+    if result["error"]:
+        raise Exception(f"Failed to move blob {blob_name}: {result['error']}")
+    
+    logging.info(f"Successfully moved {blob_name} from {source_container} to {target_container}")
+
+@tracing.traced()
+def move_documents_between_tiers():
+    """Move documents between tiers based on access patterns; returns the access statistics"""
     try:
-        source_blob_client = blob_service_client.get_blob_client(
-            container=source_container, 
-            blob=blob_name
-        )
-        target_blob_client = blob_service_client.get_blob_client(
-            container=target_container, 
-            blob=blob_name
-        )
+        _, promote_score, demote_score, _, _ = access_stats.stats_settings()
+        hot_container_name = os.environ.get("HOT_CONTAINER_NAME", "hot-documents")
+        max_moves = int(os.environ.get("ACCESS_MAX_MOVES", "500"))
         
-        # Copy blob to target container
-        copy_source = source_blob_client.url
-        target_blob_client.start_copy_from_url(copy_source)
+        # Fold access events written since the last run into the decayed scores
+        stats = access_stats.update()
         
-        # Wait for copy to complete
-        while True:
-            properties = target_blob_client.get_blob_properties()
-            if properties.copy.status == "success":
-                break
-            elif properties.copy.status == "failed":
-                raise Exception(f"Copy failed for {blob_name}")
+        locations = lifecycle_index.current_locations()
+        if locations is None:
+            locations = document_locations(hot_container_name, stats.names.tolist())
         
-        # Delete from source container
-        source_blob_client.delete_blob()
+        planned = access_stats.plan_tier_moves(stats, locations, hot_container_name, promote_score, demote_score)
+        if not planned:
+            logging.info("Analyzed document access patterns, no tier changes")
+            return stats
         
-        logging.info(f"Successfully moved {blob_name} from {source_container} to {target_container}")
+        moves = [tiering.plan_move(name, source, target) for name, source, target in planned[:max_moves]]
+        results = tiering.move_blobs(moves)
+        moved = [result for result in results if not result["error"]]
+        tracing.annotate(planned=len(planned), moved=len(moved))
+        for result in moved:
+            logging.info(f"Moved {result['name']} from {result['source']} to {result['target']} by access score")
         
+        # Tell the lifecycle index where the documents went
+        for target in {result["target"] for result in moved}:
+            lifecycle_index.record_events(
+                "moved", [result["name"] for result in moved if result["target"] == target], target
+            )
+        logging.info(f"Analyzed document access patterns: {tiering.summarize(results)}")
+        return stats
+            
     except Exception as e:
-        logging.error(f"Failed to move blob {blob_name}: {str(e)}")
-        raise
+        logging.error(f"Error moving documents between tiers: {str(e)}")
+        return None
 
-def move_documents_between_tiers():
-    """Move documents between tiers based on access patterns"""
+@tracing.traced()
+def compact_event_logs(stats):
+    """Compact query and access event blobs into Parquet once the access statistics have read them"""
+    if stats is None:
+        logging.info("Access statistics unavailable, skipping event compaction")
+        return
     try:
-        connection_string = os.environ.get("STORAGE_CONNECTION_STRING")
-        blob_service_client = BlobServiceClient.from_connection_string(connection_string)
-        
-        # Get document access statistics from metadata
-        metadata_container = os.environ.get("METADATA_CONTAINER_NAME", "metadata")
-        try:
-            container_client = blob_service_client.get_container_client(metadata_container)
-            
-            # Analyze access patterns and move documents accordingly
-            # This is a simplified version - in production you'd analyze access logs
-            logging.info("Analyzed document access patterns")
-            
-        except ResourceNotFoundError:
-            logging.info(f"Metadata container {metadata_container} does not exist")
-            
+        result = analytics.compact(stats)
+        if result["hours"] or result["failed"]:
+            logging.info(
+                f"Compacted {result['events']} events from {result['blobs']} blobs into {result['hours']} hourly "
+                f"files, {result['failed']} hours failed"
+            )
     except Exception as e:
-        logging.error(f"Error moving documents between tiers: {str(e)}")
+        logging.error(f"Error compacting event logs: {str(e)}")
 
-def cleanup_old_documents():
-    """Clean up old documents based on retention policy"""
+@tracing.traced()
+def prune_traces():
+    """Delete hours of the traces/ stream older than TRACE_RETENTION_DAYS (0 keeps them)"""
+    retention_days = int(os.environ.get("TRACE_RETENTION_DAYS", "7"))
+    if retention_days <= 0:
+        return
     try:
-        connection_string = os.environ.get("STORAGE_CONNECTION_STRING")
-        blob_service_client = BlobServiceClient.from_connection_string(connection_string)
-        
-        delete_threshold = int(os.environ.get("DELETE_THRESHOLD_DAYS", "365"))
-        
-        # Clean up archive container
-        archive_container_name = os.environ.get("ARCHIVE_CONTAINER_NAME", "archive")
-        try:
-            archive_container = blob_service_client.get_container_client(archive_container_name)
-            
-            for blob in archive_container.list_blobs():
-                if should_delete_document(blob, delete_threshold):
-                    blob_client = archive_container.get_blob_client(blob.name)
-                    blob_client.delete_blob()
-                    logging.info(f"Deleted old document: {blob.name}")
-                    
-        except ResourceNotFoundError:
-            logging.info(f"Archive container {archive_container_name} does not exist")
-            
+        deleted, failed = analytics.prune(tracing.TRACE_STREAM, retention_days)
+        if deleted or failed:
+            logging.info(f"Pruned {deleted} trace blobs older than {retention_days} days, {failed} failed")
+    except ResourceNotFoundError:
+        pass
     except Exception as e:
-        logging.error(f"Error cleaning up old documents: {str(e)}")
+        logging.error(f"Error pruning trace spans: {str(e)}")
+
+@tracing.traced()
+def seed_local_search():
+    """Seed the local search index from the processed container, resuming where the last run stopped"""
+    try:
+        _, directory, _ = local_search.local_search_settings()
+        if local_search.enabled() and not local_search.is_seeded(directory):
+            local_search.rebuild()
+    except Exception as e:
+        logging.error(f"Error seeding the local search index: {str(e)}")
+
+def document_locations(hot_container_name, names):
+    """Container of each document when there is no lifecycle index: hot if listed there, else documents"""
+    blob_service_client = clients.get_blob_service_client()
+    try:
+        hot = {blob.name for blob in blob_service_client.get_container_client(hot_container_name).list_blobs()}
+    except ResourceNotFoundError:
+        hot = set()
+    return {name: hot_container_name if name in hot else "documents" for name in names}
 
 def should_delete_document(blob, threshold_days):
     """Check if document should be deleted based on age"""
@@ -172,4 +227,10 @@ def should_delete_document(blob, threshold_days):
         return False
     
     days_since_creation = (datetime.utcnow() - blob.last_modified.replace(tzinfo=None)).days
-    return days_since_creation > threshold_days 
\ No newline at end of file
+    return days_since_creation > threshold_days 
+
+# Clients loaded ahead of the first run when WARMUP_ENABLED is true
+warmup.start({
+    "blob": clients.get_blob_service_client,
+    "sdks": lambda: warmup.import_modules("aiohttp", "azure.storage.blob.aio")
+})
@@ -2,18 +2,29 @@ import azure.functions as func
 import logging
 import os
 import json
+import base64
 from datetime import datetime
-from azure.storage.blob import BlobServiceClient
-from azure.search.documents import SearchClient
-from azure.core.credentials import AzureKeyCredential
-from azure.cognitiveservices.vision.formrecognizer import FormRecognizerClient
-from azure.cognitiveservices.vision.formrecognizer.models import AnalyzeDocumentRequest
-import PyPDF2
-import docx
-import io
-from PIL import Image
-import pytesseract
+from azure.storage.blob import BlobBlock
+from shared_code import answer_cache, chunking, clients, extraction, ingestion, lifecycle_index, local_search, manifest, ocr, retrieval_cache, telemetry, tracing, warmup
 
+# Characters of processed text per staged block
+PROCESSED_BLOCK_CHARS = 4 * 1024 * 1024
+
+# Text extractor per file extension, and the parser modules each imports on
+# first use; extensions not listed go to Form Recognizer
+EXTRACTORS = {}
+PARSER_MODULES = {}
+
+def extractor(*extensions, modules=()):
+    """Register an extractor for file extensions: fn(source, filename, known_pages, page_counts) -> (pieces, pages)"""
+    def register(function):
+        for extension in extensions:
+            EXTRACTORS[extension] = function
+            PARSER_MODULES[extension] = modules
+        return function
+    return register
+
+@tracing.traced("document_upload")
 def main(blob: func.InputStream, name: str):
     """
     Process uploaded documents: extract text, store processed content, and index in search
@@ -21,17 +32,42 @@ def main(blob: func.InputStream, name: str):
     logging.info(f"Processing document: {name}")
     
     try:
-        # Extract text from document
-        content = extract_document_text(blob, name)
-        
-        # Store processed content
-        store_processed_content(name, content)
+        # Read the upload once, in chunks, into memory or a temp file for large files
+        with ingestion.SpooledInput(blob) as source:
+            sha = source.sha256
+            state = manifest.processed_state(name)
+            
+            # Same bytes as the version already processed and indexed
+            if manifest.is_unchanged(state, sha):
+                logging.info(f"Document {name} is unchanged, skipping processing")
+                manifest.record(skipped=True)
+                track_document_access(name, "upload")
+                return
+            
+            # Same bytes as another file: share its extraction
+            entry = manifest.load_entry(sha)
+            content = manifest.load_processed_text(sha, entry) if entry else None
+            pages = None
+            reused = content is not None
+            page_counts = (0, 0)
+            
+            if reused:
+                logging.info(f"Reusing the extraction of {entry['names'][0]} for {name}")
+            else:
+                # Pages unchanged since the previous version of this file are not re-extracted
+                known_pages = {}
+                if name.lower().endswith('.pdf') and state:
+                    known_pages = manifest.load_page_texts(state.get("content_sha256"))
+                content, pages, page_counts = extract_document_text(source, name, known_pages)
         
-        # Index document in search
-        index_document(name, content)
+        with content:
+            # Store processed content
+            store_processed_content(name, content, sha)
+            
+            # Index document in search
+            indexed = index_document(name, content)
         
-        # Track document access
-        track_document_access(name, "upload")
+        record_processed(name, sha, source.size, indexed, pages, reused, page_counts)
         
         logging.info(f"Document {name} processed successfully")
         
@@ -39,68 +75,102 @@ def main(blob: func.InputStream, name: str):
         logging.error(f"Error processing document {name}: {str(e)}")
         raise
 
-def extract_document_text(blob, filename):
+def record_processed(name, sha, size, indexed, pages=None, reused=False, page_counts=(0, 0), container="documents",
+                     uploaded=None):
+    """
+    Mark the file indexed, save its PDF page records and manifest entry, and
+    track the upload in container; uploaded is when the blob was written, if not now
     """
-    Extract text from various document formats
+    if indexed:
+        manifest.mark_indexed(name, sha)
+    if pages is not None:
+        with pages:
+            manifest.save_page_texts(sha, pages)
+    manifest.save_entry(sha, name, size, indexed)
+    manifest.record(reused=reused, pages_seen=page_counts[0], pages_reused=page_counts[1])
+    
+    # Track document access
+    track_document_access(name, "upload", container, uploaded)
+
+@tracing.traced()
+def extract_document_text(source, filename, known_pages=None):
+    """
+    Extract text from various document formats into a SpooledText.
+    Returns the text, the PDF page records as JSON lines (None for other
+    formats) and the (pages seen, pages reused from known_pages) counts.
     """
-    file_content = blob.read()
     file_extension = filename.lower().split('.')[-1]
+    pages = None
+    page_counts = [0, 0]
     
     try:
-        if file_extension == 'pdf':
-            return extract_pdf_text(file_content)
-        elif file_extension == 'docx':
-            return extract_docx_text(file_content)
-        elif file_extension == 'txt':
-            return file_content.decode('utf-8')
-        elif file_extension in ['jpg', 'jpeg', 'png', 'tiff']:
-            return extract_image_text(file_content)
-        else:
-            # Try Form Recognizer for other formats
-            return extract_with_form_recognizer(file_content, filename)
+        extract = EXTRACTORS.get(file_extension, extract_other_text)
+        pieces, pages = extract(source, filename, known_pages or {}, page_counts)
+        
+        # Pieces are written out as they are extracted, so the text is never one string
+        text = ingestion.SpooledText(pieces)
+        tracing.annotate(bytes=source.size, chars=text.length, pages=page_counts[0])
+        return text, pages, tuple(page_counts)
     except Exception as e:
         logging.warning(f"Could not extract text from {filename}: {str(e)}")
-        return f"Document: {filename}\nType: {file_extension}\nSize: {len(file_content)} bytes"
-
-def extract_pdf_text(file_content):
-    """Extract text from PDF files"""
-    pdf_reader = PyPDF2.PdfReader(io.BytesIO(file_content))
-    text = ""
-    for page in pdf_reader.pages:
-        text += page.extract_text() + "\n"
-    return text.strip()
-
-def extract_docx_text(file_content):
-    """Extract text from DOCX files"""
-    doc = docx.Document(io.BytesIO(file_content))
-    text = ""
-    for paragraph in doc.paragraphs:
-        text += paragraph.text + "\n"
-    return text.strip()
-
-def extract_image_text(file_content):
-    """Extract text from images using OCR"""
+        if pages is not None:
+            pages.close()
+        placeholder = f"Document: {filename}\nType: {file_extension}\nSize: {source.size} bytes"
+        return ingestion.SpooledText([placeholder]), None, (0, 0)
+
+@extractor('pdf', modules=('PyPDF2',))
+def extract_pdf_text(source, filename, known_pages, page_counts):
+    """PDF page texts, with the page records saved for the next version of the file"""
+    pages = ingestion.SpooledText()
+    return iter_pdf_text(source.reader(), known_pages, pages, page_counts), pages
+
+@extractor('docx', modules=('docx',))
+def extract_docx_text(source, filename, known_pages, page_counts):
+    """DOCX paragraph texts"""
+    return extraction.iter_docx_paragraphs(source.reader()), None
+
+@extractor('txt')
+def extract_plain_text(source, filename, known_pages, page_counts):
+    """Text decoded chunk by chunk"""
+    return ingestion.iter_decoded(source.reader()), None
+
+@extractor('jpg', 'jpeg', 'png', 'tif', 'tiff', modules=('PIL.Image', 'pytesseract'))
+def extract_scanned_text(source, filename, known_pages, page_counts):
+    """OCR text of every frame of an image"""
+    return [extract_image_text(source.reader(), filename)], None
+
+def extract_other_text(source, filename, known_pages, page_counts):
+    """Try Form Recognizer for other formats"""
+    return [extract_with_form_recognizer(source.reader(), filename)], None
+
+def iter_pdf_text(stream, known_pages, pages, page_counts):
+    """Yield PDF page texts, recording each page and whether its text was reused"""
+    for fingerprint, text in extraction.iter_pdf_page_records(stream, known_pages):
+        page_counts[0] += 1
+        page_counts[1] += int(fingerprint in known_pages)
+        pages.write(json.dumps({"page": fingerprint, "text": text}))
+        yield text
+
+@tracing.traced()
+def extract_image_text(stream, filename=""):
+    """Extract text from images, page by page for multi-frame TIFFs, on the OCR pool"""
     try:
-        image = Image.open(io.BytesIO(file_content))
-        text = pytesseract.image_to_string(image)
-        return text.strip()
+        return extraction.join_text(ocr.iter_image_text(stream, ocr.tenant_of(filename)))
     except Exception as e:
         logging.warning(f"OCR failed: {str(e)}")
         return "Image document - OCR processing failed"
 
-def extract_with_form_recognizer(file_content, filename):
+@tracing.traced()
+def extract_with_form_recognizer(stream, filename):
     """Extract text using Azure Form Recognizer"""
     try:
-        endpoint = os.environ.get("FORM_RECOGNIZER_ENDPOINT")
-        key = os.environ.get("FORM_RECOGNIZER_KEY")
+        form_recognizer_client = clients.get_form_recognizer_client()
         
-        if not endpoint or not key:
+        if form_recognizer_client is None:
             return f"Document: {filename} - Form Recognizer not configured"
         
-        form_recognizer_client = FormRecognizerClient(endpoint, AzureKeyCredential(key))
-        
         poller = form_recognizer_client.begin_analyze_document(
-            "prebuilt-document", file_content
+            "prebuilt-document", stream
         )
         result = poller.result()
         
@@ -114,11 +184,11 @@ def extract_with_form_recognizer(file_content, filename):
         logging.warning(f"Form Recognizer failed: {str(e)}")
         return f"Document: {filename} - Form Recognizer processing failed"
 
-def store_processed_content(filename, content):
-    """Store processed text content in the processed container"""
+@tracing.traced()
+def store_processed_content(filename, content, sha=None):
+    """Store processed text content in the processed container, tagged with the upload's hash"""
     try:
-        connection_string = os.environ.get("STORAGE_CONNECTION_STRING")
-        blob_service_client = BlobServiceClient.from_connection_string(connection_string)
+        blob_service_client = clients.get_blob_service_client()
         
         container_name = "processed"
         container_client = blob_service_client.get_container_client(container_name)
@@ -130,78 +200,199 @@ def store_processed_content(filename, content):
             blob_service_client.create_container(container_name)
         
         # Store processed content
-        blob_name = f"{filename}.txt"
+        blob_name = manifest.processed_blob_name(filename)
         blob_client = container_client.get_blob_client(blob_name)
         
-        blob_client.upload_blob(content.encode('utf-8'), overwrite=True)
+        # Not marked indexed until indexing succeeds, so a failed run is retried
+        metadata = {"content_sha256": sha, "indexed": "false"} if sha else None
+        
+        if isinstance(content, str):
+            data = content.encode('utf-8')
+            blob_client.upload_blob(data, overwrite=True, metadata=metadata)
+            tracing.annotate(bytes=len(data))
+        else:
+            # Stream spooled text up as staged blocks instead of one encoded copy
+            upload_staged_blocks(blob_client, content.iter_pieces(PROCESSED_BLOCK_CHARS), metadata)
         logging.info(f"Stored processed content for {filename}")
         
     except Exception as e:
         logging.error(f"Failed to store processed content for {filename}: {str(e)}")
         raise
 
+def upload_staged_blocks(blob_client, pieces, metadata=None):
+    """Upload text pieces as the blocks of a block blob, committed once all are staged"""
+    block_list = []
+    for index, piece in enumerate(pieces):
+        block_id = base64.b64encode(f"{index:08d}".encode('utf-8')).decode('utf-8')
+        data = piece.encode('utf-8')
+        blob_client.stage_block(block_id, data)
+        tracing.add("bytes", len(data))
+        block_list.append(BlobBlock(block_id=block_id))
+    blob_client.commit_block_list(block_list, metadata=metadata)
+
+@tracing.traced()
 def index_document(filename, content):
-    """Index document in Azure Cognitive Search"""
+    """
+    Index document in Azure Cognitive Search and the local index as overlapping
+    chunks with embeddings.
+    Returns False if indexing failed, so the upload is processed again next time.
+    """
     try:
-        endpoint = os.environ.get("SEARCH_ENDPOINT")
-        key = os.environ.get("SEARCH_API_KEY")
+        search_client = clients.get_search_client("documents")
+        local = local_search.enabled()
         
-        if not endpoint or not key:
+        if search_client is None and not local:
             logging.warning("Search service not configured, skipping indexing")
-            return
+            return True
         
-        search_client = SearchClient(
-            endpoint=endpoint,
-            index_name="documents",
-            credential=AzureKeyCredential(key)
-        )
+        batch_size = int(os.environ.get("SEARCH_UPLOAD_BATCH_SIZE", "100"))
+        upload_date = datetime.utcnow().isoformat()
         
-        # Prepare document for indexing
-        document = {
-            "id": filename,
-            "filename": filename,
-            "content": content,
-            "upload_date": datetime.utcnow().isoformat(),
-            "file_type": filename.split('.')[-1].lower(),
-            "content_length": len(content)
-        }
+        # Spooled text is chunked piece by piece rather than read into one string
+        if isinstance(content, str):
+            pieces, content_length = content, len(content)
+        else:
+            pieces, content_length = content.iter_pieces(), content.length
+        
+        # The local index drops the previous version's chunks up front
+        if local:
+            local_search.remove_document(filename)
         
-        # Index the document
-        search_client.upload_documents([document])
-        logging.info(f"Indexed document {filename} in search")
+        # Upload chunks in batches so a large document is never sent in one request
+        chunk_ids = set()
+        batch = []
+        for doc in iter_chunk_docs(filename, pieces, content_length, upload_date):
+            batch.append(doc)
+            if len(batch) >= batch_size:
+                upload_chunk_batch(search_client, batch, local)
+                chunk_ids.update(doc["id"] for doc in batch)
+                batch = []
+        
+        if batch:
+            upload_chunk_batch(search_client, batch, local)
+            chunk_ids.update(doc["id"] for doc in batch)
+        
+        # Chunks left over from a longer previous version of the file
+        if search_client is not None:
+            remove_stale_chunks(search_client, filename, chunk_ids)
+        logging.info(f"Indexed document {filename} in search as {len(chunk_ids)} chunks")
+        tracing.annotate(chars=content_length, chunks=len(chunk_ids))
+        
+        # Cached answers built from the previous version are now stale
+        cache = answer_cache.get_answer_cache()
+        if cache is not None:
+            cache.invalidate_document(filename)
+        # So are cached search results, from any document
+        retrieval_cache.bump_generation()
+        return True
         
     except Exception as e:
         logging.error(f"Failed to index document {filename}: {str(e)}")
+        # Some batches may have reached the index before the failure
+        retrieval_cache.bump_generation()
         # Don't raise here - indexing failure shouldn't fail the whole process
+        return False
+
+def iter_chunk_docs(filename, pieces, content_length, upload_date):
+    """Search documents for the overlapping chunks of a file's text (a string or text pieces)"""
+    file_type = filename.split('.')[-1].lower()
+    for chunk_index, chunk in enumerate(chunking.iter_chunks(pieces)):
+        yield {
+            "id": chunking.chunk_key(filename, chunk_index),
+            "parent_id": chunking.parent_key(filename),
+            "filename": filename,
+            "chunk_index": chunk_index,
+            "content": chunk,
+            "upload_date": upload_date,
+            "file_type": file_type,
+            "content_length": content_length
+        }
+
+@tracing.traced()
+def upload_chunk_batch(search_client, batch, local=False):
+    """Embed a batch of chunks, when embeddings are configured, and upload it to search and the local index"""
+    add_embeddings(batch)
+    
+    if search_client is not None:
+        results = search_client.upload_documents(batch)
+        failed = [result.key for result in results if not result.succeeded]
+        if failed:
+            raise Exception(f"{len(failed)} chunks failed to index, first: {failed[0]}")
+    
+    if local:
+        local_search.add_chunks(batch[0]["filename"], batch[0]["upload_date"], batch)
+
+def add_embeddings(batch):
+    """Set content_vector on each chunk, when embeddings are configured"""
+    embeddings = embed_texts([doc["content"] for doc in batch])
+    if embeddings is not None:
+        for doc, embedding in zip(batch, embeddings):
+            doc["content_vector"] = embedding
+
+@tracing.traced()
+def embed_texts(texts):
+    """Embed texts with Azure OpenAI in batches, or None if embeddings are not configured"""
+    deployment = os.environ.get("OPENAI_EMBEDDING_DEPLOYMENT")
+    # Checked first so uploads without embeddings never load the OpenAI SDK
+    client = clients.get_openai_client() if deployment else None
+    
+    if client is None:
+        return None
+    
+    batch_size = int(os.environ.get("EMBEDDING_BATCH_SIZE", "16"))
+    embeddings = []
+    for i in range(0, len(texts), batch_size):
+        response = client.embeddings.create(model=deployment, input=texts[i:i + batch_size])
+        embeddings.extend(item.embedding for item in sorted(response.data, key=lambda item: item.index))
+        usage = getattr(response, "usage", None)
+        if usage is not None:
+            tracing.add("tokens", usage.total_tokens)
+    return embeddings
+
+def remove_stale_chunks(search_client, filename, current_ids):
+    """Delete indexed chunks of filename that the latest upload did not produce"""
+    existing = search_client.search(
+        search_text="*",
+        filter=f"parent_id eq '{chunking.parent_key(filename)}'",
+        select=["id"]
+    )
+    stale = [{"id": result["id"]} for result in existing if result["id"] not in current_ids]
+    
+    batch_size = int(os.environ.get("SEARCH_UPLOAD_BATCH_SIZE", "100"))
+    for i in range(0, len(stale), batch_size):
+        search_client.delete_documents(stale[i:i + batch_size])
+    
+    if stale:
+        logging.info(f"Removed {len(stale)} stale chunks of {filename}")
 
-def track_document_access(filename, access_type):
-    """Track document access for analytics"""
+@tracing.traced()
+def track_document_access(filename, access_type, container="documents", when=None):
+    """
+    Track document access for analytics, and journal it if the lifecycle
+    manages the file's container, as of when (epoch seconds, default now)
+    """
     try:
-        # Store access metadata
-        connection_string = os.environ.get("STORAGE_CONNECTION_STRING")
-        blob_service_client = BlobServiceClient.from_connection_string(connection_string)
-        
-        container_name = os.environ.get("METADATA_CONTAINER_NAME", "metadata")
-        container_client = blob_service_client.get_container_client(container_name)
-        
-        # Create container if it doesn't exist
-        try:
-            container_client.get_container_properties()
-        except:
-            blob_service_client.create_container(container_name)
-        
-        # Store access metadata
-        metadata = {
+        # Buffered and appended to the hourly access log in batches
+        telemetry.write(telemetry.ACCESS_STREAM, {
             "filename": filename,
             "access_type": access_type,
             "access_time": datetime.utcnow().isoformat(),
             "access_count": 1
-        }
+        })
         
-        blob_name = f"access_logs/{filename}_{datetime.utcnow().strftime('%Y%m%d_%H%M%S')}.json"
-        blob_client = container_client.get_blob_client(blob_name)
-        blob_client.upload_blob(json.dumps(metadata).encode('utf-8'))
+        # Journal the event so the lifecycle index sees it without a listing; blobs elsewhere are not its to move
+        if container in lifecycle_index.managed_containers():
+            event_type = "upload" if access_type == "upload" else "access"
+            lifecycle_index.record_events(event_type, [filename], container, when)
         
     except Exception as e:
         logging.warning(f"Failed to track access for {filename}: {str(e)}")
-        # Don't raise here - tracking failure shouldn't fail the whole process 
\ No newline at end of file
+        # Don't raise here - tracking failure shouldn't fail the whole process 
+
+# Parsers and clients loaded ahead of the first upload when WARMUP_ENABLED is true
+warmup.start({
+    "blob": clients.get_blob_service_client,
+    "search": clients.get_search_client,
+    "openai": lambda: os.environ.get("OPENAI_EMBEDDING_DEPLOYMENT") and clients.get_openai_client(),
+    "parsers": lambda: warmup.import_modules(*sorted({name for names in PARSER_MODULES.values() for name in names}))
+})
@@ -0,0 +1,471 @@
+"""
+Bulk ingestion: backfill, re-index or re-embed every blob under a container prefix.
+
+The blob trigger processes one upload per invocation, so onboarding tens of
+thousands of existing blobs costs as many separate search uploads and
+sequential storage writes. A bulk run lists the blobs instead and pushes them
+through three stages:
+
+- extract: threads download and hash each blob and apply the manifest's
+  unchanged-skip and shared-extraction rules; the text of the rest is
+  extracted on a process pool of BULK_EXTRACT_WORKERS;
+- store: the same BULK_STORE_WORKERS threads upload the processed text, drop
+  stale chunks of re-indexed files, and chunk and embed the text;
+- index: one thread packs the chunks of many documents into `upload_documents`
+  batches of up to BULK_INDEX_BATCH_SIZE chunks (Azure accepts 1000) and
+  BULK_INDEX_BATCH_MB of JSON, then marks each document indexed once all of
+  its chunks are in.
+
+The stages are joined by bounded queues, so a slow stage holds back the ones
+before it instead of letting extracted text pile up in memory. Every
+BULK_PROGRESS_SECONDS the run reports documents, MB and chunks per second and
+the queue depths, and checkpoints to the metadata container the blob name up
+to which every blob is done, plus the blobs that failed. Running again for the
+same container and prefix resumes after that name and retries the failures.
+
+    python -m DocumentUploadProcessor.bulk --container documents --prefix acme/
+    python -m DocumentUploadProcessor.bulk --container documents --force
+"""
+import argparse
+import hashlib
+import io
+import json
+import logging
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime
+
+from azure.core.exceptions import ResourceNotFoundError
+
+from DocumentUploadProcessor import add_embeddings, extract_document_text, iter_chunk_docs, record_processed, remove_stale_chunks, store_processed_content
+from shared_code import answer_cache, clients, ingestion, local_search, manifest, retrieval_cache, tracing
+
+# Most documents Azure Cognitive Search accepts in one indexing request
+MAX_INDEX_BATCH = 1000
+
+# A partly filled index batch is sent when no document arrives for this long
+INDEX_FLUSH_SECONDS = 5
+
+CHECKPOINT_PREFIX = "bulk_ingest/"
+
+
+def bulk_settings():
+    """Extraction processes, store threads, chunks and MB per index batch, and seconds between progress reports"""
+    extract_workers = int(os.environ.get("BULK_EXTRACT_WORKERS", str(os.cpu_count() or 1)))
+    store_workers = int(os.environ.get("BULK_STORE_WORKERS", "16"))
+    batch_size = min(int(os.environ.get("BULK_INDEX_BATCH_SIZE", str(MAX_INDEX_BATCH))), MAX_INDEX_BATCH)
+    batch_mb = float(os.environ.get("BULK_INDEX_BATCH_MB", "12"))
+    progress_seconds = float(os.environ.get("BULK_PROGRESS_SECONDS", "30"))
+    return max(1, extract_workers), max(1, store_workers), max(1, batch_size), batch_mb, progress_seconds
+
+
+def checkpoint_blob_name(container, prefix):
+    key = hashlib.sha1(f"{container}/{prefix}".encode("utf-8")).hexdigest()
+    return f"{CHECKPOINT_PREFIX}{key}.json"
+
+
+def _metadata_container():
+    blob_service_client = clients.get_blob_service_client()
+    return blob_service_client.get_container_client(os.environ.get("METADATA_CONTAINER_NAME", "metadata"))
+
+
+def load_checkpoint(container, prefix):
+    """The checkpoint of the last run over container and prefix, or None"""
+    try:
+        data = _metadata_container().download_blob(checkpoint_blob_name(container, prefix)).readall()
+        return json.loads(data)
+    except ResourceNotFoundError:
+        return None
+
+
+def save_checkpoint(checkpoint):
+    container_client = _metadata_container()
+    blob_name = checkpoint_blob_name(checkpoint["container"], checkpoint["prefix"])
+    data = json.dumps(checkpoint).encode("utf-8")
+    try:
+        container_client.upload_blob(blob_name, data, overwrite=True)
+    except ResourceNotFoundError:
+        container_client.create_container()
+        container_client.upload_blob(blob_name, data, overwrite=True)
+
+
+def _init_extract_worker():
+    # The bulk pool already has a process per core; each one's pages go to a single extraction worker
+    os.environ["EXTRACTION_WORKERS"] = "1"
+    os.environ["OCR_WORKERS"] = "1"
+
+
+def extract_in_worker(name, data, known_pages):
+    """Extraction worker: text, PDF page records and page counts of a blob, given its bytes or spilled file"""
+    stream = open(data, "rb") if isinstance(data, str) else io.BytesIO(data)
+    with stream, ingestion.SpooledInput(stream) as source:
+        content, pages, page_counts = extract_document_text(source, name, known_pages)
+    with content:
+        text = content.read_all()
+    if pages is not None:
+        with pages:
+            return text, pages.read_all(), page_counts
+    return text, None, page_counts
+
+
+@tracing.traced("bulk_extract")
+def fetch_document(container, name, pool, force=False):
+    """
+    Extract stage: download and hash a blob, then reuse an extraction of the
+    same bytes or extract its text on the process pool. Returns the document
+    as a dict for the store stage; "skipped" is set when it is unchanged since
+    it was last indexed and force is not set.
+    """
+    state = manifest.processed_state(name)
+    blob_client = clients.get_blob_service_client().get_blob_client(container, name)
+    downloader = blob_client.download_blob()
+    with ingestion.SpooledInput(downloader) as source:
+        sha = source.sha256
+        # The lifecycle counts a document's age from when it was uploaded, not from this run
+        uploaded = downloader.properties.last_modified.timestamp()
+        document = {"name": name, "sha": sha, "size": source.size, "previous": bool(state), "skipped": False,
+                    "stored": False, "text": None, "pages": None, "reused": False, "page_counts": (0, 0),
+                    "uploaded": uploaded}
+        tracing.annotate(bytes=source.size)
+        if not force and manifest.is_unchanged(state, sha):
+            document["skipped"] = True
+            return document
+
+        # A forced re-index of unchanged bytes finds its own processed text
+        stored = bool(state) and state.get("content_sha256") == sha
+        entry = manifest.load_entry(sha) or ({"names": [name]} if stored else None)
+        content = manifest.load_processed_text(sha, entry) if entry else None
+        if content is not None:
+            with content:
+                document["text"] = content.read_all()
+            document["reused"] = True
+            document["stored"] = stored
+            return document
+
+        known_pages = {}
+        if name.lower().endswith('.pdf') and state:
+            known_pages = manifest.load_page_texts(state.get("content_sha256"))
+        # Workers reopen a spilled upload by path rather than receiving a copy of it
+        data = source.path if source.path else source.reader().getvalue()
+        document["text"], document["pages"], document["page_counts"] = pool.submit(
+            extract_in_worker, name, data, known_pages
+        ).result()
+    return document
+
+
+@tracing.traced("bulk_store")
+def store_document(document, search_client, local, upload_date):
+    """Store stage: upload the processed text unless it is already there, then chunk and embed it"""
+    name = document["name"]
+    text = document.pop("text")
+    if not document["stored"]:
+        store_processed_content(name, text, document["sha"])
+
+    document["chunks"] = []
+    if search_client is None and not local:
+        return
+
+    chunks = list(iter_chunk_docs(name, text, len(text), upload_date))
+    if chunks:
+        add_embeddings(chunks)
+    # Chunks left over from a longer previous version of the file
+    if search_client is not None and document["previous"]:
+        remove_stale_chunks(search_client, name, {doc["id"] for doc in chunks})
+    document["chunks"] = chunks
+
+
+@tracing.traced("bulk_index_batch")
+def upload_index_batch(search_client, batch):
+    """Upload one batch of chunks; returns the keys that failed"""
+    tracing.annotate(chunks=len(batch))
+    results = search_client.upload_documents(batch)
+    return {result.key for result in results if not result.succeeded}
+
+
+class BulkRun:
+    """Progress, throughput and checkpoint of one bulk run"""
+
+    def __init__(self, container, prefix, checkpoint=None):
+        checkpoint = checkpoint or {}
+        self.container = container
+        self.prefix = prefix
+        self.started = checkpoint.get("started") or datetime.utcnow().isoformat()
+        self.watermark = checkpoint.get("watermark")
+        self.retry = list(checkpoint.get("failed", []))
+        self.failed = set()
+        self._retrying = set(self.retry)
+        self.error = None
+        self.counts = {"listed": 0, "extracted": 0, "stored": 0, "indexed": 0, "skipped": 0, "failed": 0,
+                       "bytes": 0, "chunks": 0}
+        self._order = deque()
+        self._finished = set()
+        self._lock = threading.Lock()
+        self._start = time.monotonic()
+
+    def count(self, key, n=1):
+        with self._lock:
+            self.counts[key] += n
+
+    def listed(self, name):
+        with self._lock:
+            self.counts["listed"] += 1
+            self._order.append(name)
+
+    def finished(self, name, failed=False):
+        """Count a document as done; the watermark moves past every name done in listing order"""
+        with self._lock:
+            if failed:
+                self.counts["failed"] += 1
+                self.failed.add(name)
+            self._finished.add(name)
+            self._retrying.discard(name)
+            while self._order and self._order[0] in self._finished:
+                done = self._order.popleft()
+                self._finished.discard(done)
+                if self.watermark is None or done > self.watermark:
+                    self.watermark = done
+
+    def progress(self, queues=None):
+        """Counters with documents, MB and chunks per second since the run started"""
+        elapsed = max(time.monotonic() - self._start, 1e-9)
+        with self._lock:
+            figures = dict(self.counts)
+        figures["done"] = figures["indexed"] + figures["skipped"] + figures["failed"]
+        figures["elapsed_seconds"] = round(elapsed, 1)
+        figures["documents_per_second"] = figures["done"] / elapsed
+        figures["mb_per_second"] = figures["bytes"] / elapsed / (1024 * 1024)
+        figures["chunks_per_second"] = figures["chunks"] / elapsed
+        figures["queued"] = {stage: depth() for stage, depth in (queues or {}).items()}
+        return figures
+
+    def checkpoint(self, done=False):
+        with self._lock:
+            # Failures from the previous run stay listed until they are retried
+            failed = sorted(self.failed | self._retrying)
+            watermark = self.watermark
+        return {"container": self.container, "prefix": self.prefix, "started": self.started, "watermark": watermark,
+                "failed": failed, "done": done, "counts": dict(self.counts), "updated": datetime.utcnow().isoformat()}
+
+
+def describe(figures):
+    queued = ", ".join(f"{stage} {depth}" for stage, depth in figures["queued"].items())
+    return (
+        f"{figures['done']}/{figures['listed']} documents done ({figures['skipped']} skipped, "
+        f"{figures['failed']} failed) in {figures['elapsed_seconds']:.0f}s: "
+        f"{figures['documents_per_second']:.1f} docs/s, {figures['mb_per_second']:.2f} MB/s, "
+        f"{figures['chunks_per_second']:.0f} chunks/s" + (f"; queued {queued}" if queued else "")
+    )
+
+
+def list_names(container, prefix, run, done):
+    """Failed names from the checkpoint, then names after its watermark, in listing order"""
+    for name in run.retry:
+        yield name
+    if done:
+        return
+    retried = set(run.retry)
+    container_client = clients.get_blob_service_client().get_container_client(container)
+    for blob in container_client.list_blobs(name_starts_with=prefix or None):
+        if run.watermark is not None and blob.name <= run.watermark:
+            continue
+        if blob.name not in retried:
+            yield blob.name
+
+
+def run(container="documents", prefix="", force=False, restart=False, report=None):
+    """
+    Ingest every blob under container/prefix; returns the final progress figures.
+    force re-indexes and re-embeds unchanged documents too; restart ignores the
+    checkpoint of a previous run. report(figures) is called with the progress
+    every BULK_PROGRESS_SECONDS and at the end (by default it is logged).
+    """
+    extract_workers, store_workers, batch_size, batch_mb, progress_seconds = bulk_settings()
+    report = report or (lambda figures: logging.info(f"Bulk ingestion of {container}/{prefix}: {describe(figures)}"))
+
+    # A finished run is started over, unless it left failures to retry
+    checkpoint = None if restart else load_checkpoint(container, prefix)
+    if checkpoint and checkpoint.get("done") and not checkpoint.get("failed"):
+        checkpoint = None
+    bulk_run = BulkRun(container, prefix, checkpoint)
+    if checkpoint:
+        resumed = "retrying its failures" if checkpoint.get("done") else f"after {bulk_run.watermark}"
+        logging.info(f"Resuming bulk ingestion of {container}/{prefix} {resumed}, "
+                     f"{len(bulk_run.retry)} failed documents to retry")
+
+    search_client = clients.get_search_client("documents")
+    local = local_search.enabled()
+    upload_date = datetime.utcnow().isoformat()
+
+    # Bounded queues between the stages: a full queue blocks the stage feeding it
+    listed = queue.Queue(maxsize=store_workers * 2)
+    stored = queue.Queue(maxsize=store_workers * 2)
+    finishing = ThreadPoolExecutor(store_workers, thread_name_prefix="bulk-finish")
+    pool = ProcessPoolExecutor(extract_workers, mp_context=multiprocessing.get_context("spawn"),
+                               initializer=_init_extract_worker)
+    queues = {"extract": listed.qsize, "index": stored.qsize}
+
+    def finish(document, indexed):
+        try:
+            pages = ingestion.SpooledText([document["pages"]], separator="") if document["pages"] is not None else None
+            record_processed(document["name"], document["sha"], document["size"], indexed, pages,
+                             document["reused"], document["page_counts"], container, document["uploaded"])
+            if indexed and document["previous"]:
+                # Cached answers built from the previous version are now stale
+                cache = answer_cache.get_answer_cache()
+                if cache is not None:
+                    cache.invalidate_document(document["name"])
+        except Exception as e:
+            logging.error(f"Failed to record {document['name']}: {str(e)}")
+            indexed = False
+        if indexed:
+            bulk_run.count("indexed")
+        bulk_run.finished(document["name"], failed=not indexed)
+
+    def store_stage():
+        # Each thread extracts a document, waiting on the process pool for its text, then stores and embeds it
+        while True:
+            name = listed.get()
+            if name is None:
+                return
+            try:
+                document = fetch_document(container, name, pool, force)
+                bulk_run.count("extracted")
+                bulk_run.count("bytes", document["size"])
+                if document["skipped"]:
+                    manifest.record(skipped=True)
+                    bulk_run.count("skipped")
+                    bulk_run.finished(name)
+                    continue
+                store_document(document, search_client, local, upload_date)
+                bulk_run.count("stored")
+            except Exception as e:
+                logging.error(f"Bulk ingestion of {name} failed: {str(e)}")
+                if isinstance(e, BrokenProcessPool):
+                    bulk_run.error = e
+                bulk_run.finished(name, failed=True)
+                continue
+            stored.put(document)
+
+    def index_stage():
+        batch, batch_bytes, pending = [], 0, {}
+
+        def flush():
+            nonlocal batch, batch_bytes
+            if not batch:
+                return
+            try:
+                failed_keys = upload_index_batch(search_client, batch) if search_client is not None else set()
+            except Exception as e:
+                logging.error(f"Index batch of {len(batch)} chunks failed: {str(e)}")
+                failed_keys = {doc["id"] for doc in batch}
+            retrieval_cache.bump_generation()
+            for doc in batch:
+                entry = pending[doc["filename"]]
+                entry[1] -= 1
+                entry[2] = entry[2] and doc["id"] not in failed_keys
+                if entry[1] == 0:
+                    del pending[doc["filename"]]
+                    bulk_run.count("chunks", entry[3])
+                    finishing.submit(finish, entry[0], entry[2])
+            batch, batch_bytes = [], 0
+
+        while True:
+            try:
+                document = stored.get(timeout=INDEX_FLUSH_SECONDS)
+            except queue.Empty:
+                flush()
+                continue
+            if document is None:
+                flush()
+                return
+
+            chunks = document.pop("chunks")
+            if local:
+                try:
+                    local_search.remove_document(document["name"])
+                    if chunks:
+                        local_search.add_chunks(document["name"], upload_date, chunks)
+                except Exception as e:
+                    logging.error(f"Failed to index {document['name']} locally: {str(e)}")
+                    finishing.submit(finish, document, False)
+                    continue
+            if not chunks or search_client is None:
+                bulk_run.count("chunks", len(chunks))
+                finishing.submit(finish, document, True)
+                continue
+
+            # [document, chunks not yet uploaded, all uploaded so far, chunk count]
+            pending[document["name"]] = [document, len(chunks), True, len(chunks)]
+            for doc in chunks:
+                size = len(json.dumps(doc))
+                if batch and (len(batch) >= batch_size or batch_bytes + size > batch_mb * 1024 * 1024):
+                    flush()
+                batch.append(doc)
+                batch_bytes += size
+
+    store_threads = [threading.Thread(target=store_stage, name=f"bulk-store-{i}", daemon=True)
+                     for i in range(store_workers)]
+    index_thread = threading.Thread(target=index_stage, name="bulk-index", daemon=True)
+    stop = threading.Event()
+
+    def report_progress():
+        while not stop.wait(progress_seconds):
+            report(bulk_run.progress(queues))
+            try:
+                save_checkpoint(bulk_run.checkpoint())
+            except Exception as e:
+                logging.warning(f"Failed to save the bulk ingestion checkpoint: {str(e)}")
+
+    reporter = threading.Thread(target=report_progress, name="bulk-progress", daemon=True)
+    for thread in store_threads + [index_thread, reporter]:
+        thread.start()
+
+    try:
+        done = bool(checkpoint and checkpoint.get("done"))
+        for name in list_names(container, prefix, bulk_run, done):
+            if bulk_run.error is not None:
+                raise bulk_run.error
+            bulk_run.listed(name)
+            listed.put(name)
+        for _ in store_threads:
+            listed.put(None)
+        for thread in store_threads:
+            thread.join()
+        stored.put(None)
+        index_thread.join()
+        finishing.shutdown(wait=True)
+    finally:
+        stop.set()
+        pool.shutdown(wait=False, cancel_futures=True)
+        # Only finished documents move the watermark, so an interrupted run resumes where it was
+        finished = not index_thread.is_alive()
+        save_checkpoint(bulk_run.checkpoint(done=finished))
+
+    figures = bulk_run.progress()
+    report(figures)
+    return figures
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--container", default="documents")
+    parser.add_argument("--prefix", default="")
+    parser.add_argument("--force", action="store_true", help="Re-index and re-embed unchanged documents too")
+    parser.add_argument("--restart", action="store_true", help="Ignore the checkpoint of a previous run")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING, format="%(asctime)s %(levelname)s %(message)s")
+    figures = run(args.container, args.prefix, args.force, args.restart,
+                  report=lambda figures: print(f"{datetime.utcnow():%H:%M:%S} {describe(figures)}", flush=True))
+    if figures["failed"]:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,4 @@
+"""
+Offline benchmarks for the Python functions. Run from functions-python, e.g.
+python -m benchmarks.bench_client_pool
+"""
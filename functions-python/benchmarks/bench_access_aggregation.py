@@ -0,0 +1,76 @@
+"""
+Events per second of the vectorised access aggregation versus a per-event
+Python loop, over a synthetic event log with Zipf-distributed document
+popularity, plus a check that both produce the same scores.
+
+    python -m benchmarks.bench_access_aggregation --events 2000000 --documents 50000
+"""
+import argparse
+import math
+import time
+
+import numpy as np
+
+from shared_code.access_stats import AccessStats
+
+
+def synthetic_events(events, documents, days, seed=0):
+    rng = np.random.default_rng(seed)
+    ranks = (rng.zipf(1.2, events) - 1) % documents
+    names = np.char.add("doc-", ranks.astype(str))
+    now = time.time()
+    times = now - rng.uniform(0, days * 86400, events)
+    return names, times, now
+
+
+def loop_aggregate(names, times, now, half_life_days):
+    """The straightforward per-event version"""
+    decay_rate = math.log(2) / (half_life_days * 86400)
+    stats = {}
+    for name, when in zip(names, times.tolist()):
+        count, score, last = stats.get(name, (0, 0.0, 0.0))
+        stats[name] = (count + 1, score + math.exp(-decay_rate * max(now - when, 0)), max(last, when))
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--events", type=int, default=2000000)
+    parser.add_argument("--documents", type=int, default=50000)
+    parser.add_argument("--days", type=float, default=30)
+    parser.add_argument("--batches", type=int, default=4, help="Runs the events are split over")
+    parser.add_argument("--half-life-days", type=float, default=7)
+    args = parser.parse_args()
+
+    names, times, now = synthetic_events(args.events, args.documents, args.days)
+    print(f"{args.events} events over {len(np.unique(names))} documents")
+    # Events arrive as parsed JSON, i.e. Python strings
+    names = names.tolist()
+
+    start = time.perf_counter()
+    expected = loop_aggregate(names, times, now, args.half_life_days)
+    loop_seconds = time.perf_counter() - start
+    print(f"loop       {args.events / loop_seconds:12.0f} events/s  {loop_seconds * 1000:9.1f}ms")
+
+    stats = AccessStats(args.half_life_days)
+    start = time.perf_counter()
+    size = -(-args.events // args.batches)
+    for i in range(0, args.events, size):
+        stats.add_events(names[i:i + size], times[i:i + size], now=now)
+    vector_seconds = time.perf_counter() - start
+    print(f"vectorised {args.events / vector_seconds:12.0f} events/s  {vector_seconds * 1000:9.1f}ms  "
+          f"({loop_seconds / vector_seconds:.1f}x, {args.batches} batches)")
+
+    start = time.perf_counter()
+    restored = AccessStats.from_bytes(stats.to_bytes(), args.half_life_days)
+    print(f"state      {len(stats.to_bytes()) / 1024:9.0f}KB saved and loaded in {(time.perf_counter() - start) * 1000:.1f}ms")
+
+    scores = dict(zip(restored.names.tolist(), restored.decayed_scores(now).tolist()))
+    worst = max(abs(scores[name] - score) / max(score, 1e-9) for name, (_, score, _) in expected.items())
+    counts_match = all(int(count) == expected[name][0] for name, count in zip(restored.names.tolist(), restored.counts))
+    print(f"max relative score difference {worst:.2e}, counts match: {counts_match}")
+    print("top documents:", ", ".join(f"{name} ({score:.1f})" for name, score, _ in restored.top(5, now)))
+
+
+if __name__ == "__main__":
+    main()
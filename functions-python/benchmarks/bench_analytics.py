@@ -0,0 +1,144 @@
+"""
+Report latency over the raw per-event tracking blobs versus the compacted
+Parquet partitions. Seeds the stub's metadata container with one blob per
+query and access event spread over --days days, answers the three reports by
+listing and downloading every blob, answers them through shared_code.analytics
+before and after compacting the events, and checks every answer gives the
+same rows.
+
+    python -m benchmarks.bench_analytics --queries 10000 --accesses 10000 --days 2
+"""
+import argparse
+import json
+import logging
+import os
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from benchmarks.bench_tier_mover import RequestCounter
+from benchmarks.stub_servers import StubAzureServer
+from shared_code import access_stats, analytics, clients, telemetry
+
+CONTAINER = "metadata"
+
+
+def seed(server, queries, accesses, days, documents, users):
+    """Per-event blobs as the original track_query and track_document_access wrote them"""
+    rng = random.Random(7)
+    now = time.time()
+    blobs = {}
+    contents = {}
+    for i in range(queries + accesses):
+        # Sealed hours only: the newest events are an hour old
+        when = now - 3600 - rng.random() * (days * 86400 - 7200)
+        stamp = datetime.utcfromtimestamp(when)
+        if i < queries:
+            found = rng.sample(documents, rng.choice([0, 0, 1, 2, 3]))
+            record = {"query": f"question {rng.randrange(50)}", "user_id": rng.choice(users),
+                      "timestamp": stamp.isoformat(), "documents_found": len(found), "document_names": found}
+            name = f"{telemetry.QUERY_STREAM}{record['user_id']}_{i}.json"
+        else:
+            record = {"filename": rng.choice(documents), "access_type": "view",
+                      "access_time": stamp.isoformat(), "access_count": 1}
+            name = f"{telemetry.ACCESS_STREAM}{record['filename']}_{i}.json"
+        blobs[name] = (int(when), "Hot")
+        contents[(CONTAINER, name)] = json.dumps(record).encode("utf-8")
+    with server._lock:
+        server.containers[CONTAINER] = blobs
+        server.contents.update(contents)
+
+
+def raw_reports(limit):
+    """The three reports from a full listing and download of the event blobs"""
+    container_client = clients.get_blob_service_client().get_container_client(CONTAINER)
+    names = [blob.name for blob in container_client.list_blobs()]
+    with ThreadPoolExecutor(analytics.analytics_settings()[1]) as pool:
+        records = list(pool.map(lambda name: (name, json.loads(container_client.download_blob(name).readall())), names))
+
+    documents, users, empty = {}, {}, {}
+    for name, record in records:
+        if name.startswith(telemetry.ACCESS_STREAM):
+            documents[record["filename"]] = documents.get(record["filename"], 0) + record["access_count"]
+            continue
+        users[record["user_id"]] = users.get(record["user_id"], 0) + 1
+        for document in record["document_names"]:
+            documents[document] = documents.get(document, 0) + 1
+        if record["documents_found"] == 0:
+            empty[record["query"]] = empty.get(record["query"], 0) + 1
+
+    order = lambda item: (-item[1], item[0])
+    return {
+        "top_documents": sorted(documents.items(), key=order)[:limit],
+        "queries_per_user": sorted(users.items(), key=order)[:limit],
+        "zero_result_queries": sorted(empty.items(), key=order)[:limit]
+    }
+
+
+def run(args, server, counter):
+    documents = [f"doc{i:04d}.pdf" for i in range(args.documents)]
+    users = [f"user{i:03d}" for i in range(args.users)]
+    seed(server, args.queries, args.accesses, args.days, documents, users)
+    events = args.queries + args.accesses
+
+    counter.count = 0
+    start = time.perf_counter()
+    expected = raw_reports(args.limit)
+    raw_seconds = time.perf_counter() - start
+    print(f"raw scan     {raw_seconds * 1000:9.0f}ms  {counter.count:6d} requests for {events} event blobs")
+
+    # Before compaction the reports read the per-event blobs themselves
+    for report, function in analytics.REPORTS.items():
+        counter.count = 0
+        start = time.perf_counter()
+        rows = function(days=args.days + 1, limit=args.limit)
+        status = "matches raw scan" if [tuple(row) for row in rows] == expected[report] else "DIFFERS from raw scan"
+        print(f"{report + ' (raw)':<26} {(time.perf_counter() - start) * 1000:7.0f}ms  {counter.count:6d} requests  {status}")
+
+    # The access statistics have read every event, so every sealed hour may be compacted
+    stats = access_stats.AccessStats()
+    newest = max(modified for modified, _ in server.containers[CONTAINER].values())
+    stats.watermarks = {prefix: {"time": newest + 1, "names": []} for prefix in access_stats.EVENT_PREFIXES}
+    counter.count = 0
+    start = time.perf_counter()
+    result = analytics.compact(stats)
+    print(f"compaction   {(time.perf_counter() - start) * 1000:9.0f}ms  {counter.count:6d} requests, {result}")
+
+    total = 0
+    for report, function in analytics.REPORTS.items():
+        counter.count = 0
+        start = time.perf_counter()
+        rows = function(days=args.days + 1, limit=args.limit)
+        elapsed = time.perf_counter() - start
+        total += elapsed
+        status = "matches raw scan" if [tuple(row) for row in rows] == expected[report] else "DIFFERS from raw scan"
+        print(f"{report:<26} {elapsed * 1000:7.0f}ms  {counter.count:6d} requests  {status}")
+    print(f"compacted reports are {raw_seconds * 3 / total:.1f}x faster than three raw scans")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--queries", type=int, default=5000)
+    parser.add_argument("--accesses", type=int, default=5000)
+    parser.add_argument("--days", type=int, default=7)
+    parser.add_argument("--documents", type=int, default=200)
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--limit", type=int, default=10)
+    parser.add_argument("--latency-ms", type=float, default=5)
+    args = parser.parse_args()
+
+    counter = RequestCounter()
+    http_logger = logging.getLogger("azure.core.pipeline.policies.http_logging_policy")
+    http_logger.setLevel(logging.INFO)
+    http_logger.addHandler(counter)
+    http_logger.propagate = False
+
+    with StubAzureServer(latency_ms=args.latency_ms) as server:
+        os.environ.update(server.environment())
+        clients.reset_clients()
+        run(args, server, counter)
+
+
+if __name__ == "__main__":
+    main()
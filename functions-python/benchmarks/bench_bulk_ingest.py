@@ -0,0 +1,100 @@
+"""
+Bulk ingestion against per-blob triggers. A mixed corpus of text, PDF and DOCX
+blobs is seeded into the stub's documents container and ingested twice: once
+through DocumentUploadProcessor.main per blob, --trigger-concurrency at a time
+as the blob trigger runs them, and once by a bulk run over the container.
+Reports documents per second, requests per document and `upload_documents`
+calls for each.
+
+    python -m benchmarks.bench_bulk_ingest --documents 300 --latency-ms 10
+"""
+import argparse
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import azure.functions as func
+
+import DocumentUploadProcessor
+from DocumentUploadProcessor import bulk
+from benchmarks.corpus import make_docx, make_pdf, make_text
+from benchmarks.stub_servers import StubAzureServer
+from shared_code import clients, telemetry
+
+
+def make_corpus(documents):
+    """{name: bytes}, a third each of text, PDF and DOCX"""
+    corpus = {}
+    for i in range(documents):
+        kind = ("txt", "pdf", "docx")[i % 3]
+        if kind == "txt":
+            data = make_text(40, seed=i)
+        elif kind == "pdf":
+            data = make_pdf(4, seed=i)
+        else:
+            data = make_docx(40, seed=i)
+        corpus[f"bulk/doc{i:05d}.{kind}"] = data
+    return corpus
+
+
+def seed(corpus):
+    container_client = clients.get_blob_service_client().get_container_client("documents")
+    for name, data in corpus.items():
+        container_client.upload_blob(name, data, overwrite=True)
+
+
+def run_triggers(corpus, concurrency):
+    def trigger(item):
+        name, data = item
+        DocumentUploadProcessor.main(func.blob.InputStream(data=data, name=f"documents/{name}", length=len(data)), name)
+
+    with ThreadPoolExecutor(concurrency) as pool:
+        list(pool.map(trigger, corpus.items()))
+
+
+def report(label, documents, wall, requests, uploads):
+    print(f"{label:<8} {documents / wall:7.1f} docs/s  {wall:7.2f}s  {requests / documents:5.1f} requests per document  "
+          f"{uploads:5d} upload_documents calls")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--documents", type=int, default=300)
+    parser.add_argument("--latency-ms", type=float, default=10, help="Stub latency per request")
+    parser.add_argument("--trigger-concurrency", type=int, default=8, help="Blobs the trigger processes at once")
+    args = parser.parse_args()
+
+    with StubAzureServer(latency_ms=args.latency_ms) as server:
+        for container in ("documents", "processed", "metadata"):
+            server.add_blobs(container, [])
+        os.environ.update(server.environment())
+        os.environ.update({
+            "ANSWER_CACHE_BACKEND": "none", "RETRIEVAL_CACHE_BACKEND": "none", "LOCAL_SEARCH_MODE": "off",
+            "OPENAI_EMBEDDING_DEPLOYMENT": "embeddings", "METRICS_LOG_INTERVAL_SECONDS": "3600",
+            "BULK_PROGRESS_SECONDS": "5"
+        })
+        clients.reset_clients()
+
+        corpus = make_corpus(args.documents)
+        seed(corpus)
+        print(f"{len(corpus)} documents, {sum(map(len, corpus.values())) / 1024 / 1024:.1f}MB, "
+              f"stub latency {args.latency_ms:.0f}ms")
+
+        server.reset_counters()
+        start = time.perf_counter()
+        run_triggers(corpus, args.trigger_concurrency)
+        telemetry.flush()
+        report("trigger", len(corpus), time.perf_counter() - start, server.request_count, server.index_uploads)
+
+        server.reset_counters()
+        start = time.perf_counter()
+        figures = bulk.run("documents", "bulk/", force=True, restart=True,
+                           report=lambda figures: print(f"         {bulk.describe(figures)}"))
+        telemetry.flush()
+        report("bulk", len(corpus), time.perf_counter() - start, server.request_count, server.index_uploads)
+        if figures["failed"]:
+            raise SystemExit(f"{figures['failed']} documents failed")
+
+
+if __name__ == "__main__":
+    main()
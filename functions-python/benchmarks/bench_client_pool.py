@@ -0,0 +1,86 @@
+"""
+Per-call latency of a fresh client per invocation versus the pooled client registry.
+
+Runs against the local stub server by default, or against Azurite with --azurite:
+
+    python -m benchmarks.bench_client_pool --calls 200
+    python -m benchmarks.bench_client_pool --azurite "UseDevelopmentStorage=true"
+"""
+import argparse
+import os
+import statistics
+import time
+
+from azure.storage.blob import BlobServiceClient
+
+from benchmarks.stub_servers import StubAzureServer
+from shared_code import clients
+
+
+def upload_with_new_client(connection_string, index):
+    blob_service_client = BlobServiceClient.from_connection_string(connection_string)
+    container_client = blob_service_client.get_container_client("metadata")
+    container_client.get_blob_client(f"bench/new_{index}.json").upload_blob(b"{}", overwrite=True)
+
+
+def upload_with_pooled_client(connection_string, index):
+    blob_service_client = clients.get_blob_service_client()
+    container_client = blob_service_client.get_container_client("metadata")
+    container_client.get_blob_client(f"bench/pooled_{index}.json").upload_blob(b"{}", overwrite=True)
+
+
+def measure(label, call, connection_string, calls):
+    timings = []
+    for i in range(calls):
+        start = time.perf_counter()
+        call(connection_string, i)
+        timings.append((time.perf_counter() - start) * 1000)
+
+    timings.sort()
+    p50 = statistics.median(timings)
+    p99 = timings[min(len(timings) - 1, int(len(timings) * 0.99))]
+    print(f"{label:<8} mean={statistics.mean(timings):7.2f}ms p50={p50:7.2f}ms p99={p99:7.2f}ms")
+    return p50
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--calls", type=int, default=200)
+    parser.add_argument("--latency-ms", type=float, default=0)
+    parser.add_argument("--azurite", help="Connection string of a running Azurite instance")
+    args = parser.parse_args()
+
+    server = None
+    if args.azurite:
+        connection_string = args.azurite
+    else:
+        server = StubAzureServer(latency_ms=args.latency_ms).start()
+        connection_string = server.storage_connection_string
+
+    os.environ["STORAGE_CONNECTION_STRING"] = connection_string
+    clients.reset_clients()
+
+    try:
+        # Warm both paths once so import and first-use costs are excluded
+        upload_with_new_client(connection_string, -1)
+        upload_with_pooled_client(connection_string, -1)
+
+        if server:
+            server.reset_counters()
+        new_p50 = measure("new", upload_with_new_client, connection_string, args.calls)
+        if server:
+            print(f"         connections opened: {server.connection_count}")
+            server.reset_counters()
+
+        pooled_p50 = measure("pooled", upload_with_pooled_client, connection_string, args.calls)
+        if server:
+            print(f"         connections opened: {server.connection_count}")
+
+        print(f"p50 latency drop: {new_p50 - pooled_p50:.2f}ms per call ({new_p50 / pooled_p50:.1f}x)")
+    finally:
+        if server:
+            server.stop()
+
+
+if __name__ == "__main__":
+    main()
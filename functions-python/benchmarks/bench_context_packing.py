@@ -0,0 +1,93 @@
+"""
+Prompt size and packing time of the token-budget context builder versus the
+old fixed 2000-character truncation, over a synthetic corpus.
+
+    python -m benchmarks.bench_context_packing --queries 200 --budget 2000
+"""
+import argparse
+import random
+import statistics
+import time
+
+from shared_code import context_packing
+
+WORDS = (
+    "invoice refund shipping warranty contract payment policy customer account "
+    "delivery order return support product feature pricing discount renewal "
+    "security compliance audit report storage archive retention access"
+).split()
+
+BOILERPLATE = "Confidential - for internal use only. Copyright Contoso Ltd. All rights reserved."
+
+
+def legacy_prepare_context(relevant_docs):
+    """prepare_context as it was before token budgeting"""
+    if not relevant_docs:
+        return "No relevant documents found."
+
+    context_parts = []
+    for i, doc in enumerate(relevant_docs, 1):
+        content = doc.get('content', '')
+        filename = doc.get('filename', 'Unknown')
+        if len(content) > 2000:
+            content = content[:2000] + "..."
+        context_parts.append(f"Document {i} ({filename}):\n{content}\n")
+
+    return "\n".join(context_parts)
+
+
+def synthetic_document(rng, paragraphs):
+    parts = [BOILERPLATE]
+    for _ in range(paragraphs):
+        sentences = [" ".join(rng.choice(WORDS) for _ in range(rng.randint(8, 20))).capitalize() + "."
+                     for _ in range(rng.randint(2, 6))]
+        parts.append(" ".join(sentences))
+    parts.append(BOILERPLATE)
+    return "\n\n".join(parts)
+
+
+def synthetic_results(rng, docs_per_query):
+    return [
+        {
+            "filename": f"doc{rng.randint(0, 10000)}.pdf",
+            "content": synthetic_document(rng, rng.randint(5, 120)),
+            "score": rng.uniform(1, 10)
+        }
+        for _ in range(docs_per_query)
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--docs", type=int, default=5)
+    parser.add_argument("--budget", type=int, default=2000)
+    parser.add_argument("--seed", type=int, default=7)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    workload = [(" ".join(rng.sample(WORDS, 4)), synthetic_results(rng, args.docs)) for _ in range(args.queries)]
+
+    legacy_tokens, legacy_ms, packed_tokens, packed_ms, duplicates = [], [], [], [], 0
+    for query, docs in workload:
+        start = time.perf_counter()
+        context = legacy_prepare_context(docs)
+        legacy_ms.append((time.perf_counter() - start) * 1000)
+        legacy_tokens.append(context_packing.count_tokens(context))
+
+        start = time.perf_counter()
+        context, stats = context_packing.pack_context(query, docs, token_budget=args.budget)
+        packed_ms.append((time.perf_counter() - start) * 1000)
+        packed_tokens.append(context_packing.count_tokens(context))
+        duplicates += stats["duplicates_removed"]
+
+    print(f"legacy  tokens mean={statistics.mean(legacy_tokens):8.1f} max={max(legacy_tokens):6d} "
+          f"time p50={statistics.median(legacy_ms):7.3f}ms")
+    print(f"packed  tokens mean={statistics.mean(packed_tokens):8.1f} max={max(packed_tokens):6d} "
+          f"time p50={statistics.median(packed_ms):7.3f}ms")
+    print(f"prompt tokens saved: {1 - sum(packed_tokens) / sum(legacy_tokens):.1%}, "
+          f"duplicate passages removed: {duplicates}")
+
+
+if __name__ == "__main__":
+    main()
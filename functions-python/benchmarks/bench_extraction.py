@@ -0,0 +1,86 @@
+"""
+Pages per second and peak RSS of the page-parallel PDF/DOCX extraction versus
+the original string-concatenation loops, over generated documents.
+
+    python -m benchmarks.bench_extraction --pages 300 --paragraphs 5000
+"""
+import argparse
+import io
+import multiprocessing
+import resource
+import time
+
+from benchmarks.corpus import make_docx, make_pdf
+from shared_code import extraction
+
+
+def legacy_pdf_text(file_content):
+    import PyPDF2
+    pdf_reader = PyPDF2.PdfReader(io.BytesIO(file_content))
+    text = ""
+    for page in pdf_reader.pages:
+        text += page.extract_text() + "\n"
+    return text.strip()
+
+
+def legacy_docx_text(file_content):
+    import docx
+    doc = docx.Document(io.BytesIO(file_content))
+    text = ""
+    for paragraph in doc.paragraphs:
+        text += paragraph.text + "\n"
+    return text.strip()
+
+
+def pdf_text(file_content):
+    return extraction.join_text(extraction.iter_pdf_pages(file_content))
+
+
+def docx_text(file_content):
+    return extraction.join_text(extraction.iter_docx_paragraphs(file_content))
+
+
+def _measure(function, file_content, queue):
+    start = time.perf_counter()
+    text = function(file_content)
+    elapsed = time.perf_counter() - start
+    peak_self = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    peak_children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    queue.put((elapsed, len(text), peak_self, peak_children))
+
+
+def measure(function, file_content):
+    """Run one extraction in a fresh process so peak RSS is not shared between runs"""
+    queue = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_measure, args=(function, file_content, queue))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+
+def report(label, units, unit_name, result):
+    elapsed, characters, peak_self, peak_children = result
+    print(f"{label:<12} {units / elapsed:9.1f} {unit_name}/s  {elapsed * 1000:9.1f}ms  "
+          f"peak RSS {peak_self / 1024:7.1f}MB (+{peak_children / 1024:.1f}MB in workers)  {characters} chars")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--pages", type=int, default=300)
+    parser.add_argument("--paragraphs", type=int, default=5000)
+    args = parser.parse_args()
+
+    pdf = make_pdf(args.pages)
+    print(f"PDF: {args.pages} pages, {len(pdf) / 1024:.0f}KB")
+    report("legacy", args.pages, "pages", measure(legacy_pdf_text, pdf))
+    report("parallel", args.pages, "pages", measure(pdf_text, pdf))
+
+    document = make_docx(args.paragraphs)
+    print(f"DOCX: {args.paragraphs} paragraphs, {len(document) / 1024:.0f}KB")
+    report("legacy", args.paragraphs, "paras", measure(legacy_docx_text, document))
+    report("streaming", args.paragraphs, "paras", measure(docx_text, document))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+"""
+Peak-memory regression check for DocumentUploadProcessor ingestion.
+
+Pushes a large text upload through DocumentUploadProcessor.main against the
+stub server and compares the Python heap peak with the old read-everything
+path. Exits non-zero when the streaming path goes over --max-peak-mb, so it can
+gate changes to the ingestion code.
+
+    python -m benchmarks.bench_ingestion_memory --size-mb 64 --max-peak-mb 40
+"""
+import argparse
+import os
+import sys
+import tracemalloc
+
+import azure.functions as func
+
+import DocumentUploadProcessor
+from benchmarks.corpus import make_text
+from benchmarks.stub_servers import StubAzureServer
+from shared_code import clients
+
+
+def make_upload(size_mb):
+    paragraph_block = make_text(200)
+    repeat = size_mb * 1024 * 1024 // len(paragraph_block) + 1
+    return (paragraph_block * repeat)[:size_mb * 1024 * 1024]
+
+
+def legacy_ingest(blob, name):
+    """The old path: whole file read, decoded and re-encoded in memory"""
+    file_content = blob.read()
+    content = file_content.decode('utf-8')
+    blob_client = clients.get_blob_service_client().get_blob_client("processed", f"{name}.txt")
+    blob_client.upload_blob(content.encode('utf-8'), overwrite=True)
+
+
+def peak_mb(function, data, name):
+    blob = func.blob.InputStream(data=data, name=f"documents/{name}", length=len(data))
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    before = tracemalloc.get_traced_memory()[0]
+    function(blob, name)
+    peak = tracemalloc.get_traced_memory()[1] - before
+    tracemalloc.stop()
+    return peak / (1024 * 1024)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size-mb", type=int, default=64)
+    parser.add_argument("--spool-threshold-mb", type=int, default=4)
+    parser.add_argument("--max-peak-mb", type=float, default=40)
+    args = parser.parse_args()
+
+    data = make_upload(args.size_mb)
+
+    with StubAzureServer() as server:
+        os.environ.update(server.environment())
+        os.environ["INGEST_SPOOL_THRESHOLD_MB"] = str(args.spool_threshold_mb)
+        os.environ["ANSWER_CACHE_BACKEND"] = "none"
+        clients.reset_clients()
+
+        legacy = peak_mb(legacy_ingest, data, "legacy.txt")
+        streaming = peak_mb(lambda blob, name: DocumentUploadProcessor.main(blob, name), data, "streaming.txt")
+
+    print(f"upload: {args.size_mb}MB text, spool threshold {args.spool_threshold_mb}MB")
+    print(f"legacy    peak heap {legacy:8.1f}MB")
+    print(f"streaming peak heap {streaming:8.1f}MB (limit {args.max_peak_mb}MB)")
+
+    if streaming > args.max_peak_mb:
+        print("FAIL: streaming ingestion peak memory regressed")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
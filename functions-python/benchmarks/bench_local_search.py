@@ -0,0 +1,160 @@
+"""
+Recall and latency of the embedded local search index over a synthetic
+corpus. Documents are indexed through the same journal the upload function
+writes (compacting into snapshots along the way), then a fresh reader maps the
+snapshot and answers queries built from words of a random chunk. Keyword
+results are checked against an exhaustive BM25 scan and vector results against
+an exhaustive cosine scan; a few documents are then re-indexed to time how
+soon a reader sees them.
+
+    python -m benchmarks.bench_local_search --documents 500 --chunks 10 --queries 300
+"""
+import argparse
+import math
+import os
+import random
+import statistics
+import tempfile
+import time
+from collections import Counter
+
+import numpy as np
+
+from shared_code import local_search
+
+
+def make_corpus(rng, documents, chunks, vocabulary, dimensions, words_per_chunk=250):
+    """{filename: [(content, vector)]}: Zipf-distributed words plus topic words, vectors near a topic centre"""
+    words = [f"w{i}" for i in range(vocabulary)]
+    weights = [1 / (rank + 1) for rank in range(vocabulary)]
+    topics = [(rng.sample(words[vocabulary // 10:], 30), np.random.default_rng(t).normal(size=dimensions))
+              for t in range(max(1, documents // 10))]
+    noise = np.random.default_rng(1)
+
+    corpus = {}
+    for d in range(documents):
+        topic_words, centre = topics[d % len(topics)]
+        corpus[f"doc{d:05d}.txt"] = [
+            (" ".join(rng.choices(words, weights=weights, k=words_per_chunk - 20) + rng.choices(topic_words, k=20)),
+             (centre + noise.normal(scale=0.8, size=dimensions)).astype(np.float32))
+            for _ in range(chunks)
+        ]
+    return corpus
+
+
+def exhaustive_bm25(query, chunk_terms):
+    """BM25 score of every matching chunk position, with the formula the index uses, scanning every chunk"""
+    count = len(chunk_terms)
+    average = sum(sum(terms.values()) for terms in chunk_terms) / count
+    scores = Counter()
+    for term in set(local_search.tokenize(query)):
+        matches = [(i, terms[term]) for i, terms in enumerate(chunk_terms) if term in terms]
+        if not matches:
+            continue
+        idf = math.log(1 + (count - len(matches) + 0.5) / (len(matches) + 0.5))
+        for i, tf in matches:
+            length = sum(chunk_terms[i].values())
+            norm = local_search.BM25_K1 * (1 - local_search.BM25_B + local_search.BM25_B * length / average)
+            scores[i] += idf * tf * (local_search.BM25_K1 + 1) / (tf + norm)
+    return scores
+
+
+def percentiles(timings):
+    timings = sorted(timings)
+    return (statistics.median(timings), timings[int(len(timings) * 0.95)], timings[int(len(timings) * 0.99)])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--documents", type=int, default=500)
+    parser.add_argument("--chunks", type=int, default=10, help="Chunks per document")
+    parser.add_argument("--vocabulary", type=int, default=20000)
+    parser.add_argument("--dimensions", type=int, default=256)
+    parser.add_argument("--queries", type=int, default=300)
+    parser.add_argument("--top", type=int, default=5)
+    parser.add_argument("--journal-mb", type=float, help="LOCAL_SEARCH_JOURNAL_BYTES in MiB")
+    args = parser.parse_args()
+
+    rng = random.Random(5)
+    corpus = make_corpus(rng, args.documents, args.chunks, args.vocabulary, args.dimensions)
+    os.environ["LOCAL_SEARCH_DIR"] = tempfile.mkdtemp(prefix="local_search_bench_")
+    if args.journal_mb:
+        os.environ["LOCAL_SEARCH_JOURNAL_BYTES"] = str(int(args.journal_mb * 1024 * 1024))
+
+    start = time.perf_counter()
+    for filename, chunks in corpus.items():
+        local_search.remove_document(filename)
+        local_search.add_chunks(filename, "2024-01-01T00:00:00", [
+            {"chunk_index": i, "content": content, "content_vector": vector} for i, (content, vector) in enumerate(chunks)
+        ])
+    elapsed = time.perf_counter() - start
+    directory = os.environ["LOCAL_SEARCH_DIR"]
+    total = args.documents * args.chunks
+    print(f"indexed      {total} chunks in {elapsed:.1f}s ({total / elapsed:.0f} chunks/s), "
+          f"generation {local_search.current_generation(directory)}")
+
+    start = time.perf_counter()
+    index = local_search.LocalIndex(directory)
+    index.refresh()
+    print(f"cold load    {(time.perf_counter() - start) * 1000:.1f}ms "
+          f"({index.snapshot.size} chunks mapped, {sum(c is not None for c in index.chunks)} replayed from the journal)")
+
+    # Positions in the same order the index returns them, for the exhaustive scans
+    live = list(index.live_chunks())
+    position = {(filename, chunk_index): i for i, (filename, _, chunk_index, _, _) in enumerate(live)}
+    chunk_terms = [Counter(local_search.tokenize(content)) for _, _, _, content, _ in live]
+    vectors = np.array([vector / np.linalg.norm(vector) for _, _, _, _, vector in live], dtype=np.float32)
+
+    keyword_timings, hybrid_timings = [], []
+    keyword_recall = vector_recall = source_hits = 0
+    noise = np.random.default_rng(2)
+    for _ in range(args.queries):
+        source = rng.randrange(len(live))
+        terms = sorted(chunk_terms[source], key=lambda term: int(term[1:]))[-4:]
+        query = " ".join(rng.sample(terms, 3))
+        query_vector = live[source][4] + noise.normal(scale=0.3, size=args.dimensions)
+
+        start = time.perf_counter()
+        results = index.search(query, top=args.top)
+        keyword_timings.append((time.perf_counter() - start) * 1000)
+        found = [position[(doc["filename"], doc["chunk_index"])] for doc in results]
+        # Chunks tied with the last expected one count as expected, whichever the index returns
+        scores = exhaustive_bm25(query, chunk_terms)
+        expected = scores.most_common(args.top)
+        cutoff = expected[-1][1] * (1 - 1e-5) if expected else 0
+        keyword_recall += sum(scores[i] >= cutoff for i in found[:len(expected)]) / max(len(expected), 1)
+        source_hits += source in found
+
+        start = time.perf_counter()
+        index.search(query, query_vector, top=args.top)
+        hybrid_timings.append((time.perf_counter() - start) * 1000)
+        expected = np.argsort(-(vectors @ (query_vector / np.linalg.norm(query_vector))))[:args.top]
+        found = [position[(doc["filename"], doc["chunk_index"])]
+                 for doc in [index._result(i, s) for i, s in index._vector_ranking(query_vector, args.top)]]
+        vector_recall += len(set(found) & set(expected.tolist())) / args.top
+
+    for label, timings in (("keyword", keyword_timings), ("hybrid", hybrid_timings)):
+        p50, p95, p99 = percentiles(timings)
+        print(f"{label:<12} p50={p50:.3f}ms p95={p95:.3f}ms p99={p99:.3f}ms")
+    print(f"recall@{args.top}     keyword {keyword_recall / args.queries:.3f} vs exhaustive BM25, "
+          f"vector {vector_recall / args.queries:.3f} vs exhaustive cosine, "
+          f"source chunk found {source_hits / args.queries:.1%}")
+
+    # Re-index a few documents with a new word and time until a reader finds them
+    updated = list(corpus)[:5]
+    for filename in updated:
+        local_search.remove_document(filename)
+        local_search.add_chunks(filename, "2024-06-01T00:00:00", [{"chunk_index": 0, "content": "zebracorn " * 5}])
+    start = time.perf_counter()
+    index.refresh()
+    refreshed = (time.perf_counter() - start) * 1000
+    results = index.search("zebracorn", top=10)
+    status = "visible" if sorted(doc["filename"] for doc in results) == updated else "NOT visible"
+    gone = index.search(corpus[updated[0]][0][0][:200], top=args.top)
+    stale = sum(doc["filename"] in updated and doc["chunk_index"] > 0 for doc in gone)
+    print(f"update       refresh {refreshed:.2f}ms, {len(updated)} re-indexed documents {status}, "
+          f"{stale} stale chunks returned")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+"""
+Throughput and CPU use of the pooled, preprocessed OCR path versus the original
+full-resolution image_to_string call, over generated multi-frame TIFF scans.
+Two tenants submit at once to show one large batch does not starve the other.
+Requires the tesseract binary.
+
+    python -m benchmarks.bench_ocr --documents 4 --pages 4 --dpi 600
+"""
+import argparse
+import io
+import os
+import resource
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmarks.corpus import make_scan
+from shared_code import ocr
+
+
+def cpu_seconds():
+    """User plus system CPU of this process and its finished children"""
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime
+
+
+def legacy_ocr(document, tenant):
+    """The original extract_image_text: first frame only, full resolution, request thread"""
+    from PIL import Image
+    import pytesseract
+    return pytesseract.image_to_string(Image.open(io.BytesIO(document))).strip()
+
+
+def pooled_ocr(document, tenant):
+    return "\n".join(ocr.iter_image_text(io.BytesIO(document), tenant))
+
+
+def run(label, function, jobs, threads, pages):
+    start_cpu, start = cpu_seconds(), time.perf_counter()
+    finished = {}
+
+    def timed(job):
+        tenant, document = job
+        function(document, tenant)
+        finished.setdefault(tenant, []).append(time.perf_counter() - start)
+
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        list(pool.map(timed, jobs))
+    wall = time.perf_counter() - start
+    cpu = cpu_seconds() - start_cpu
+
+    print(f"{label:<8} {pages / wall:7.2f} pages/s  wall {wall:7.2f}s  "
+          f"CPU {cpu:7.2f}s ({cpu / wall / (os.cpu_count() or 1):.0%} of {os.cpu_count()} cores)")
+    for tenant, times in sorted(finished.items()):
+        print(f"         tenant {tenant:<6} last document done at {max(times):6.2f}s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--documents", type=int, default=4, help="Documents submitted by the large tenant")
+    parser.add_argument("--pages", type=int, default=4, help="Frames per TIFF")
+    parser.add_argument("--dpi", type=int, default=600)
+    parser.add_argument("--threads", type=int, default=4, help="Concurrent function invocations")
+    args = parser.parse_args()
+
+    document = make_scan(args.pages, dpi=args.dpi)
+    small = make_scan(1, dpi=args.dpi, seed=1)
+    print(f"TIFF: {args.pages} frames at {args.dpi} DPI, {len(document) / 1024:.0f}KB")
+
+    # The large tenant queues first; the small tenant's single page arrives behind it
+    jobs = [("bulk", document)] * args.documents + [("small", small)]
+    pages = args.documents * args.pages + 1
+
+    # The legacy path only ever read the first frame of each TIFF
+    run("legacy", legacy_ocr, jobs, args.threads, args.documents + 1)
+    run("pooled", pooled_ocr, jobs, args.threads, pages)
+    ocr.reset_pool()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+"""
+A burst of partly identical questions against a rate-limited stub OpenAI
+deployment: the original handler, which sends every completion and leaves 429s
+to the SDK's two retries, versus the handler with request coalescing and the
+client-side rate limiter. Reports answered and failed requests, completions
+sent upstream, 429s received and latency. Caches are off so only coalescing
+and queueing are measured.
+
+    python -m benchmarks.bench_rate_limit --requests 150 --distinct 30 --limit 10 --window 2
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import statistics
+import time
+
+import azure.functions as func
+
+import AIQueryProcessor
+from benchmarks.stub_servers import StubAzureServer
+from shared_code import clients, metrics, telemetry
+
+FAILED = "Sorry, I encountered an error"
+
+
+def questions(requests, distinct, seed=3):
+    """Zipf-popular questions, typed with varying case and punctuation"""
+    rng = random.Random(seed)
+    weights = [1 / (rank + 1) for rank in range(distinct)]
+    picks = rng.choices(range(distinct), weights=weights, k=requests)
+    return [rng.choice(["{}", "{}?", "{} ", "{}!"]).format(f"What is the policy on topic {q}")
+            .replace("What", rng.choice(["What", "what"])) for q in picks]
+
+
+async def legacy_handler(query):
+    """The original pipeline: every request searches and calls the SDK, which retries a 429 twice"""
+    start = time.perf_counter()
+    relevant_docs = await AIQueryProcessor.search_documents_async(query)
+    try:
+        client = clients.get_async_openai_client()
+        response = await client.chat.completions.create(**AIQueryProcessor.completion_options(query, relevant_docs))
+        answer = response.choices[0].message.content
+    except Exception as e:
+        answer = f"{FAILED}: {str(e)}"
+    return answer, (time.perf_counter() - start) * 1000
+
+
+async def handler(query, i):
+    start = time.perf_counter()
+    body = json.dumps({"query": query, "user_id": f"user{i}"}).encode("utf-8")
+    response = await AIQueryProcessor.main(func.HttpRequest(method="POST", url="/api/query", body=body))
+    answer = json.loads(response.get_body()).get("response", FAILED)
+    return answer, (time.perf_counter() - start) * 1000
+
+
+async def burst(make_call, queries):
+    start = time.perf_counter()
+    results = await asyncio.gather(*(make_call(query, i) for i, query in enumerate(queries)))
+    wall = time.perf_counter() - start
+    await clients.close_async_clients()
+    return results, wall
+
+
+def report(label, server, results, wall):
+    timings = sorted(ms for _, ms in results)
+    failed = sum(answer.startswith(FAILED) for answer, _ in results)
+    print(f"{label:<10} answered {len(results) - failed:4d}  failed {failed:4d}  completions sent "
+          f"{server.chat_completions:4d}  429s {server.chat_throttled:4d}  p50={statistics.median(timings):7.0f}ms "
+          f"p95={timings[int(len(timings) * 0.95)]:7.0f}ms  wall {wall:5.1f}s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=150)
+    parser.add_argument("--distinct", type=int, default=30)
+    parser.add_argument("--limit", type=int, default=10, help="Completions the stub allows per window")
+    parser.add_argument("--window", type=float, default=2, help="Stub rate window in seconds")
+    parser.add_argument("--latency-ms", type=float, default=20)
+    parser.add_argument("--token-delay-ms", type=float, default=20)
+    args = parser.parse_args()
+
+    queries = questions(args.requests, args.distinct)
+    with StubAzureServer(latency_ms=args.latency_ms, token_delay_ms=args.token_delay_ms,
+                         chat_requests_limit=args.limit, rate_window_seconds=args.window) as server:
+        os.environ.update(server.environment())
+        os.environ["ANSWER_CACHE_BACKEND"] = "none"
+        os.environ["RETRIEVAL_CACHE_BACKEND"] = "none"
+        os.environ["LOCAL_SEARCH_MODE"] = "off"
+        clients.reset_clients()
+
+        results, wall = asyncio.run(burst(lambda query, i: legacy_handler(query), queries))
+        report("original", server, results, wall)
+
+        # The stub's window empties before the next run
+        time.sleep(args.window)
+        server.chat_window.clear()
+        server.chat_completions = server.chat_throttled = 0
+        os.environ["OPENAI_RPM"] = str(args.limit * 60 / args.window)
+        os.environ["OPENAI_RATE_BURST_SECONDS"] = str(args.window)
+        metrics.reset()
+        results, wall = asyncio.run(burst(handler, queries))
+        telemetry.flush()
+        report("coalesced", server, results, wall)
+        print(f"           {metrics.summary()}")
+
+
+if __name__ == "__main__":
+    main()
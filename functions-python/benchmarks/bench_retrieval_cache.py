@@ -0,0 +1,83 @@
+"""
+Query embedding and search latency with and without the retrieval cache.
+Replays a Zipf-distributed stream of queries, some asking for a second page,
+against the stub search and embedding endpoints, once with
+RETRIEVAL_CACHE_BACKEND=none and once with the file cache (the memory backend
+caches embeddings only), then bumps the index generation and checks the next
+search goes back to the index.
+
+    python -m benchmarks.bench_retrieval_cache --requests 500 --distinct 100 --latency-ms 40
+"""
+import argparse
+import asyncio
+import os
+import random
+import tempfile
+import time
+
+from benchmarks.stub_servers import StubAzureServer
+from shared_code import clients, metrics, retrieval_cache
+
+from AIQueryProcessor import embed_query_async, search_documents_async
+
+
+def workload(requests, distinct, skew, seed=11):
+    """(query, skip) pairs with query popularity following a Zipf law"""
+    rng = random.Random(seed)
+    weights = [1 / (rank + 1) ** skew for rank in range(distinct)]
+    queries = rng.choices(range(distinct), weights=weights, k=requests)
+    return [(f"What does the policy say about topic {q}?", rng.choice([0, 0, 0, 5])) for q in queries]
+
+
+async def replay(queries):
+    for query, skip in queries:
+        embedding = await embed_query_async(query)
+        await search_documents_async(query, embedding, top=5, skip=skip)
+    await clients.close_async_clients()
+
+
+def run(label, queries, backend):
+    os.environ["RETRIEVAL_CACHE_BACKEND"] = backend
+    clients.reset_clients()
+    metrics.reset()
+    start = time.perf_counter()
+    asyncio.run(replay(queries))
+    wall = time.perf_counter() - start
+    stages = metrics.snapshot()
+    requests = len(queries)
+    hits = stages.get("search_cached", {}).get("count", 0)
+    print(f"{label:<9} {wall:7.2f}s  {wall / requests * 1000:7.1f}ms per request  search hit rate {hits / requests:.1%}")
+    print(f"          {metrics.summary()}")
+    return wall
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--distinct", type=int, default=100)
+    parser.add_argument("--skew", type=float, default=1.1)
+    parser.add_argument("--latency-ms", type=float, default=40)
+    args = parser.parse_args()
+
+    queries = workload(args.requests, args.distinct, args.skew)
+    with StubAzureServer(latency_ms=args.latency_ms) as server:
+        os.environ.update(server.environment())
+        os.environ["OPENAI_EMBEDDING_DEPLOYMENT"] = "stub-embedding"
+        uncached = run("no cache", queries, "none")
+        with tempfile.TemporaryDirectory() as directory:
+            os.environ["RETRIEVAL_CACHE_FILE"] = os.path.join(directory, "retrieval.sqlite3")
+            cached = run("cache", queries, "file")
+            print(f"cache is {uncached / cached:.1f}x faster")
+
+            # After a reindex the same query must reach the index again
+            retrieval_cache.bump_generation()
+            server.reset_counters()
+            metrics.reset()
+            asyncio.run(replay(queries[:1]))
+            stages = metrics.snapshot()
+            status = "miss as expected" if "search" in stages and "search_cached" not in stages else "STALE HIT"
+            print(f"after bump_generation: {status}, {server.request_count} requests")
+
+
+if __name__ == "__main__":
+    main()
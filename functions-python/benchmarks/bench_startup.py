@@ -0,0 +1,128 @@
+"""
+Cold-start cost of each function: a fresh interpreter per run imports the
+function module, then serves a first and a second request against the stub
+server. "eager" first imports every parser and SDK the modules used to load
+at import time, as the functions did before backends were loaded lazily;
+"lazy" is the functions as they are; "warmup" sets WARMUP_ENABLED and leaves
+--idle-ms between loading and the first request, as a host does between
+loading a function and invoking it. Reports medians over --runs processes.
+
+    python -m benchmarks.bench_startup --runs 5 --idle-ms 300
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+from benchmarks.stub_servers import StubAzureServer
+
+# What DocumentUploadProcessor, AIQueryProcessor and their shared modules imported at load
+EAGER_MODULES = (
+    "PyPDF2", "docx", "PIL.Image", "PIL.ImageOps", "PIL.ImageSequence", "pytesseract", "openai", "httpx",
+    "aiohttp", "azure.search.documents", "azure.search.documents.aio", "azure.search.documents.models",
+    "azure.storage.blob.aio"
+)
+
+CASES = {
+    "upload_txt": ("DocumentUploadProcessor", "txt"),
+    "upload_pdf": ("DocumentUploadProcessor", "pdf"),
+    "query": ("AIQueryProcessor", None),
+    "tracker": ("DocumentAccessTracker", None)
+}
+
+
+def child(case, variant, idle_ms):
+    """Runs in the fresh interpreter: prints import, first and second request milliseconds as JSON"""
+    import importlib
+
+    start = time.perf_counter()
+    if variant == "eager":
+        for name in EAGER_MODULES:
+            importlib.import_module(name)
+    module = importlib.import_module(CASES[case][0])
+    imported = time.perf_counter()
+    if variant == "warmup":
+        time.sleep(idle_ms / 1000)
+
+    request = make_request(case)
+    timings = []
+    for i in range(2):
+        began = time.perf_counter()
+        request(module, i)
+        timings.append((time.perf_counter() - began) * 1000)
+    print(json.dumps({"import_ms": (imported - start) * 1000, "first_ms": timings[0], "second_ms": timings[1]}))
+
+
+def make_request(case):
+    import azure.functions as func
+    from benchmarks.corpus import make_pdf, make_text
+    from shared_code import clients
+
+    if case.startswith("upload"):
+        extension = CASES[case][1]
+        data = make_pdf(3) if extension == "pdf" else make_text(20)
+
+        def upload(module, i):
+            name = f"startup/doc{i}.{extension}"
+            module.main(func.blob.InputStream(data=data, name=f"documents/{name}", length=len(data)), name)
+        return upload
+
+    if case == "query":
+        def query(module, i):
+            async def ask():
+                body = json.dumps({"query": f"What is in document {i}?"}).encode("utf-8")
+                response = await module.main(func.HttpRequest(method="POST", url="/api/query", body=body))
+                await clients.close_async_clients()
+                return response
+            if asyncio.run(ask()).status_code != 200:
+                raise RuntimeError("Query failed")
+        return query
+
+    return lambda module, i: module.main(None)
+
+
+def run_child(case, variant, idle_ms, environment):
+    output = subprocess.run(
+        [sys.executable, "-m", "benchmarks.bench_startup", "--child", case, "--variant", variant,
+         "--idle-ms", str(idle_ms)],
+        env=environment, capture_output=True, text=True, check=True
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--idle-ms", type=float, default=300, help="Gap between loading and the first request")
+    parser.add_argument("--cases", default=",".join(CASES))
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    parser.add_argument("--variant", default="lazy", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(args.child, args.variant, args.idle_ms)
+        return
+
+    with StubAzureServer() as server:
+        for container in ("documents", "hot-documents", "archive", "processed", "metadata"):
+            server.add_blobs(container, [])
+        environment = dict(os.environ, **server.environment(), ANSWER_CACHE_BACKEND="none",
+                           RETRIEVAL_CACHE_BACKEND="none", LOCAL_SEARCH_MODE="off")
+        for case in args.cases.split(","):
+            for variant in ("eager", "lazy", "warmup"):
+                runs = [run_child(case, variant, args.idle_ms, dict(environment, WARMUP_ENABLED=str(variant == "warmup")))
+                        for _ in range(args.runs)]
+                figures = {key: statistics.median(run[key] for run in runs) for key in runs[0]}
+                idle = args.idle_ms if variant == "warmup" else 0
+                print(f"{case:<11} {variant:<7} import {figures['import_ms']:6.0f}ms  first request "
+                      f"{figures['first_ms']:6.0f}ms  second {figures['second_ms']:5.0f}ms  "
+                      f"load to first response {figures['import_ms'] + idle + figures['first_ms']:6.0f}ms"
+                      + (f" (incl. {idle:.0f}ms idle)" if idle else ""))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+"""
+Throughput and loss of query tracking: the original one-blob-per-event upload
+versus the buffered telemetry writer. Every event carries a unique id and is
+read back afterwards, so events lost to same-second name collisions, failed
+flushes or an exit before the last flush show up as missing ids. The exit
+case runs the writer in a child process that returns without flushing.
+
+    python -m benchmarks.bench_telemetry --events 5000 --threads 8
+    python -m benchmarks.bench_telemetry --events 20000 --threads 16 --azurite
+"""
+import argparse
+import json
+import logging
+import os
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from benchmarks.bench_tier_mover import AZURITE_CONNECTION_STRING, RequestCounter
+from benchmarks.stub_servers import StubAzureServer
+from shared_code import clients, telemetry
+
+CONTAINER = "metadata"
+
+
+def event(i, user_id):
+    return {"id": i, "query": f"What does document {i % 10} say?", "user_id": user_id,
+            "timestamp": datetime.utcnow().isoformat(), "documents_found": 1, "document_names": ["stub.pdf"]}
+
+
+def legacy_track(i, user_id):
+    """The original track_query: container check, then one blob named to the second"""
+    blob_service_client = clients.get_blob_service_client()
+    container_client = blob_service_client.get_container_client(CONTAINER)
+    try:
+        container_client.get_container_properties()
+    except Exception:
+        blob_service_client.create_container(CONTAINER)
+    blob_name = f"legacy/{user_id}_{datetime.utcnow().strftime('%Y%m%d_%H%M%S')}.json"
+    container_client.get_blob_client(blob_name).upload_blob(json.dumps(event(i, user_id)).encode("utf-8"), overwrite=True)
+
+
+def read_ids(prefix):
+    """Ids of the events stored under prefix, one per line or one per blob"""
+    container_client = clients.get_blob_service_client().get_container_client(CONTAINER)
+    ids = []
+    for blob in container_client.list_blobs(name_starts_with=prefix):
+        data = container_client.download_blob(blob.name).readall()
+        ids.extend(json.loads(line)["id"] for line in data.splitlines() if line)
+    return ids
+
+
+def report(label, written, wall, requests, ids):
+    missing = written - len(set(ids))
+    print(f"{label:<9} {written / wall:9.0f} events/s  {wall:7.2f}s  {requests:6d} requests "
+          f"({requests / max(written, 1):.3f} per event)  lost {missing} ({missing / max(written, 1):.1%})"
+          f"  duplicated {len(ids) - len(set(ids))}")
+
+
+def run(args, counter):
+    users = [f"user{u}" for u in range(args.users)]
+    try:
+        clients.get_blob_service_client().create_container(CONTAINER)
+    except Exception:
+        pass
+
+    counter.count = 0
+    start = time.perf_counter()
+    with ThreadPoolExecutor(args.threads) as pool:
+        list(pool.map(lambda i: legacy_track(i, users[i % len(users)]), range(args.events)))
+    wall = time.perf_counter() - start
+    requests = counter.count
+    report("legacy", args.events, wall, requests, read_ids("legacy/"))
+
+    telemetry.reset_writer()
+    counter.count = 0
+    start = time.perf_counter()
+    with ThreadPoolExecutor(args.threads) as pool:
+        list(pool.map(lambda i: telemetry.write("bench/", event(i, users[i % len(users)])), range(args.events)))
+    buffered = time.perf_counter() - start
+    telemetry.flush()
+    wall = time.perf_counter() - start
+    requests = counter.count
+    print(f"          writes returned after {buffered * 1000:.0f}ms, stats {telemetry.get_writer().stats}")
+    report("writer", args.events, wall, requests, read_ids("bench/"))
+
+    # Exit without an explicit flush: only the atexit flush saves the buffered events
+    start = time.perf_counter()
+    subprocess.run([sys.executable, "-m", "benchmarks.bench_telemetry", "--child", str(args.events)],
+                   check=True, env=os.environ.copy())
+    report("exit", args.events, time.perf_counter() - start, 0, read_ids("exit/"))
+
+
+def child(events):
+    for i in range(events):
+        telemetry.write("exit/", event(i, "exit"))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--events", type=int, default=5000)
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--latency-ms", type=float, default=5)
+    parser.add_argument("--azurite", action="store_true", help="Use Azurite on 127.0.0.1:10000")
+    parser.add_argument("--child", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child is not None:
+        child(args.child)
+        return
+
+    counter = RequestCounter()
+    http_logger = logging.getLogger("azure.core.pipeline.policies.http_logging_policy")
+    http_logger.setLevel(logging.INFO)
+    http_logger.addHandler(counter)
+    http_logger.propagate = False
+
+    if args.azurite:
+        os.environ["STORAGE_CONNECTION_STRING"] = AZURITE_CONNECTION_STRING
+        clients.reset_clients()
+        run(args, counter)
+        return
+
+    with StubAzureServer(latency_ms=args.latency_ms) as server:
+        server.add_blobs(CONTAINER, [])
+        os.environ.update(server.environment())
+        clients.reset_clients()
+        run(args, counter)
+
+
+if __name__ == "__main__":
+    main()
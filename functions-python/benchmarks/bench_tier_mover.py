@@ -0,0 +1,119 @@
+"""
+Blobs moved per minute and storage requests made by the tier mover versus the
+original copy-and-spin loop. Runs against the stub server, whose copies stay
+pending for --copy-ms, or against Azurite with --azurite.
+
+    python -m benchmarks.bench_tier_mover --blobs 100 --copy-ms 1500
+    python -m benchmarks.bench_tier_mover --blobs 500 --azurite
+"""
+import argparse
+import logging
+import os
+import time
+
+from benchmarks.stub_servers import AZURITE_ACCOUNT, AZURITE_KEY, StubAzureServer
+from shared_code import clients, tiering
+
+AZURITE_CONNECTION_STRING = (
+    "DefaultEndpointsProtocol=http;"
+    f"AccountName={AZURITE_ACCOUNT};"
+    f"AccountKey={AZURITE_KEY};"
+    f"BlobEndpoint=http://127.0.0.1:10000/{AZURITE_ACCOUNT};"
+)
+
+
+class RequestCounter(logging.Handler):
+    """Counts requests from the azure-core HTTP logging policy, for sync and async clients alike"""
+
+    def __init__(self):
+        super().__init__()
+        self.count = 0
+
+    def emit(self, record):
+        if str(record.msg).startswith("Request URL"):
+            self.count += 1
+
+
+def legacy_move(blob_service_client, source_container, target_container, blob_name):
+    """The original move: copy, then poll properties with no sleep until done"""
+    source_blob_client = blob_service_client.get_blob_client(container=source_container, blob=blob_name)
+    target_blob_client = blob_service_client.get_blob_client(container=target_container, blob=blob_name)
+    target_blob_client.start_copy_from_url(source_blob_client.url)
+    while True:
+        properties = target_blob_client.get_blob_properties()
+        if properties.copy.status == "success":
+            break
+        elif properties.copy.status == "failed":
+            raise Exception(f"Copy failed for {blob_name}")
+    source_blob_client.delete_blob()
+
+
+def seed_blobs(container, names):
+    blob_service_client = clients.get_blob_service_client()
+    container_client = blob_service_client.get_container_client(container)
+    try:
+        container_client.create_container()
+    except Exception:
+        pass
+    for name in names:
+        container_client.upload_blob(name, b"benchmark blob " * 64, overwrite=True)
+
+
+def report(label, moved, wall, requests):
+    print(f"{label:<8} {moved / wall * 60:9.0f} blobs/min  {wall:7.2f}s  "
+          f"{requests:6d} requests ({requests / max(moved, 1):.1f} per blob)")
+
+
+def run(args):
+    counter = RequestCounter()
+    http_logger = logging.getLogger("azure.core.pipeline.policies.http_logging_policy")
+    http_logger.setLevel(logging.INFO)
+    http_logger.addHandler(counter)
+    http_logger.propagate = False
+
+    for container in ("hot-documents", "documents"):
+        try:
+            clients.get_blob_service_client().create_container(container)
+        except Exception:
+            pass
+
+    names = [f"legacy/{i:05d}.txt" for i in range(args.blobs)]
+    seed_blobs("hot-documents", names)
+    counter.count = 0
+    start = time.perf_counter()
+    for name in names:
+        legacy_move(clients.get_blob_service_client(), "hot-documents", "documents", name)
+    report("legacy", len(names), time.perf_counter() - start, counter.count)
+
+    names = [f"mover/{i:05d}.txt" for i in range(args.blobs)]
+    seed_blobs("hot-documents", names)
+    counter.count = 0
+    start = time.perf_counter()
+    results = tiering.move_blobs([tiering.plan_move(name, "hot-documents", "documents") for name in names])
+    report("mover", len(names), time.perf_counter() - start, counter.count)
+    print(f"         results: {tiering.summarize(results)}, "
+          f"polls: {sum(result['polls'] for result in results)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--blobs", type=int, default=100)
+    parser.add_argument("--copy-ms", type=float, default=1500, help="How long stub copies stay pending")
+    parser.add_argument("--latency-ms", type=float, default=5)
+    parser.add_argument("--azurite", action="store_true", help="Use Azurite on 127.0.0.1:10000")
+    args = parser.parse_args()
+
+    if args.azurite:
+        os.environ["STORAGE_CONNECTION_STRING"] = AZURITE_CONNECTION_STRING
+        clients.reset_clients()
+        run(args)
+        return
+
+    with StubAzureServer(latency_ms=args.latency_ms, copy_ms=args.copy_ms) as server:
+        os.environ.update(server.environment())
+        clients.reset_clients()
+        run(args)
+
+
+if __name__ == "__main__":
+    main()
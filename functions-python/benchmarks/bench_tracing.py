@@ -0,0 +1,110 @@
+"""
+Overhead of the tracing layer. First the cost of one span around an empty
+function, per exporter; then the query function end to end against a stub
+with no latency, so that tracing is as large a share of the request as it can
+be: untraced (the @traced wrappers removed), traced with TRACE_EXPORTER=none
+and traced with every span exported as JSON. Rounds are interleaved and the
+median per-request time of each variant is compared.
+
+    python -m benchmarks.bench_tracing --requests 200 --rounds 7
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import tempfile
+import time
+
+import azure.functions as func
+
+import AIQueryProcessor
+from benchmarks.stub_servers import StubAzureServer
+from shared_code import clients, metrics, telemetry, tracing
+
+
+def span_cost(exporter, calls=200000):
+    """Microseconds a traced empty function adds over the plain one"""
+    os.environ["TRACE_EXPORTER"] = exporter
+    tracing.reset()
+
+    def plain():
+        return None
+
+    traced = tracing.traced("bench_span")(plain)
+    timings = {}
+    for label, function in (("plain", plain), ("traced", traced)):
+        start = time.perf_counter()
+        for _ in range(calls):
+            function()
+        timings[label] = (time.perf_counter() - start) / calls * 1e6
+    return timings["traced"] - timings["plain"]
+
+
+def untraced(module):
+    """{name: traced function} replaced in module by the functions they wrap"""
+    replaced = {name: value for name, value in vars(module).items() if hasattr(value, "__wrapped__")}
+    for name, value in replaced.items():
+        setattr(module, name, value.__wrapped__)
+    return replaced
+
+
+async def requests_round(requests):
+    """Mean milliseconds per request, run one at a time"""
+    start = time.perf_counter()
+    for i in range(requests):
+        body = json.dumps({"query": f"What does document {i % 10} say about item {i}?", "user_id": "bench"})
+        response = await AIQueryProcessor.main(func.HttpRequest(method="POST", url="/api/query", body=body.encode("utf-8")))
+        if response.status_code != 200:
+            raise RuntimeError(response.get_body())
+    elapsed = (time.perf_counter() - start) * 1000 / requests
+    await clients.close_async_clients()
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--rounds", type=int, default=7)
+    args = parser.parse_args()
+
+    trace_path = os.path.join(tempfile.mkdtemp(prefix="tracing_bench_"), "spans.jsonl")
+    os.environ["TRACE_JSON_PATH"] = trace_path
+    for exporter in ("none", "json"):
+        print(f"span cost    exporter={exporter:<5} {span_cost(exporter):.2f}us per span")
+    tracing.reset()
+    os.remove(trace_path)
+
+    with StubAzureServer() as server:
+        os.environ.update(server.environment())
+        os.environ["ANSWER_CACHE_BACKEND"] = "none"
+        os.environ["RETRIEVAL_CACHE_BACKEND"] = "none"
+        os.environ["LOCAL_SEARCH_MODE"] = "off"
+        os.environ["METRICS_LOG_INTERVAL_SECONDS"] = "3600"
+        clients.reset_clients()
+
+        traced = untraced(AIQueryProcessor)
+        asyncio.run(requests_round(20))
+        timings = {"untraced": [], "none": [], "json": []}
+        for _ in range(args.rounds):
+            for variant in timings:
+                for name, value in traced.items():
+                    setattr(AIQueryProcessor, name, value.__wrapped__ if variant == "untraced" else value)
+                os.environ["TRACE_EXPORTER"] = "none" if variant == "untraced" else variant
+                tracing.reset()
+                timings[variant].append(asyncio.run(requests_round(args.requests)))
+        tracing.reset()
+        telemetry.flush()
+
+    with open(trace_path) as f:
+        spans = sum(1 for _ in f)
+    baseline = statistics.median(timings["untraced"])
+    for variant, rounds in timings.items():
+        median = statistics.median(rounds)
+        print(f"query        {variant:<9} {median:.3f}ms per request  overhead {(median / baseline - 1) * 100:+.2f}%")
+    print(f"             {spans / (args.rounds * args.requests):.1f} spans exported per request")
+    print(f"             {metrics.summary()}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+"""
+Synthetic documents for the benchmarks.
+"""
+import io
+import random
+
+WORDS = (
+    "invoice refund shipping warranty contract payment policy customer account "
+    "delivery order return support product feature pricing discount renewal "
+    "security compliance audit report storage archive retention access"
+).split()
+
+
+def sentence(rng, words=12):
+    return " ".join(rng.choice(WORDS) for _ in range(words)).capitalize() + "."
+
+
+def make_pdf(pages, lines_per_page=40, seed=0):
+    """A text PDF written directly, so no PDF writer library is needed"""
+    rng = random.Random(seed)
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        None,  # page tree, filled in once the page objects are numbered
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"
+    ]
+
+    page_ids = []
+    for _ in range(pages):
+        lines = [sentence(rng) for _ in range(lines_per_page)]
+        stream = "BT /F1 10 Tf 12 TL 50 780 Td " + " ".join(f"({line}) '" for line in lines) + " ET"
+        stream = stream.encode("latin-1")
+        objects.append(b"<< /Length %d >>\nstream\n" % len(stream) + stream + b"\nendstream")
+        content_id = len(objects)
+        objects.append(
+            b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] "
+            b"/Resources << /Font << /F1 3 0 R >> >> /Contents %d 0 R >>" % content_id
+        )
+        page_ids.append(len(objects))
+
+    kids = " ".join(f"{page_id} 0 R" for page_id in page_ids).encode("ascii")
+    objects[1] = b"<< /Type /Pages /Kids [" + kids + b"] /Count %d >>" % pages
+
+    output = io.BytesIO()
+    output.write(b"%PDF-1.4\n")
+    offsets = []
+    for number, body in enumerate(objects, 1):
+        offsets.append(output.tell())
+        output.write(b"%d 0 obj\n" % number + body + b"\nendobj\n")
+
+    xref = output.tell()
+    output.write(b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1))
+    for offset in offsets:
+        output.write(b"%010d 00000 n \n" % offset)
+    output.write(b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref))
+    return output.getvalue()
+
+
+def make_docx(paragraphs, seed=0):
+    import docx
+
+    rng = random.Random(seed)
+    document = docx.Document()
+    for _ in range(paragraphs):
+        document.add_paragraph(" ".join(sentence(rng) for _ in range(4)))
+    output = io.BytesIO()
+    document.save(output)
+    return output.getvalue()
+
+
+def make_text(paragraphs, seed=0):
+    rng = random.Random(seed)
+    return "\n\n".join(" ".join(sentence(rng) for _ in range(4)) for _ in range(paragraphs)).encode("utf-8")
+
+
+def make_scan(pages, dpi=600, lines_per_page=30, seed=0, image_format="TIFF"):
+    """A letter-size greyscale scan; pages > 1 gives a multi-frame TIFF"""
+    from PIL import Image, ImageDraw, ImageFont
+
+    rng = random.Random(seed)
+    width, height = int(8.5 * dpi), int(11 * dpi)
+    font = ImageFont.load_default(size=dpi // 6)
+    frames = []
+    for _ in range(pages):
+        frame = Image.new("L", (width, height), 235)
+        draw = ImageDraw.Draw(frame)
+        for line in range(lines_per_page):
+            draw.text((dpi, dpi + line * dpi // 3), sentence(rng, 8), fill=20, font=font)
+        frames.append(frame)
+
+    output = io.BytesIO()
+    frames[0].save(output, format=image_format, dpi=(dpi, dpi), save_all=pages > 1, append_images=frames[1:])
+    return output.getvalue()
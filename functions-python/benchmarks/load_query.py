@@ -0,0 +1,92 @@
+"""
+Load test for AIQueryProcessor: the blocking search -> generate -> track pipeline
+run on a worker thread pool versus the async handler on a single event loop.
+
+    python -m benchmarks.load_query --requests 200 --concurrency 20 --latency-ms 50
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import azure.functions as func
+
+import AIQueryProcessor
+from benchmarks.stub_servers import StubAzureServer
+from shared_code import clients, telemetry
+
+
+def make_request(i):
+    body = json.dumps({"query": f"What does document {i % 10} say?", "user_id": f"user{i}"})
+    return func.HttpRequest(method="POST", url="/api/query", body=body.encode("utf-8"))
+
+
+def blocking_pipeline(i):
+    """The pre-async handler: every call, including tracking, on the request path"""
+    start = time.perf_counter()
+    query = f"What does document {i % 10} say?"
+    relevant_docs = AIQueryProcessor.search_documents(query)
+    AIQueryProcessor.generate_ai_response(query, relevant_docs)
+    AIQueryProcessor.track_query(query, f"user{i}", relevant_docs)
+    return (time.perf_counter() - start) * 1000
+
+
+async def async_handler(i, semaphore):
+    async with semaphore:
+        start = time.perf_counter()
+        response = await AIQueryProcessor.main(make_request(i))
+        elapsed = (time.perf_counter() - start) * 1000
+    if response.status_code != 200:
+        raise RuntimeError(response.get_body())
+    return elapsed
+
+
+async def run_async(requests, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+    start = time.perf_counter()
+    timings = await asyncio.gather(*(async_handler(i, semaphore) for i in range(requests)))
+    wall = time.perf_counter() - start
+    # Write out the buffered tracking events
+    telemetry.flush()
+    await clients.close_async_clients()
+    return timings, wall
+
+
+def report(label, timings, wall):
+    timings = sorted(timings)
+    p50 = statistics.median(timings)
+    p99 = timings[min(len(timings) - 1, int(len(timings) * 0.99))]
+    print(f"{label:<9} p50={p50:8.2f}ms p99={p99:8.2f}ms throughput={len(timings) / wall:8.1f} req/s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--threads", type=int, default=int(os.environ.get("PYTHON_THREADPOOL_THREAD_COUNT", "1")),
+                        help="Worker threads for the blocking handler (PYTHON_THREADPOOL_THREAD_COUNT)")
+    parser.add_argument("--latency-ms", type=float, default=50)
+    args = parser.parse_args()
+
+    with StubAzureServer(latency_ms=args.latency_ms) as server:
+        os.environ.update(server.environment())
+        # Measure search and generation themselves, not cache hits
+        os.environ["ANSWER_CACHE_BACKEND"] = "none"
+        os.environ["RETRIEVAL_CACHE_BACKEND"] = "none"
+        clients.reset_clients()
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.threads) as pool:
+            timings = list(pool.map(blocking_pipeline, range(args.requests)))
+        report("blocking", timings, time.perf_counter() - start)
+
+        timings, wall = asyncio.run(run_async(args.requests, args.concurrency))
+        report("async", timings, wall)
+        print(f"stub requests served: {server.request_count}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,520 @@
+"""
+Local stand-ins for Blob Storage, Cognitive Search, Azure OpenAI and Form
+Recognizer.
+
+The stub answers just enough of each REST API for the SDK calls made by the
+functions, with an optional fixed latency per request. It counts requests and
+new TCP connections so benchmarks can show the effect of connection reuse.
+Chat completions can be rate limited like an Azure OpenAI deployment: requests
+and tokens per window, answered with 429 and Retry-After once exceeded.
+"""
+import json
+import math
+import re
+import threading
+import time
+from collections import deque
+from email.utils import formatdate
+from urllib.parse import parse_qs, unquote, urlsplit
+from xml.sax.saxutils import escape
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Well-known Azurite development account, safe to publish
+AZURITE_ACCOUNT = "devstoreaccount1"
+AZURITE_KEY = "Eby8vdM02xNOcqFlqUwJPLlmEtlCDXJ1OUzFT50uSRZ6IFsuFq2UVErCz4I6tq/K1SZFPTOtr/KBHBeksoGMGw=="
+
+
+class _BurstHTTPServer(ThreadingHTTPServer):
+    # Room for a burst of new connections; the default backlog of 5 resets them
+    request_queue_size = 128
+
+
+class StubAzureServer:
+    """Threaded HTTP server that imitates the Azure services used by the functions"""
+
+    def __init__(self, latency_ms=0, token_delay_ms=0, copy_ms=0, host="127.0.0.1", port=0,
+                 chat_requests_limit=0, chat_tokens_limit=0, rate_window_seconds=60):
+        self.latency = latency_ms / 1000.0
+        self.token_delay = token_delay_ms / 1000.0
+        # Blob copies report "pending" until copy_ms after they were started
+        self.copy_time = copy_ms / 1000.0
+        self.copies = {}
+        # Containers whose blobs are listed, moved and deleted: {container: {name: (last_modified, tier)}}
+        self.containers = {}
+        self.contents = {}
+        self.request_count = 0
+        self.connection_count = 0
+        self.index_uploads = 0
+        self.search_results = [
+            {
+                "@search.score": 1.0,
+                "id": "stub",
+                "filename": "stub.pdf",
+                "content": "Stub document content. " * 50,
+                "upload_date": "2024-01-01T00:00:00"
+            }
+        ]
+        self.completion_text = "This is a stub answer based on the documents."
+        # Form Recognizer analyze operations: {result id: analyze result}
+        self.analyze_results = {}
+        # Chat completion quota per rate window, 0 for unlimited, as Azure counts it: prompt plus max_tokens
+        self.chat_requests_limit = chat_requests_limit
+        self.chat_tokens_limit = chat_tokens_limit
+        self.rate_window = rate_window_seconds
+        self.chat_window = deque()
+        self.chat_completions = 0
+        self.chat_throttled = 0
+        self._lock = threading.Lock()
+        self._httpd = _BurstHTTPServer((host, port), _make_handler(self))
+        self._httpd.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    @property
+    def storage_connection_string(self):
+        return (
+            "DefaultEndpointsProtocol=http;"
+            f"AccountName={AZURITE_ACCOUNT};"
+            f"AccountKey={AZURITE_KEY};"
+            f"BlobEndpoint={self.url}/{AZURITE_ACCOUNT};"
+        )
+
+    def environment(self):
+        """Environment variables that point the functions at this server"""
+        return {
+            "STORAGE_CONNECTION_STRING": self.storage_connection_string,
+            "SEARCH_ENDPOINT": self.url,
+            "SEARCH_API_KEY": "stub-key",
+            "OPENAI_ENDPOINT": self.url,
+            "OPENAI_API_KEY": "stub-key",
+            "FORM_RECOGNIZER_ENDPOINT": self.url,
+            "FORM_RECOGNIZER_KEY": "stub-key"
+        }
+
+    def start(self):
+        self._thread = threading.Thread(target=self._httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def reset_counters(self):
+        with self._lock:
+            self.request_count = 0
+            self.connection_count = 0
+            self.index_uploads = 0
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def add_blobs(self, container, names, age_days=0, tier="Hot"):
+        """Make blobs listable in container, last modified age_days ago"""
+        modified = time.time() - age_days * 86400
+        with self._lock:
+            blobs = self.containers.setdefault(container, {})
+            for name in names:
+                blobs[name] = (modified, tier)
+
+    def _count(self, attribute):
+        with self._lock:
+            setattr(self, attribute, getattr(self, attribute) + 1)
+
+    def handle(self, handler, method):
+        """Route one request to the matching fake API"""
+        self._count("request_count")
+        if self.latency:
+            time.sleep(self.latency)
+
+        path = handler.path
+        body = handler.read_body()
+
+        if "search.post.search" in path:
+            return handler.send_json(200, {"value": self.search_results})
+        if "search.index" in path:
+            self._count("index_uploads")
+            documents = json.loads(body or b"{}").get("value", [])
+            return handler.send_json(200, {
+                "value": [
+                    {"key": doc.get("id", ""), "status": True, "errorMessage": None, "statusCode": 201}
+                    for doc in documents
+                ]
+            })
+        if "/documentModels/" in path:
+            return self.handle_analyze(handler, method, path, body)
+        if "/chat/completions" in path:
+            return self.handle_chat_completion(handler, json.loads(body or b"{}"))
+        if "/embeddings" in path:
+            inputs = json.loads(body or b"{}").get("input", [])
+            if isinstance(inputs, str):
+                inputs = [inputs]
+            return handler.send_json(200, {
+                "object": "list",
+                "model": "text-embedding-ada-002",
+                "data": [
+                    {"object": "embedding", "index": i, "embedding": _fake_embedding(text)}
+                    for i, text in enumerate(inputs)
+                ],
+                "usage": {"prompt_tokens": 0, "total_tokens": 0}
+            })
+
+        # Anything else is treated as a blob or container operation
+        blob_path = path.split("?", 1)[0]
+        container, blob_name = self.blob_location(blob_path)
+        if container in self.containers:
+            handled = self.handle_tracked_blob(handler, method, path, container, blob_name, body)
+            if handled is not False:
+                return handled
+        if method == "PUT" and handler.headers.get("x-ms-copy-source"):
+            with self._lock:
+                self.copies[blob_path] = time.monotonic()
+            return handler.send_empty(202, self.copy_headers(blob_path))
+        if method == "PUT" and ("comp=tier" in path or "comp=metadata" in path):
+            return handler.send_empty(200)
+        if method == "PUT" and "comp=copy" in path:
+            return handler.send_empty(204)
+        if method == "HEAD" and blob_path in self.copies:
+            return handler.send_empty(200, self.copy_headers(blob_path))
+        if method == "PUT":
+            return handler.send_empty(201)
+        if method == "DELETE":
+            return handler.send_empty(202)
+        if method == "HEAD" or "restype=container" in path:
+            return handler.send_empty(200)
+        return handler.send_bytes(200, b"", "application/octet-stream")
+
+    @staticmethod
+    def blob_location(blob_path):
+        parts = blob_path.split("/", 3)
+        container = unquote(parts[2]) if len(parts) > 2 else None
+        blob_name = unquote(parts[3]) if len(parts) > 3 else None
+        return container, blob_name
+
+    def handle_tracked_blob(self, handler, method, path, container, blob_name, body):
+        """Listing, batch delete, copy, set tier and delete on the containers in self.containers"""
+        query = parse_qs(urlsplit(path).query)
+        blobs = self.containers[container]
+
+        if method == "GET" and query.get("comp") == ["list"]:
+            return handler.send_bytes(200, self.list_page(container, query), "application/xml")
+
+        if method == "POST" and query.get("comp") == ["batch"]:
+            names = [unquote(name.decode("utf-8")) for name in re.findall(rb"DELETE /[^/ ]+/([^? ]+)", body)]
+            boundary = "batchresponse_stub"
+            parts = []
+            for index, name in enumerate(names):
+                with self._lock:
+                    found = self.containers[container].pop(name, None) is not None
+                status = "202 Accepted" if found else "404 The specified blob does not exist."
+                parts.append(
+                    f"--{boundary}\r\nContent-Type: application/http\r\nContent-ID: {index}\r\n\r\n"
+                    f"HTTP/1.1 {status}\r\nx-ms-request-id: stub\r\nx-ms-version: 2021-12-02\r\n\r\n"
+                )
+            data = ("\r\n".join(parts) + f"\r\n--{boundary}--\r\n").encode("utf-8")
+            return handler.send_bytes(202, data, f"multipart/mixed; boundary={boundary}")
+
+        if blob_name is None:
+            return False
+
+        if method == "PUT" and handler.headers.get("x-ms-copy-source"):
+            source_container, source_name = self.blob_location(urlsplit(handler.headers["x-ms-copy-source"]).path)
+            tier = handler.headers.get("x-ms-access-tier", "Hot")
+            with self._lock:
+                if source_name not in self.containers.get(source_container, {}):
+                    return handler.send_empty(404, {"x-ms-error-code": "BlobNotFound"})
+                blobs[blob_name] = (time.time(), tier)
+                self.copies[urlsplit(path).path] = time.monotonic()
+            return handler.send_empty(202, self.copy_headers(urlsplit(path).path))
+        if method == "PUT" and query.get("comp") == ["tier"]:
+            with self._lock:
+                modified, _ = blobs[blob_name]
+                blobs[blob_name] = (modified, handler.headers.get("x-ms-access-tier"))
+            return handler.send_empty(200)
+        if method == "PUT" and query.get("comp") == ["appendblock"]:
+            with self._lock:
+                if blob_name not in blobs:
+                    return handler.send_empty(404, {"x-ms-error-code": "BlobNotFound"})
+                offset = len(self.contents.get((container, blob_name), b""))
+                self.contents[(container, blob_name)] = self.contents.get((container, blob_name), b"") + body
+                blobs[blob_name] = (time.time(), blobs[blob_name][1])
+            return handler.send_empty(201, {"x-ms-blob-append-offset": str(offset), "x-ms-blob-committed-block-count": "1"})
+        if method == "PUT" and query.get("comp") == ["blocklist"]:
+            # Staged block contents are not kept, only that the blob exists
+            with self._lock:
+                blobs[blob_name] = (time.time(), handler.headers.get("x-ms-access-tier", "Hot"))
+            return handler.send_empty(201)
+        if method == "PUT" and not query.get("comp"):
+            with self._lock:
+                if handler.headers.get("If-None-Match") == "*" and blob_name in blobs:
+                    return handler.send_empty(409, {"x-ms-error-code": "BlobAlreadyExists"})
+                blobs[blob_name] = (time.time(), handler.headers.get("x-ms-access-tier", "Hot"))
+                self.contents[(container, blob_name)] = body
+            return handler.send_empty(201)
+        if method in ("GET", "HEAD") and not query.get("comp"):
+            with self._lock:
+                data = self.contents.get((container, blob_name))
+                found = blob_name in blobs
+            if not found:
+                return handler.send_empty(404, {"x-ms-error-code": "BlobNotFound"})
+            data = data or b""
+            total = len(data)
+            start, end = 0, max(total - 1, 0)
+            requested = re.match(r"bytes=(\d+)-(\d*)", handler.headers.get("x-ms-range") or handler.headers.get("Range") or "")
+            if requested:
+                start = int(requested.group(1))
+                end = min(int(requested.group(2) or total - 1), total - 1)
+                data = data[start:end + 1]
+            headers = {"x-ms-blob-type": "BlockBlob", "Content-Range": f"bytes {start}-{end}/{total}"}
+            if method == "HEAD":
+                return handler.send_empty(200, headers)
+            return handler.send_bytes(206, data, "application/octet-stream", headers)
+        if method == "DELETE":
+            with self._lock:
+                found = blobs.pop(blob_name, None) is not None
+                self.contents.pop((container, blob_name), None)
+            return handler.send_empty(202) if found else handler.send_empty(404, {"x-ms-error-code": "BlobNotFound"})
+        return False
+
+    def list_page(self, container, query):
+        page_size = int(query.get("maxresults", ["5000"])[0])
+        marker = query.get("marker", [""])[0]
+        with self._lock:
+            prefix = query.get("prefix", [""])[0]
+            names = sorted(
+                name for name in self.containers[container] if name > marker and name.startswith(prefix)
+            )
+            page = [(name, self.containers[container][name]) for name in names[:page_size]]
+        next_marker = page[-1][0] if len(names) > page_size else ""
+
+        items = "".join(
+            f"<Blob><Name>{escape(name)}</Name><Properties>"
+            f"<Last-Modified>{formatdate(modified, usegmt=True)}</Last-Modified><Etag>0x1</Etag>"
+            f"<Content-Length>{size}</Content-Length><BlobType>BlockBlob</BlobType><AccessTier>{tier}</AccessTier>"
+            f"</Properties></Blob>"
+            for name, (modified, tier), size in (
+                (name, entry, len(self.contents[(container, name)]) if (container, name) in self.contents else 1)
+                for name, entry in page
+            )
+        )
+        return (
+            f'<?xml version="1.0" encoding="utf-8"?><EnumerationResults ContainerName="{escape(container)}">'
+            f"<MaxResults>{page_size}</MaxResults><Blobs>{items}</Blobs>"
+            f"<NextMarker>{escape(next_marker)}</NextMarker></EnumerationResults>"
+        ).encode("utf-8")
+
+    def copy_headers(self, blob_path):
+        done = time.monotonic() - self.copies[blob_path] >= self.copy_time
+        return {"x-ms-copy-id": "stub-copy", "x-ms-copy-status": "success" if done else "pending"}
+
+    def admit_chat_completion(self, payload):
+        """None if the completion fits the quota, else the seconds until it would"""
+        cost = sum((len(message.get("content") or "") + 3) // 4 for message in payload.get("messages", []))
+        cost += payload.get("max_tokens", 16)
+        now = time.monotonic()
+        with self._lock:
+            while self.chat_window and self.chat_window[0][0] <= now - self.rate_window:
+                self.chat_window.popleft()
+            used = sum(tokens for _, tokens in self.chat_window)
+            over_requests = self.chat_requests_limit and len(self.chat_window) >= self.chat_requests_limit
+            over_tokens = self.chat_tokens_limit and used + cost > self.chat_tokens_limit
+            if not over_requests and not over_tokens:
+                self.chat_window.append((now, cost))
+                self.chat_completions += 1
+                return None
+            self.chat_throttled += 1
+            # Until enough of the window has expired for this request to fit
+            wait, requests, tokens_used = 0.0, len(self.chat_window), used
+            for started, tokens in self.chat_window:
+                if (not self.chat_requests_limit or requests < self.chat_requests_limit) and \
+                        (not self.chat_tokens_limit or tokens_used + cost <= self.chat_tokens_limit):
+                    break
+                wait = started + self.rate_window - now
+                requests -= 1
+                tokens_used -= tokens
+            return max(wait, 0.001)
+
+    def handle_analyze(self, handler, method, path, body):
+        """Form Recognizer analyze: accept the document, then return its printable lines as the result"""
+        if method == "POST":
+            lines = [line.strip() for line in re.findall(rb"[ -~]{20,}", body)[:200]]
+            result_id = f"stub-{len(self.analyze_results)}"
+            with self._lock:
+                self.analyze_results[result_id] = {
+                    "apiVersion": "2023-07-31",
+                    "modelId": "prebuilt-document",
+                    "stringIndexType": "textElements",
+                    "content": "\n".join(line.decode("ascii") for line in lines),
+                    "pages": [{
+                        "pageNumber": 1, "angle": 0, "width": 8.5, "height": 11, "unit": "inch",
+                        "words": [], "spans": [],
+                        "lines": [{"content": line.decode("ascii"), "polygon": [], "spans": []} for line in lines]
+                    }]
+                }
+            model = urlsplit(path).path.split(":analyze")[0]
+            return handler.send_empty(202, {
+                "Operation-Location": f"{self.url}{model}/analyzeResults/{result_id}?api-version=2023-07-31"
+            })
+
+        result_id = urlsplit(path).path.rsplit("/", 1)[-1]
+        with self._lock:
+            result = self.analyze_results.get(result_id)
+        if result is None:
+            return handler.send_json(404, {"error": {"code": "NotFound", "message": "Unknown result"}})
+        return handler.send_json(200, {
+            "status": "succeeded",
+            "createdDateTime": "2024-01-01T00:00:00Z",
+            "lastUpdatedDateTime": "2024-01-01T00:00:00Z",
+            "analyzeResult": result
+        })
+
+    def handle_chat_completion(self, handler, payload):
+        retry_after = self.admit_chat_completion(payload)
+        if retry_after is not None:
+            return handler.send_json(429, {
+                "error": {
+                    "code": "429",
+                    "message": "Requests to the ChatCompletions_Create Operation under Azure OpenAI API have "
+                               f"exceeded the rate limit. Please retry after {math.ceil(retry_after)} seconds."
+                }
+            }, headers={"retry-after": str(math.ceil(retry_after)), "retry-after-ms": str(int(retry_after * 1000))})
+
+        # Without streaming the whole completion is generated before replying
+        tokens = self.completion_text.split(" ")
+        if payload.get("stream"):
+            return self.stream_chat_completion(handler, tokens)
+        if self.token_delay:
+            time.sleep(self.token_delay * len(tokens))
+
+        return handler.send_json(200, {
+            "id": "chatcmpl-stub",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": "gpt-4",
+            "choices": [
+                {
+                    "index": 0,
+                    "message": {"role": "assistant", "content": self.completion_text},
+                    "finish_reason": "stop"
+                }
+            ],
+            "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}
+        })
+
+    def stream_chat_completion(self, handler, tokens):
+        """Send the completion as server-sent events, one token per chunk"""
+        handler.start_chunked(200, "text/event-stream")
+        # Azure sends a first chunk with content filter results and no choices
+        handler.write_event({"id": "chatcmpl-stub", "object": "chat.completion.chunk", "created": 0,
+                             "model": "", "choices": [], "prompt_filter_results": []})
+        for i, token in enumerate(tokens):
+            if self.token_delay:
+                time.sleep(self.token_delay)
+            handler.write_event({
+                "id": "chatcmpl-stub",
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": "gpt-4",
+                "choices": [{"index": 0, "delta": {"content": token if i == 0 else " " + token},
+                             "finish_reason": None}]
+            })
+        handler.write_event({
+            "id": "chatcmpl-stub",
+            "object": "chat.completion.chunk",
+            "created": int(time.time()),
+            "model": "gpt-4",
+            "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]
+        })
+        handler.write_chunk(b"data: [DONE]\n\n")
+        handler.write_chunk(b"")
+
+
+def _fake_embedding(text, dimensions=16):
+    """Deterministic low-dimensional vector so similar inputs stay comparable"""
+    vector = [0.0] * dimensions
+    for i, char in enumerate(text.lower()):
+        vector[(ord(char) + i) % dimensions] += 1.0
+    norm = sum(v * v for v in vector) ** 0.5 or 1.0
+    return [v / norm for v in vector]
+
+
+def _make_handler(server):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def setup(self):
+            super().setup()
+            server._count("connection_count")
+
+        def log_message(self, format, *args):
+            pass
+
+        def read_body(self):
+            length = int(self.headers.get("Content-Length") or 0)
+            return self.rfile.read(length) if length else b""
+
+        def send_common_headers(self):
+            self.send_header("Date", formatdate(usegmt=True))
+            self.send_header("Last-Modified", formatdate(usegmt=True))
+            self.send_header("ETag", '"0x8D0000000000000"')
+            self.send_header("x-ms-request-id", "stub")
+            self.send_header("x-ms-version", "2021-12-02")
+
+        def send_empty(self, status, headers=None):
+            self.send_response(status)
+            self.send_common_headers()
+            for header, value in (headers or {}).items():
+                self.send_header(header, value)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+        def send_bytes(self, status, data, content_type, headers=None):
+            self.send_response(status)
+            self.send_common_headers()
+            for header, value in (headers or {}).items():
+                self.send_header(header, value)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def send_json(self, status, payload, headers=None):
+            self.send_bytes(status, json.dumps(payload).encode("utf-8"), "application/json", headers)
+
+        def start_chunked(self, status, content_type):
+            self.send_response(status)
+            self.send_common_headers()
+            self.send_header("Content-Type", content_type)
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+
+        def write_chunk(self, data):
+            self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+            self.wfile.flush()
+
+        def write_event(self, payload):
+            self.write_chunk(f"data: {json.dumps(payload)}\n\n".encode("utf-8"))
+
+        def do_GET(self):
+            server.handle(self, "GET")
+
+        def do_PUT(self):
+            server.handle(self, "PUT")
+
+        def do_POST(self):
+            server.handle(self, "POST")
+
+        def do_DELETE(self):
+            server.handle(self, "DELETE")
+
+        def do_HEAD(self):
+            server.handle(self, "HEAD")
+
+    return Handler
@@ -0,0 +1,328 @@
+"""
+Offline regression suite for the ingestion, query and lifecycle paths.
+
+Synthetic corpora of PDFs, DOCX, text, scanned images and a format left to
+Form Recognizer go through DocumentUploadProcessor.main, questions through
+AIQueryProcessor.main and a seeded document estate through the
+DocumentAccessTracker timer, at each requested scale. Search, OpenAI and Form
+Recognizer are the stub server; storage is the stub too, or Azurite on
+127.0.0.1:10000 with --azurite (blob ages cannot be backdated there, so the
+lifecycle run scans without moving anything). Caches are off, every corpus
+is seeded and the lazily imported parsers and SDKs are loaded before the
+first measurement (cold starts are bench_startup's), so runs are comparable.
+
+Each scenario records throughput, p50/p99 latency and the peak resident
+memory it added, each the median over --repeat runs of the scale. Results are
+compared with --baseline: a latency or memory figure above the baseline by
+more than --tolerance, or a throughput below it, is flagged and the suite
+exits 1. --update-baseline (or a missing baseline)
+records this run instead. Baselines only compare on the same machine.
+
+    python -m benchmarks.suite --scales small,medium
+    python -m benchmarks.suite --scales small --update-baseline
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+import azure.functions as func
+
+import AIQueryProcessor
+import DocumentAccessTracker
+import DocumentUploadProcessor
+from benchmarks.bench_startup import EAGER_MODULES
+from benchmarks.bench_tier_mover import AZURITE_CONNECTION_STRING, seed_blobs
+from benchmarks.corpus import make_docx, make_pdf, make_scan, make_text, sentence
+from benchmarks.stub_servers import StubAzureServer
+from shared_code import clients, metrics, ocr, telemetry, warmup
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(__file__), "baseline.json")
+
+# Documents per format, PDF pages, DOCX paragraphs, questions and lifecycle blobs per scale
+SCALES = {
+    "small": {"documents": 2, "pages": 5, "paragraphs": 50, "queries": 50, "blobs": 1000},
+    "medium": {"documents": 5, "pages": 20, "paragraphs": 200, "queries": 200, "blobs": 5000},
+    "large": {"documents": 10, "pages": 60, "paragraphs": 600, "queries": 500, "blobs": 20000}
+}
+
+# Figures where higher is worse, and the one where lower is
+WORSE_WHEN_HIGHER = ("p50_ms", "p99_ms", "peak_mb")
+WORSE_WHEN_LOWER = ("throughput_per_s",)
+
+# Resident memory moves by a few megabytes between identical runs (arenas, caches)
+MEMORY_NOISE_MB = 5
+
+CONTAINERS = ("documents", "hot-documents", "archive", "processed", "metadata")
+
+
+class PeakMemory:
+    """Samples resident memory on a thread; peak_mb is the most the block added over where it started"""
+
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.peak_mb = 0.0
+        self._stop = threading.Event()
+
+    @staticmethod
+    def resident_mb():
+        try:
+            with open("/proc/self/statm") as f:
+                return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+        except OSError:
+            # No /proc: the process high-water mark, which never goes down
+            import resource
+            return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, self.resident_mb())
+
+    def __enter__(self):
+        self.start = self.peak = self.resident_mb()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, self.resident_mb())
+        self.peak_mb = self.peak - self.start
+
+
+def summarize(timings, wall, peak_mb, operations=None):
+    timings = sorted(timings)
+    return {
+        "count": len(timings),
+        "throughput_per_s": (operations or len(timings)) / wall,
+        "p50_ms": statistics.median(timings),
+        "p99_ms": timings[min(len(timings) - 1, int(len(timings) * 0.99))],
+        "peak_mb": peak_mb
+    }
+
+
+def make_corpus(scale, seed=11):
+    """[(name, bytes)] with scale["documents"] of each format, interleaved"""
+    rng = random.Random(seed)
+    count = scale["documents"]
+    images = shutil.which("tesseract") is not None
+    corpus = []
+    for i in range(count):
+        corpus.append((f"bench/report{i:03d}.pdf", make_pdf(scale["pages"], seed=seed + i)))
+        corpus.append((f"bench/contract{i:03d}.docx", make_docx(scale["paragraphs"], seed=seed + i)))
+        corpus.append((f"bench/notes{i:03d}.txt", make_text(scale["paragraphs"] * 4, seed=seed + i)))
+        corpus.append((f"bench/form{i:03d}.rtf", "\n".join(sentence(rng) for _ in range(scale["paragraphs"])).encode("ascii")))
+        if images:
+            corpus.append((f"bench/scan{i:03d}.png", make_scan(1, dpi=200, seed=seed + i, image_format="PNG")))
+    return corpus
+
+
+def run_uploads(corpus):
+    """Upload scenario plus one per format"""
+    timings = {}
+    total_bytes = 0
+    with PeakMemory() as memory:
+        start = time.perf_counter()
+        for name, data in corpus:
+            blob = func.blob.InputStream(data=data, name=f"documents/{name}", length=len(data))
+            began = time.perf_counter()
+            DocumentUploadProcessor.main(blob, name)
+            timings.setdefault(name.rsplit(".", 1)[-1], []).append((time.perf_counter() - began) * 1000)
+            total_bytes += len(data)
+        wall = time.perf_counter() - start
+
+    results = {"upload": summarize([ms for values in timings.values() for ms in values], wall, memory.peak_mb)}
+    results["upload"]["mb_per_s"] = total_bytes / (1024 * 1024) / wall
+    for extension, values in sorted(timings.items()):
+        results[f"upload_{extension}"] = summarize(values, sum(values) / 1000, memory.peak_mb)
+    return results
+
+
+async def query_all(queries):
+    timings = []
+    for i, query in enumerate(queries):
+        body = json.dumps({"query": query, "user_id": f"bench{i % 7}"}).encode("utf-8")
+        began = time.perf_counter()
+        response = await AIQueryProcessor.main(func.HttpRequest(method="POST", url="/api/query", body=body))
+        timings.append((time.perf_counter() - began) * 1000)
+        if response.status_code != 200:
+            raise RuntimeError(f"Query failed: {response.get_body()}")
+    await clients.close_async_clients()
+    return timings
+
+
+def run_queries(scale, seed=11):
+    rng = random.Random(seed)
+    queries = [f"{sentence(rng, 8)} ({i})" for i in range(scale["queries"])]
+    with PeakMemory() as memory:
+        start = time.perf_counter()
+        timings = asyncio.run(query_all(queries))
+        wall = time.perf_counter() - start
+    return {"query": summarize(timings, wall, memory.peak_mb)}
+
+
+def seed_estate(server, blobs, azurite, seed=11):
+    """Spread blobs over the hot, cool and archive containers at ages that make some of them due"""
+    rng = random.Random(seed)
+    placed = {"hot-documents": [], "documents": [], "archive": []}
+    for i in range(blobs):
+        placed[rng.choice(list(placed))].append(f"estate/{i:06d}.pdf")
+    for container, names in placed.items():
+        if azurite:
+            seed_blobs(container, names)
+            continue
+        for name in names:
+            server.add_blobs(container, [name], age_days=rng.choice([1, 10, 45, 120, 400]))
+
+
+def run_lifecycle(server, scale, azurite, runs=3):
+    """Timer invocations over the seeded estate; throughput is blobs per second of the first, full scan"""
+    seed_estate(server, scale["blobs"], azurite)
+    timings = []
+    with PeakMemory() as memory:
+        for _ in range(runs):
+            began = time.perf_counter()
+            DocumentAccessTracker.main(None)
+            timings.append((time.perf_counter() - began) * 1000)
+    result = summarize(timings, timings[0] / 1000, memory.peak_mb, operations=scale["blobs"])
+    return {"lifecycle": result}
+
+
+def run_scale(name, scale, azurite):
+    """Every scenario of one scale against a fresh stub and empty local state"""
+    with StubAzureServer() as server:
+        os.environ.update(server.environment())
+        state = tempfile.mkdtemp(prefix=f"suite_{name}_")
+        os.environ.update({
+            "ANSWER_CACHE_BACKEND": "none",
+            "RETRIEVAL_CACHE_BACKEND": "none",
+            "LOCAL_SEARCH_DIR": os.path.join(state, "local_search"),
+            "METRICS_LOG_INTERVAL_SECONDS": "3600",
+            "OPENAI_EMBEDDING_DEPLOYMENT": "embeddings"
+        })
+        if azurite:
+            os.environ["STORAGE_CONNECTION_STRING"] = AZURITE_CONNECTION_STRING
+        for container in CONTAINERS:
+            server.add_blobs(container, [])
+        clients.reset_clients()
+        if azurite:
+            for container in CONTAINERS:
+                try:
+                    clients.get_blob_service_client().create_container(container)
+                except Exception:
+                    pass
+        metrics.reset()
+
+        results = run_uploads(make_corpus(scale))
+        results.update(run_queries(scale))
+        results.update(run_lifecycle(server, scale, azurite))
+        telemetry.flush()
+        ocr.reset_pool()
+        shutil.rmtree(state, ignore_errors=True)
+    return results
+
+
+def median_of(runs):
+    """Each scenario's figures as the median over repeated runs of a scale"""
+    return {
+        scenario: {figure: statistics.median(run[scenario][figure] for run in runs) for figure in figures}
+        for scenario, figures in runs[0].items()
+    }
+
+
+def compare(results, baseline, tolerance):
+    """Lines for every figure outside tolerance of the baseline, and whether any was a regression"""
+    lines, regressed = [], False
+    for scale, scenarios in results["scales"].items():
+        for scenario, figures in scenarios.items():
+            expected = baseline.get("scales", {}).get(scale, {}).get(scenario)
+            if expected is None:
+                continue
+            for figure in WORSE_WHEN_HIGHER + WORSE_WHEN_LOWER:
+                if figure not in expected or figure not in figures:
+                    continue
+                if figure == "peak_mb" and abs(figures[figure] - expected[figure]) < MEMORY_NOISE_MB:
+                    continue
+                old, new = expected[figure], figures[figure]
+                change = (new - old) / old if old else 0.0
+                worse = change > tolerance if figure in WORSE_WHEN_HIGHER else change < -tolerance
+                better = change < -tolerance if figure in WORSE_WHEN_HIGHER else change > tolerance
+                if worse or better:
+                    regressed = regressed or worse
+                    lines.append(f"{'REGRESSION' if worse else 'improved':<10} {scale}/{scenario} {figure} "
+                                 f"{new:.2f} vs baseline {old:.2f} ({change:+.0%})")
+    return lines, regressed
+
+
+def environment():
+    return {
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+        "tesseract": shutil.which("tesseract") is not None
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scales", default="small", help=f"Comma separated, of {', '.join(SCALES)}")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE)
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per scale; figures are their medians")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="Allowed relative change, e.g. 0.25")
+    parser.add_argument("--update-baseline", action="store_true")
+    parser.add_argument("--output", help="Also write this run's results here")
+    parser.add_argument("--azurite", action="store_true", help="Use Azurite on 127.0.0.1:10000 for storage")
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.WARNING)
+    warmup.import_modules(*EAGER_MODULES)
+    results = {"environment": environment(), "tolerance": args.tolerance, "scales": {}}
+    for name in args.scales.split(","):
+        started = time.perf_counter()
+        results["scales"][name] = median_of([run_scale(name, SCALES[name], args.azurite) for _ in range(args.repeat)])
+        print(f"{name}: {time.perf_counter() - started:.0f}s")
+        for scenario, figures in results["scales"][name].items():
+            print(f"  {scenario:<14} {figures['throughput_per_s']:9.2f}/s  p50={figures['p50_ms']:9.1f}ms  "
+                  f"p99={figures['p99_ms']:9.1f}ms  peak +{figures['peak_mb']:.0f}MB  n={figures['count']:.0f}")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.update_baseline or not os.path.exists(args.baseline):
+        baseline = {"scales": {}}
+        if os.path.exists(args.baseline):
+            with open(args.baseline) as f:
+                baseline = json.load(f)
+        # Scales not run this time keep their previous baseline
+        baseline.update(environment=results["environment"])
+        baseline.setdefault("scales", {}).update(results["scales"])
+        with open(args.baseline, "w") as f:
+            json.dump(baseline, f, indent=2)
+        print(f"Recorded baseline {args.baseline}")
+        return
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    if baseline.get("environment") != results["environment"]:
+        print(f"Baseline was recorded on {baseline.get('environment')}, this run is on {results['environment']}")
+    lines, regressed = compare(results, baseline, args.tolerance)
+    for line in lines:
+        print(line)
+    if not lines:
+        print(f"Within {args.tolerance:.0%} of baseline {args.baseline}")
+    sys.exit(1 if regressed else 0)
+
+
+if __name__ == "__main__":
+    main()
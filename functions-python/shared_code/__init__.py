@@ -0,0 +1,3 @@
+"""
+Helpers shared by the DocumentUploadProcessor, DocumentAccessTracker and AIQueryProcessor functions
+"""
@@ -0,0 +1,301 @@
+"""
+Per-document access statistics aggregated from the tracking event blobs.
+
+Each run reads only the `access_logs/` and `queries/` events written since the
+last run (a read offset per telemetry blob, and a last-modified watermark for
+the one-blob-per-event records written before the telemetry writer) and folds
+them into compact arrays: total accesses, last access time and an exponentially decayed access
+score per document, with a half-life of ACCESS_SCORE_HALF_LIFE_DAYS. The
+arithmetic is done with numpy over whole batches of events, so millions of
+events cost one pass over a few arrays. The state is saved as an .npz blob in
+the metadata container.
+"""
+import asyncio
+import io
+import json
+import logging
+import math
+import os
+import time
+from datetime import datetime, timezone
+
+import numpy as np
+from azure.core.exceptions import ResourceNotFoundError
+
+from shared_code import clients, telemetry
+
+STATE_BLOB = "access/stats.npz"
+EVENT_PREFIXES = (telemetry.ACCESS_STREAM, telemetry.QUERY_STREAM)
+
+
+def stats_settings():
+    """Score half-life, promote and demote scores, event blobs read per run and download concurrency"""
+    half_life_days = float(os.environ.get("ACCESS_SCORE_HALF_LIFE_DAYS", "7"))
+    promote_score = float(os.environ.get("PROMOTE_SCORE", "10"))
+    demote_score = float(os.environ.get("DEMOTE_SCORE", "1"))
+    max_event_blobs = int(os.environ.get("ACCESS_MAX_EVENT_BLOBS", "50000"))
+    concurrency = int(os.environ.get("ACCESS_DOWNLOAD_CONCURRENCY", "32"))
+    return half_life_days, promote_score, demote_score, max_event_blobs, concurrency
+
+
+class AccessStats:
+    """Sorted document names with parallel arrays of counts, decayed scores and last access times"""
+
+    def __init__(self, half_life_days=7.0):
+        self.decay_rate = math.log(2) / (half_life_days * 86400)
+        self.names = np.array([], dtype=str)
+        self.counts = np.zeros(0, dtype=np.int64)
+        self.scores = np.zeros(0, dtype=np.float64)
+        self.last_access = np.zeros(0, dtype=np.float64)
+        # Scores are stored as of this time and decayed forward on use
+        self.score_time = 0.0
+        self.watermarks = {}
+        self.offsets = {}
+
+    def add_events(self, names, times, weights=None, now=None):
+        """Fold a batch of (name, epoch time, weight) events into the statistics"""
+        now = time.time() if now is None else now
+        times = np.asarray(times, dtype=np.float64)
+        weights = np.ones(len(times)) if weights is None else np.asarray(weights, dtype=np.float64)
+
+        self._decay_to(now)
+        if len(times) == 0:
+            return
+
+        # Hashing names to ids is far cheaper than sorting millions of strings
+        ids = {}
+        inverse = np.fromiter((ids.setdefault(name, len(ids)) for name in names), dtype=np.int64, count=len(times))
+        unique = np.array(list(ids), dtype=str)
+        self._insert_names(unique)
+        positions = np.searchsorted(self.names, unique)
+
+        # Events in the future (clock skew) count as happening now
+        contributions = weights * np.exp(-self.decay_rate * np.clip(now - times, 0, None))
+        self.scores[positions] += np.bincount(inverse, weights=contributions, minlength=len(unique))
+        self.counts[positions] += np.bincount(inverse, weights=weights, minlength=len(unique)).astype(np.int64)
+
+        latest = np.full(len(unique), -np.inf)
+        np.maximum.at(latest, inverse, times)
+        self.last_access[positions] = np.maximum(self.last_access[positions], latest)
+
+    def decayed_scores(self, now=None):
+        """Scores as of now, without changing the stored state"""
+        now = time.time() if now is None else now
+        return self.scores * math.exp(-self.decay_rate * max(now - self.score_time, 0))
+
+    def top(self, n=10, now=None):
+        scores = self.decayed_scores(now)
+        order = np.argsort(scores)[::-1][:n]
+        return [(str(self.names[i]), float(scores[i]), int(self.counts[i])) for i in order]
+
+    def _decay_to(self, now):
+        if self.score_time and now > self.score_time:
+            self.scores *= math.exp(-self.decay_rate * (now - self.score_time))
+        self.score_time = max(self.score_time, now)
+
+    def _insert_names(self, unique):
+        new = np.setdiff1d(unique, self.names)
+        if len(new) == 0:
+            return
+        names = np.concatenate([self.names, new])
+        order = np.argsort(names, kind="stable")
+        self.names = names[order]
+        self.counts = np.concatenate([self.counts, np.zeros(len(new), dtype=np.int64)])[order]
+        self.scores = np.concatenate([self.scores, np.zeros(len(new))])[order]
+        self.last_access = np.concatenate([self.last_access, np.zeros(len(new))])[order]
+
+    def to_bytes(self):
+        output = io.BytesIO()
+        meta = {"score_time": self.score_time, "watermarks": self.watermarks, "offsets": self.offsets}
+        np.savez_compressed(
+            output, names=self.names, counts=self.counts, scores=self.scores,
+            last_access=self.last_access, meta=np.array(json.dumps(meta))
+        )
+        return output.getvalue()
+
+    @classmethod
+    def from_bytes(cls, data, half_life_days=7.0):
+        stats = cls(half_life_days)
+        with np.load(io.BytesIO(data), allow_pickle=False) as arrays:
+            stats.names = arrays["names"]
+            stats.counts = arrays["counts"]
+            stats.scores = arrays["scores"]
+            stats.last_access = arrays["last_access"]
+            meta = json.loads(str(arrays["meta"]))
+        stats.score_time = meta["score_time"]
+        stats.watermarks = meta["watermarks"]
+        stats.offsets = meta.get("offsets", {})
+        return stats
+
+
+def events_from_record(prefix, record):
+    """(name, epoch time) pairs in one tracking record"""
+    if prefix == telemetry.ACCESS_STREAM:
+        when = _timestamp(record.get("access_time"))
+        return [(record["filename"], when)] * int(record.get("access_count", 1))
+    when = _timestamp(record.get("timestamp"))
+    return [(name, when) for name in record.get("document_names", []) if name]
+
+
+def _timestamp(value):
+    if not value:
+        return time.time()
+    # Tracking records are written with utcnow(), which carries no offset
+    parsed = datetime.fromisoformat(value)
+    return (parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)).timestamp()
+
+
+def update():
+    """Load the statistics, fold in events written since the last run and save them"""
+    return asyncio.run(_update_and_close())
+
+
+async def _update_and_close():
+    try:
+        return await update_async()
+    finally:
+        await clients.close_async_clients()
+
+
+async def update_async():
+    half_life_days, _, _, max_event_blobs, concurrency = stats_settings()
+    blob_service_client = clients.get_async_blob_service_client()
+    container_client = blob_service_client.get_container_client(
+        os.environ.get("METADATA_CONTAINER_NAME", "metadata")
+    )
+
+    try:
+        downloader = await container_client.download_blob(STATE_BLOB)
+        stats = AccessStats.from_bytes(await downloader.readall(), half_life_days)
+    except ResourceNotFoundError:
+        stats = AccessStats(half_life_days)
+
+    start = time.perf_counter()
+    names, times = await read_new_events(
+        container_client, stats.watermarks, stats.offsets, max_event_blobs, concurrency
+    )
+    stats.add_events(names, times)
+    logging.info(
+        f"Aggregated {len(names)} access events for {len(stats.names)} documents "
+        f"in {(time.perf_counter() - start) * 1000:.0f}ms"
+    )
+
+    try:
+        await container_client.upload_blob(STATE_BLOB, stats.to_bytes(), overwrite=True)
+    except ResourceNotFoundError:
+        await container_client.create_container()
+        await container_client.upload_blob(STATE_BLOB, stats.to_bytes(), overwrite=True)
+    return stats
+
+
+async def read_new_events(container_client, watermarks, offsets, max_blobs, concurrency):
+    """
+    Events appended to telemetry blobs past their offsets, and events in
+    per-event blobs modified after each prefix's watermark, oldest first and
+    from at most max_blobs blobs per run. Advances offsets and watermarks in place.
+    """
+    candidates = []
+    listed = set()
+    for prefix in EVENT_PREFIXES:
+        mark = watermarks.get(prefix, {"time": 0, "names": []})
+        seen_at_mark = set(mark["names"])
+        async for blob in container_client.list_blobs(name_starts_with=prefix):
+            modified = blob.last_modified.timestamp()
+            if blob.name.endswith(".jsonl"):
+                listed.add(blob.name)
+                if blob.size > offsets.get(blob.name, 0):
+                    candidates.append((modified, prefix, blob.name, blob.size))
+            # Last-modified has one-second resolution, so blobs at the mark itself are matched by name
+            elif modified > mark["time"] or (modified == mark["time"] and blob.name not in seen_at_mark):
+                candidates.append((modified, prefix, blob.name, None))
+
+    # Offsets of telemetry blobs that have since been removed are no longer needed
+    for name in [name for name in offsets if name not in listed]:
+        del offsets[name]
+
+    candidates.sort()
+    candidates = candidates[:max_blobs]
+    semaphore = asyncio.Semaphore(concurrency)
+    reads = await asyncio.gather(*(
+        _read_blob(container_client, name, offsets.get(name, 0), size, semaphore)
+        for _, _, name, size in candidates
+    ))
+
+    names = []
+    times = []
+    # Prefixes whose watermark stopped at a per-event blob that could not be read
+    stalled = set()
+    for (modified, prefix, name, size), (records, offset) in zip(candidates, reads):
+        if records is None:
+            if size is None:
+                stalled.add(prefix)
+            continue
+        if size is None and prefix in stalled:
+            # Newer than the failed blob, so read again with it next run
+            continue
+
+        for record in records:
+            for event_name, when in events_from_record(prefix, record):
+                names.append(event_name)
+                times.append(when)
+
+        if size is not None:
+            offsets[name] = offset
+            continue
+        mark = watermarks.setdefault(prefix, {"time": 0, "names": []})
+        if modified > mark["time"]:
+            mark["time"], mark["names"] = modified, [name]
+        else:
+            mark["names"].append(name)
+
+    if len(candidates) == max_blobs:
+        logging.info(f"Read {max_blobs} event blobs, the rest are picked up next run")
+    return names, times
+
+
+def is_consumed(stats, prefix, blob):
+    """Whether update() has read every event in an event blob listed under prefix"""
+    if blob.name.endswith(".jsonl"):
+        return stats.offsets.get(blob.name, 0) >= blob.size
+    mark = stats.watermarks.get(prefix, {"time": 0, "names": []})
+    modified = blob.last_modified.timestamp()
+    return modified < mark["time"] or (modified == mark["time"] and blob.name in mark["names"])
+
+
+async def _read_blob(container_client, name, offset, size, semaphore):
+    """
+    (records, new offset): new lines of a telemetry blob, or the single record
+    of a per-event blob. Records are None when the download failed, so the
+    blob is retried next run; a malformed per-event blob is skipped for good.
+    """
+    async with semaphore:
+        try:
+            if size is not None:
+                return await telemetry.read_lines(container_client, name, offset, size)
+            downloader = await container_client.download_blob(name)
+            data = await downloader.readall()
+        except Exception as e:
+            logging.warning(f"Failed to read event blob {name}, retrying next run: {str(e)}")
+            return None, offset
+
+        try:
+            return [json.loads(data)], 0
+        except ValueError:
+            logging.warning(f"Skipping malformed event blob {name}")
+            return [], 0
+
+
+def plan_tier_moves(stats, locations, hot_container, promote_score, demote_score, now=None):
+    """
+    (name, source, target) moves: documents scoring at least promote_score
+    into the hot container, hot documents scoring below demote_score out of it
+    """
+    scores = stats.decayed_scores(now)
+    moves = []
+    for name, score in zip(stats.names.tolist(), scores.tolist()):
+        container = locations.get(name)
+        if container == "documents" and score >= promote_score:
+            moves.append((name, "documents", hot_container))
+        elif container == hot_container and score < demote_score:
+            moves.append((name, hot_container, "documents"))
+    return moves
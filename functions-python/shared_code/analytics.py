@@ -0,0 +1,456 @@
+"""
+Columnar analytics over the query and access events.
+
+The `queries/` and `access_logs/` streams in the metadata container are
+compacted into Parquet, one file per event type and hour, partitioned by date:
+`analytics/{queries|access}/date=YYYY-MM-DD/{YYYYMMDDHH}.parquet`. An hour is
+compacted once it is sealed and the access statistics have read it, and its
+source blobs are deleted afterwards. Each file lists the blobs it was built
+from in its schema metadata, so a run interrupted between writing a file and
+deleting the sources neither loses nor duplicates events when it is repeated.
+Per-event blobs from before the telemetry writer are compacted the same way,
+by the hour they were written in, and once a run finds none left it writes a
+marker so reports stop looking for them.
+
+The reports read only the date partitions in range and, through ranged blob
+reads, only the columns they use. Events not compacted yet are read from
+their telemetry blobs, listed by the hours in range, and from per-event blobs
+still waiting for compaction, so reports are current to the last flush.
+Streams no report reads, such as `traces/`, are only pruned by age.
+"""
+import asyncio
+import io
+import json
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from azure.core.exceptions import ResourceNotFoundError
+
+from shared_code import access_stats, clients, lifecycle, telemetry
+
+ANALYTICS_PREFIX = "analytics/"
+
+# Smallest ranged read; a compacted file under this size is fetched in one request
+READ_BLOCK_BYTES = 1024 * 1024
+TIMESTAMP = pa.timestamp("us", tz="UTC")
+LEGACY_MARKER = "legacy-compacted"
+
+# Event types whose per-event blobs are all compacted, once seen; none are written any more
+_legacy_compacted = set()
+
+EVENT_TYPES = {
+    "queries": {
+        "stream": telemetry.QUERY_STREAM,
+        "time_field": "timestamp",
+        "schema": pa.schema([
+            ("timestamp", TIMESTAMP),
+            ("user_id", pa.string()),
+            ("query", pa.string()),
+            ("documents_found", pa.int32()),
+            ("document_names", pa.list_(pa.string()))
+        ])
+    },
+    "access": {
+        "stream": telemetry.ACCESS_STREAM,
+        "time_field": "access_time",
+        "schema": pa.schema([
+            ("timestamp", TIMESTAMP),
+            ("filename", pa.string()),
+            ("access_type", pa.string()),
+            ("access_count", pa.int32())
+        ])
+    }
+}
+
+
+def analytics_settings():
+    """Event blobs compacted per run and blobs read at once"""
+    max_blobs = int(os.environ.get("COMPACTION_MAX_BLOBS", "20000"))
+    concurrency = int(os.environ.get("ANALYTICS_READ_CONCURRENCY", "16"))
+    return max_blobs, concurrency
+
+
+def _metadata_container_name():
+    return os.environ.get("METADATA_CONTAINER_NAME", "metadata")
+
+
+def legacy_marker_name(event_type):
+    """Blob whose presence records that no per-event blobs of event_type are left to compact"""
+    return f"{ANALYTICS_PREFIX}{event_type}/{LEGACY_MARKER}"
+
+
+def partition_name(event_type, hour):
+    return f"{ANALYTICS_PREFIX}{event_type}/date={hour[:4]}-{hour[4:6]}-{hour[6:8]}/{hour}.parquet"
+
+
+def to_table(event_type, records):
+    """Tracking records as a table in the event type's schema, oldest first"""
+    spec = EVENT_TYPES[event_type]
+    columns = {}
+    for field in spec["schema"]:
+        if field.name == "timestamp":
+            # Tracking records are written with utcnow(), which carries no offset
+            values = pa.array([record.get(spec["time_field"]) for record in records], pa.string())
+            columns[field.name] = pc.cast(values, pa.timestamp("us")).cast(TIMESTAMP)
+        else:
+            columns[field.name] = pa.array([record.get(field.name) for record in records], field.type)
+    return pa.table(columns, schema=spec["schema"]).sort_by("timestamp")
+
+
+def compact(stats):
+    """Compact the event hours that stats has read; returns counts of the work done"""
+    return asyncio.run(_compact_and_close(stats))
+
+
+async def _compact_and_close(stats):
+    try:
+        return await compact_async(stats)
+    finally:
+        await clients.close_async_clients()
+
+
+async def compact_async(stats):
+    max_blobs, concurrency = analytics_settings()
+    container_client = clients.get_async_blob_service_client().get_container_client(_metadata_container_name())
+    result = {"hours": 0, "blobs": 0, "events": 0, "failed": 0}
+
+    groups, legacy_free = await _compactable(container_client, stats, max_blobs)
+    semaphore = asyncio.Semaphore(concurrency)
+    for (event_type, hour), blobs in sorted(groups.items()):
+        try:
+            result["events"] += await _compact_hour(container_client, event_type, hour, blobs, semaphore)
+            result["hours"] += 1
+            result["blobs"] += len(blobs)
+        except Exception as e:
+            # The sources are kept, so the hour is retried next run
+            result["failed"] += 1
+            logging.error(f"Compacting {event_type} events for {hour} failed: {str(e)}")
+
+    # Reports stop scanning for per-event blobs once none are left
+    for event_type in legacy_free - _legacy_compacted:
+        try:
+            await container_client.upload_blob(legacy_marker_name(event_type), b"", overwrite=True)
+            _legacy_compacted.add(event_type)
+        except Exception as e:
+            logging.warning(f"Failed to record that {event_type} per-event blobs are compacted: {str(e)}")
+    return result
+
+
+def prune(stream, retention_days, now=None):
+    """Delete a telemetry stream's hourly blobs older than retention_days; returns (deleted, failed)"""
+    return asyncio.run(_prune_and_close(stream, retention_days, now))
+
+
+async def _prune_and_close(stream, retention_days, now):
+    try:
+        return await prune_async(stream, retention_days, now)
+    finally:
+        await clients.close_async_clients()
+
+
+async def prune_async(stream, retention_days, now=None):
+    container_client = clients.get_async_blob_service_client().get_container_client(_metadata_container_name())
+    cutoff = f"{(now or datetime.now(timezone.utc)) - timedelta(days=retention_days):%Y%m%d%H}"
+    expired = []
+    # Names sort by hour, so the listing stops at the first hour that is kept
+    async for blob in container_client.list_blobs(name_starts_with=stream):
+        hour = telemetry.blob_hour(blob.name, stream)
+        if hour is None:
+            continue
+        if hour >= cutoff:
+            break
+        expired.append(blob.name)
+    return await lifecycle.delete_in_batches(container_client, expired)
+
+
+async def _compactable(container_client, stats, max_blobs):
+    """
+    ({(event type, hour): [blob, ...]} for sealed hours whose events the
+    access statistics have read, event types fully listed without a per-event blob)
+    """
+    groups = {}
+    legacy_free = set()
+    count = 0
+    for event_type, spec in EVENT_TYPES.items():
+        legacy = False
+        async for blob in container_client.list_blobs(name_starts_with=spec["stream"]):
+            if blob.name.endswith(".jsonl"):
+                hour = telemetry.blob_hour(blob.name, spec["stream"])
+            else:
+                legacy = True
+                hour = telemetry.hour_of(blob.last_modified.timestamp())
+            if hour is None or not telemetry.is_sealed(hour):
+                continue
+            if not access_stats.is_consumed(stats, spec["stream"], blob):
+                continue
+            groups.setdefault((event_type, hour), []).append(blob)
+            count += 1
+            if count >= max_blobs:
+                logging.info(f"Compacting {max_blobs} event blobs, the rest are picked up next run")
+                return groups, legacy_free
+        if not legacy:
+            legacy_free.add(event_type)
+    return groups, legacy_free
+
+
+async def _compact_hour(container_client, event_type, hour, blobs, semaphore):
+    """Merge an hour's source blobs into its Parquet file, then delete them; returns the events added"""
+    blob_client = container_client.get_blob_client(partition_name(event_type, hour))
+    existing = None
+    sources = set()
+    try:
+        downloader = await blob_client.download_blob()
+        existing = pq.read_table(io.BytesIO(await downloader.readall()))
+        sources = set(json.loads(existing.schema.metadata.get(b"sources", b"[]")))
+    except ResourceNotFoundError:
+        pass
+
+    # Sources already in the file were compacted by a run that stopped before deleting them
+    new = [blob for blob in blobs if blob.name not in sources]
+    reads = await asyncio.gather(*(_read_source(container_client, blob, semaphore) for blob in new))
+    records = [record for batch in reads for record in batch]
+
+    if new:
+        tables = [to_table(event_type, records)]
+        if existing is not None:
+            tables.append(existing.replace_schema_metadata(None))
+        table = pa.concat_tables(tables).sort_by("timestamp")
+        table = table.replace_schema_metadata({
+            "sources": json.dumps(sorted(sources | {blob.name for blob in new}))
+        })
+        output = io.BytesIO()
+        pq.write_table(table, output, compression="zstd")
+        await blob_client.upload_blob(output.getvalue(), overwrite=True)
+
+    _, failed = await lifecycle.delete_in_batches(container_client, [blob.name for blob in blobs])
+    if failed:
+        logging.warning(f"{failed} compacted {event_type} blobs for {hour} were not deleted, retried next run")
+    return len(records)
+
+
+async def _read_source(container_client, blob, semaphore):
+    async with semaphore:
+        if blob.name.endswith(".jsonl"):
+            records, _ = await telemetry.read_lines(container_client, blob.name, 0, blob.size)
+            return records
+        downloader = await container_client.download_blob(blob.name)
+        try:
+            return [json.loads(await downloader.readall())]
+        except ValueError:
+            logging.warning(f"Skipping malformed event blob {blob.name}")
+            return []
+
+
+class BlobFile(io.RawIOBase):
+    """
+    Read-only, seekable view of a blob that downloads only the byte ranges
+    read, at least READ_BLOCK_BYTES at a time. Reads near the end (the Parquet
+    footer) fetch the whole last block, so a small file costs one request.
+    """
+
+    def __init__(self, blob_client, size):
+        self._blob_client = blob_client
+        self._size = size
+        self._position = 0
+        self._window_start = 0
+        self._window = b""
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self._position = offset
+        elif whence == io.SEEK_CUR:
+            self._position += offset
+        else:
+            self._position = self._size + offset
+        return self._position
+
+    def readinto(self, buffer):
+        length = min(len(buffer), self._size - self._position)
+        if length <= 0:
+            return 0
+        offset = self._position - self._window_start
+        if offset < 0 or offset + length > len(self._window):
+            start = min(self._position, max(0, self._size - READ_BLOCK_BYTES))
+            end = min(self._size, max(self._position + length, start + READ_BLOCK_BYTES))
+            self._window = self._blob_client.download_blob(offset=start, length=end - start).readall()
+            self._window_start = start
+            offset = self._position - start
+        buffer[:length] = self._window[offset:offset + length]
+        self._position += length
+        return length
+
+
+def read_events(event_type, columns, start, end):
+    """
+    Table of timestamp plus columns for events of event_type between start
+    and end (UTC datetimes), from compacted files and uncompacted telemetry blobs
+    """
+    _, concurrency = analytics_settings()
+    spec = EVENT_TYPES[event_type]
+    container_client = clients.get_blob_service_client().get_container_client(_metadata_container_name())
+    days = [start.date() + timedelta(days=i) for i in range((end.date() - start.date()).days + 1)]
+    first_hour, last_hour = start.strftime("%Y%m%d%H"), end.strftime("%Y%m%d%H")
+
+    # Partition pruning: only the dates, and within them the hours, in range
+    files = [
+        blob for day in days
+        for blob in container_client.list_blobs(name_starts_with=f"{ANALYTICS_PREFIX}{event_type}/date={day:%Y-%m-%d}/")
+        if first_hour <= blob.name.rsplit("/", 1)[-1][:10] <= last_hour
+    ]
+    with ThreadPoolExecutor(max(1, concurrency)) as pool:
+        # Telemetry blobs not compacted yet, listed only under the hours in range
+        listings = pool.map(
+            lambda prefix: [blob for blob in container_client.list_blobs(name_starts_with=prefix)
+                            if blob.name.endswith(".jsonl")],
+            raw_prefixes(spec["stream"], start, end)
+        )
+        raw = [blob for listing in listings for blob in listing]
+        raw.extend(_legacy_blobs(container_client, event_type, start, end))
+
+        compacted = list(pool.map(lambda blob: _read_parquet(container_client, blob, ["timestamp"] + columns), files))
+        sources = set().union(*(file_sources for _, file_sources in compacted))
+        # A blob that is both compacted and still listed is only waiting to be deleted
+        raw = [blob for blob in raw if blob.name not in sources]
+        raw_records = list(pool.map(lambda blob: _read_raw(container_client, blob), raw))
+
+    records = [record for batch in raw_records for record in batch]
+    tables = [table for table, _ in compacted]
+    if records:
+        tables.append(to_table(event_type, records).select(["timestamp"] + columns))
+    if not tables:
+        return spec["schema"].empty_table().select(["timestamp"] + columns)
+
+    table = pa.concat_tables(tables)
+    in_range = pc.and_(
+        pc.greater_equal(table["timestamp"], pa.scalar(start, TIMESTAMP)),
+        pc.less(table["timestamp"], pa.scalar(end, TIMESTAMP))
+    )
+    return table.filter(in_range)
+
+
+def raw_prefixes(stream, start, end):
+    """Name prefixes of the telemetry blobs between start and end: whole days, and single hours at either end"""
+    prefixes = []
+    hour = start.replace(minute=0, second=0, microsecond=0)
+    while hour <= end:
+        if hour.hour == 0 and hour + timedelta(days=1) <= end:
+            prefixes.append(f"{stream}{hour:%Y%m%d}")
+            hour += timedelta(days=1)
+        else:
+            prefixes.append(f"{stream}{hour:%Y%m%d%H}")
+            hour += timedelta(hours=1)
+    return prefixes
+
+
+def _legacy_blobs(container_client, event_type, start, end):
+    """
+    Per-event blobs from before the telemetry writer written between start
+    and end. They are not partitioned, so finding them lists the whole
+    stream; once compaction has found none left the scan is skipped.
+    """
+    if event_type in _legacy_compacted:
+        return []
+    try:
+        container_client.get_blob_client(legacy_marker_name(event_type)).get_blob_properties()
+        _legacy_compacted.add(event_type)
+        return []
+    except ResourceNotFoundError:
+        pass
+
+    # Written just after their event, so when they were written bounds the event time
+    latest = end + timedelta(seconds=telemetry.SEAL_SECONDS)
+    return [
+        blob for blob in container_client.list_blobs(name_starts_with=EVENT_TYPES[event_type]["stream"])
+        if blob.name.endswith(".json") and start <= blob.last_modified <= latest
+    ]
+
+
+def _read_raw(container_client, blob):
+    """Records of one uncompacted blob: JSON Lines, or a single event in a per-event blob"""
+    data = container_client.download_blob(blob.name).readall()
+    if blob.name.endswith(".jsonl"):
+        return [json.loads(line) for line in data.splitlines() if line.strip()]
+    try:
+        return [json.loads(data)]
+    except ValueError:
+        logging.warning(f"Skipping malformed event blob {blob.name}")
+        return []
+
+
+def _read_parquet(container_client, blob, columns):
+    """(table of columns, source blob names) for one compacted file"""
+    parquet = pq.ParquetFile(BlobFile(container_client.get_blob_client(blob.name), blob.size))
+    sources = json.loads((parquet.schema_arrow.metadata or {}).get(b"sources", b"[]"))
+    return parquet.read(columns=columns), sources
+
+
+def time_range(days, now=None):
+    """(start, end) covering the last days days up to now, as UTC datetimes"""
+    end = now or datetime.now(timezone.utc)
+    return end - timedelta(days=days), end
+
+
+def top_documents(days=7, limit=10, now=None):
+    """Most used documents: direct accesses plus retrievals in queries, as [(name, count)]"""
+    start, end = time_range(days, now)
+    counts = {}
+
+    access = read_events("access", ["filename", "access_count"], start, end)
+    totals = access.group_by("filename").aggregate([("access_count", "sum")])
+    for name, count in zip(totals["filename"].to_pylist(), totals["access_count_sum"].to_pylist()):
+        if name:
+            counts[name] = counts.get(name, 0) + (count or 0)
+
+    queries = read_events("queries", ["document_names"], start, end)
+    retrieved = pc.value_counts(pc.list_flatten(queries["document_names"]))
+    for item in retrieved.to_pylist():
+        if item["values"]:
+            counts[item["values"]] = counts.get(item["values"], 0) + item["counts"]
+
+    return sorted(counts.items(), key=lambda item: (-item[1], item[0]))[:limit]
+
+
+def queries_per_user(days=7, limit=None, now=None):
+    """Query count per user, busiest first, as [(user_id, count)]"""
+    start, end = time_range(days, now)
+    queries = read_events("queries", ["user_id"], start, end)
+    counts = queries.group_by("user_id").aggregate([([], "count_all")])
+    result = sorted(
+        zip(counts["user_id"].to_pylist(), counts["count_all"].to_pylist()),
+        key=lambda item: (-item[1], item[0] or "")
+    )
+    return result[:limit] if limit else result
+
+
+def zero_result_queries(days=7, limit=10, now=None):
+    """Most frequent queries that found no documents, as [(query, count)]"""
+    start, end = time_range(days, now)
+    queries = read_events("queries", ["query", "documents_found"], start, end)
+    empty = queries.filter(pc.equal(queries["documents_found"], 0))
+    counts = empty.group_by("query").aggregate([([], "count_all")])
+    result = sorted(
+        zip(counts["query"].to_pylist(), counts["count_all"].to_pylist()),
+        key=lambda item: (-item[1], item[0] or "")
+    )
+    return result[:limit]
+
+
+REPORTS = {
+    "top_documents": top_documents,
+    "queries_per_user": queries_per_user,
+    "zero_result_queries": zero_result_queries
+}
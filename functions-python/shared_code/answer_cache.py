@@ -0,0 +1,379 @@
+"""
+Answer cache for AIQueryProcessor.
+
+Entries are keyed on the normalised query plus the retrieved document set and
+each document's version (its upload date), so re-indexed documents never serve
+an old answer. A near-duplicate tier compares query embeddings among entries
+built from the same document set. Backends: in-process memory, a local SQLite
+file, or any Redis-compatible server. Async callers reach a cache through
+offload, which moves redis round trips off the event loop.
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import re
+import sqlite3
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_answer_cache():
+    """Return the process-wide answer cache configured from the environment, or None if disabled"""
+    global _cache
+    backend_name = os.environ.get("ANSWER_CACHE_BACKEND", "memory").lower()
+    if backend_name == "none":
+        return None
+
+    if _cache is None or _cache.backend_name != backend_name:
+        with _cache_lock:
+            if _cache is None or _cache.backend_name != backend_name:
+                _cache = AnswerCache(
+                    build_backend(backend_name),
+                    backend_name,
+                    ttl_seconds=int(os.environ.get("ANSWER_CACHE_TTL_SECONDS", "3600")),
+                    similarity_threshold=float(os.environ.get("ANSWER_CACHE_SIMILARITY", "0.95"))
+                )
+    return _cache
+
+
+async def offload(cache, function, *args):
+    """Await function(*args) from async code, on a worker thread when the cache's backend makes network calls"""
+    if cache is not None and cache.backend_name == "redis":
+        return await asyncio.to_thread(function, *args)
+    return function(*args)
+
+
+def build_backend(backend_name, prefix="ANSWER_CACHE"):
+    """Create the storage backend named by {prefix}_BACKEND, configured from the other {prefix}_ settings"""
+    max_entries = int(os.environ.get(f"{prefix}_MAX_ENTRIES", "1000"))
+
+    if backend_name == "memory":
+        return MemoryBackend(max_entries)
+    if backend_name == "file":
+        default_path = os.path.join(tempfile.gettempdir(), f"{prefix.lower()}.sqlite3")
+        return FileBackend(os.environ.get(f"{prefix}_FILE", default_path), max_entries)
+    if backend_name == "redis":
+        return RedisBackend(os.environ.get(f"{prefix}_REDIS_URL", "redis://localhost:6379/0"))
+    raise ValueError(f"Unknown cache backend: {backend_name}")
+
+
+def normalize_query(query):
+    """Lowercase, collapse whitespace and drop trailing punctuation"""
+    query = re.sub(r"\s+", " ", query.strip().lower())
+    return query.rstrip("?!. ")
+
+
+def document_versions(relevant_docs):
+    """Sorted (filename, version) pairs the answer depends on"""
+    return sorted({(doc.get("filename", ""), str(doc.get("upload_date", ""))) for doc in relevant_docs})
+
+
+def _digest(*parts):
+    return hashlib.sha256("\x1f".join(parts).encode("utf-8")).hexdigest()
+
+
+def _cosine_similarity(a, b):
+    dot = sum(x * y for x, y in zip(a, b))
+    norm_a = sum(x * x for x in a) ** 0.5
+    norm_b = sum(y * y for y in b) ** 0.5
+    if not norm_a or not norm_b:
+        return 0.0
+    return dot / (norm_a * norm_b)
+
+
+class AnswerCache:
+    """Exact-match and near-duplicate answer lookup on top of a storage backend"""
+
+    def __init__(self, backend, backend_name, ttl_seconds=3600, similarity_threshold=0.95):
+        self.backend = backend
+        self.backend_name = backend_name
+        self.ttl_seconds = ttl_seconds
+        self.similarity_threshold = similarity_threshold
+        self._stats = {"exact_hits": 0, "near_hits": 0, "misses": 0, "latency_saved_ms": 0.0}
+        self._stats_lock = threading.Lock()
+
+    def lookup(self, query, relevant_docs, query_embedding=None):
+        """Return the cached entry for this query and document set, or None"""
+        try:
+            versions = document_versions(relevant_docs)
+            signature = _digest(*(f"{name}@{version}" for name, version in versions))
+
+            entry = self.backend.get(self._entry_key(query, signature))
+            if entry is not None:
+                return self._hit("exact_hits", entry)
+
+            if query_embedding is not None:
+                entry = self._nearest(signature, query_embedding)
+                if entry is not None:
+                    return self._hit("near_hits", entry)
+
+        except Exception as e:
+            logging.warning(f"Answer cache lookup failed: {str(e)}")
+
+        self._count("misses")
+        return None
+
+    def store(self, query, relevant_docs, response, generation_ms, query_embedding=None):
+        """Cache a generated answer and record which documents it depends on"""
+        try:
+            versions = document_versions(relevant_docs)
+            signature = _digest(*(f"{name}@{version}" for name, version in versions))
+            key = self._entry_key(query, signature)
+
+            entry = {
+                "query": normalize_query(query),
+                "response": response,
+                "documents": [name for name, _ in versions],
+                "embedding": query_embedding,
+                "generation_ms": generation_ms,
+                "created": time.time()
+            }
+            self.backend.set(key, entry, self.ttl_seconds)
+            self.backend.add_member(f"signature:{signature}", key, self.ttl_seconds)
+            for name, _ in versions:
+                self.backend.add_member(f"document:{name}", key, self.ttl_seconds)
+
+        except Exception as e:
+            logging.warning(f"Answer cache store failed: {str(e)}")
+
+    def invalidate_document(self, filename):
+        """Drop every cached answer built from filename"""
+        try:
+            keys = self.backend.members(f"document:{filename}")
+            if keys:
+                self.backend.delete(*keys)
+            self.backend.delete(f"document:{filename}")
+            logging.info(f"Invalidated {len(keys)} cached answers for {filename}")
+        except Exception as e:
+            logging.warning(f"Answer cache invalidation failed for {filename}: {str(e)}")
+
+    def metrics(self):
+        """Hit rate and generation time saved by this process"""
+        with self._stats_lock:
+            stats = dict(self._stats)
+        lookups = stats["exact_hits"] + stats["near_hits"] + stats["misses"]
+        stats["hit_rate"] = (stats["exact_hits"] + stats["near_hits"]) / lookups if lookups else 0.0
+        return stats
+
+    def _entry_key(self, query, signature):
+        return "answer:" + _digest(normalize_query(query), signature)
+
+    def _nearest(self, signature, query_embedding):
+        """Best cached entry for the same document set whose query embedding is similar enough"""
+        best, best_score = None, self.similarity_threshold
+        for key in self.backend.members(f"signature:{signature}"):
+            entry = self.backend.get(key)
+            if entry is None or not entry.get("embedding"):
+                continue
+            score = _cosine_similarity(query_embedding, entry["embedding"])
+            if score >= best_score:
+                best, best_score = entry, score
+        return best
+
+    def _hit(self, tier, entry):
+        with self._stats_lock:
+            self._stats[tier] += 1
+            self._stats["latency_saved_ms"] += entry.get("generation_ms", 0.0)
+        return entry
+
+    def _count(self, name):
+        with self._stats_lock:
+            self._stats[name] += 1
+
+
+class MemoryBackend:
+    """In-process LRU store with per-entry expiry"""
+
+    def __init__(self, max_entries=1000):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._sets = {}
+        # Entry key -> the sets it belongs to, so members leave with their entry
+        self._memberships = {}
+        # Counters are never evicted
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._entries.get(key)
+            if item is None:
+                return None
+            value, expires = item
+            if expires < time.time():
+                del self._entries[key]
+                self._forget(key)
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl_seconds):
+        with self._lock:
+            self._entries[key] = (value, time.time() + ttl_seconds)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                evicted, _ = self._entries.popitem(last=False)
+                self._forget(evicted)
+
+    def delete(self, *keys):
+        with self._lock:
+            for key in keys:
+                if self._entries.pop(key, None) is not None:
+                    self._forget(key)
+                self._sets.pop(key, None)
+
+    def add_member(self, set_key, member, ttl_seconds):
+        with self._lock:
+            # Members are entry keys; one already evicted is not worth tracking
+            if member not in self._entries:
+                return
+            self._sets.setdefault(set_key, set()).add(member)
+            self._memberships.setdefault(member, set()).add(set_key)
+
+    def members(self, set_key):
+        with self._lock:
+            members = self._sets.get(set_key, set())
+            # Expired entries stay listed until read, evicted or deleted
+            members.intersection_update(self._entries)
+            return list(members)
+
+    def _forget(self, key):
+        """Remove an evicted, expired or deleted entry from its sets, dropping sets left empty"""
+        for set_key in self._memberships.pop(key, ()):
+            members = self._sets.get(set_key)
+            if members is None:
+                continue
+            members.discard(key)
+            if not members:
+                del self._sets[set_key]
+
+    def incr(self, key):
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + 1
+            return self._counters[key]
+
+    def counter(self, key):
+        with self._lock:
+            return self._counters.get(key, 0)
+
+
+class FileBackend:
+    """SQLite file store, shared by the worker processes of one instance but not across instances"""
+
+    def __init__(self, path, max_entries=1000):
+        self.path = path
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False, timeout=5)
+        with self._connection:
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS entries "
+                "(key TEXT PRIMARY KEY, value TEXT, expires REAL, last_used REAL)"
+            )
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS members "
+                "(set_key TEXT, member TEXT, PRIMARY KEY (set_key, member))"
+            )
+            self._connection.execute("CREATE TABLE IF NOT EXISTS counters (key TEXT PRIMARY KEY, value INTEGER)")
+
+    def get(self, key):
+        now = time.time()
+        with self._lock, self._connection:
+            row = self._connection.execute(
+                "SELECT value FROM entries WHERE key = ? AND expires >= ?", (key, now)
+            ).fetchone()
+            if row is None:
+                return None
+            self._connection.execute("UPDATE entries SET last_used = ? WHERE key = ?", (now, key))
+            return json.loads(row[0])
+
+    def set(self, key, value, ttl_seconds):
+        now = time.time()
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO entries (key, value, expires, last_used) VALUES (?, ?, ?, ?)",
+                (key, json.dumps(value), now + ttl_seconds, now)
+            )
+            self._connection.execute("DELETE FROM entries WHERE expires < ?", (now,))
+            self._connection.execute(
+                "DELETE FROM entries WHERE key IN (SELECT key FROM entries ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,)
+            )
+            # Set members go with the entries expired or evicted above
+            self._connection.execute("DELETE FROM members WHERE member NOT IN (SELECT key FROM entries)")
+
+    def delete(self, *keys):
+        with self._lock, self._connection:
+            for key in keys:
+                self._connection.execute("DELETE FROM entries WHERE key = ?", (key,))
+                self._connection.execute("DELETE FROM members WHERE set_key = ?", (key,))
+
+    def add_member(self, set_key, member, ttl_seconds):
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT OR IGNORE INTO members (set_key, member) VALUES (?, ?)", (set_key, member)
+            )
+
+    def members(self, set_key):
+        with self._lock, self._connection:
+            self._connection.execute(
+                "DELETE FROM members WHERE set_key = ? AND member NOT IN (SELECT key FROM entries)", (set_key,)
+            )
+            rows = self._connection.execute("SELECT member FROM members WHERE set_key = ?", (set_key,))
+            return [row[0] for row in rows]
+
+    def incr(self, key):
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT INTO counters (key, value) VALUES (?, 1) ON CONFLICT(key) DO UPDATE SET value = value + 1",
+                (key,)
+            )
+            return self._connection.execute("SELECT value FROM counters WHERE key = ?", (key,)).fetchone()[0]
+
+    def counter(self, key):
+        with self._lock, self._connection:
+            row = self._connection.execute("SELECT value FROM counters WHERE key = ?", (key,)).fetchone()
+            return row[0] if row else 0
+
+
+class RedisBackend:
+    """Redis-compatible store; eviction follows the server's maxmemory-policy (use allkeys-lru)"""
+
+    def __init__(self, url):
+        # Imported here so redis is only needed when this backend is selected
+        import redis
+        self._redis = redis.Redis.from_url(url)
+
+    def get(self, key):
+        value = self._redis.get(key)
+        return json.loads(value) if value is not None else None
+
+    def set(self, key, value, ttl_seconds):
+        self._redis.set(key, json.dumps(value), ex=ttl_seconds)
+
+    def delete(self, *keys):
+        if keys:
+            self._redis.delete(*keys)
+
+    def add_member(self, set_key, member, ttl_seconds):
+        pipeline = self._redis.pipeline()
+        pipeline.sadd(set_key, member)
+        pipeline.expire(set_key, ttl_seconds)
+        pipeline.execute()
+
+    def members(self, set_key):
+        return [member.decode("utf-8") for member in self._redis.smembers(set_key)]
+
+    def incr(self, key):
+        return self._redis.incr(key)
+
+    def counter(self, key):
+        value = self._redis.get(key)
+        return int(value) if value is not None else 0
@@ -0,0 +1,59 @@
+"""
+Split extracted document text into overlapping chunks for search indexing.
+"""
+import hashlib
+import os
+
+
+def chunk_settings():
+    """Chunk size and overlap in characters, from the environment"""
+    chunk_size = int(os.environ.get("CHUNK_SIZE_CHARS", "2000"))
+    overlap = int(os.environ.get("CHUNK_OVERLAP_CHARS", "200"))
+    return chunk_size, min(overlap, chunk_size // 2)
+
+
+def parent_key(filename):
+    """Search key shared by every chunk of a file (search keys cannot contain dots or slashes)"""
+    return hashlib.sha1(filename.encode("utf-8")).hexdigest()
+
+
+def chunk_key(filename, chunk_index):
+    return f"{parent_key(filename)}-{chunk_index}"
+
+
+def iter_chunks(text, chunk_size=None, overlap=None):
+    """
+    Yield overlapping chunks of text, cut on whitespace where possible.
+    text may be a string or an iterable of string pieces, so a document never
+    has to be held in memory more than one chunk at a time.
+    """
+    default_size, default_overlap = chunk_settings()
+    chunk_size = chunk_size or default_size
+    overlap = default_overlap if overlap is None else overlap
+
+    pieces = [text] if isinstance(text, str) else text
+    buffer = ""
+    start = 0
+    pending = False
+    for piece in pieces:
+        # Offsets into the buffer avoid re-copying a large piece for every chunk
+        buffer = buffer[start:] + piece
+        start = 0
+        pending = pending or bool(piece)
+        while len(buffer) - start >= chunk_size:
+            cut = _cut_point(buffer, start, chunk_size, overlap)
+            yield buffer[start:cut].strip()
+            start = cut - overlap
+            pending = len(buffer) - start > overlap
+
+    if pending and buffer[start:].strip():
+        yield buffer[start:].strip()
+
+
+def _cut_point(buffer, start, chunk_size, overlap):
+    """Last whitespace in the second half of the chunk, or a hard cut at chunk_size"""
+    end = start + chunk_size
+    cut = max(buffer.rfind(" ", start + chunk_size // 2, end), buffer.rfind("\n", start + chunk_size // 2, end))
+    if cut <= start + overlap:
+        cut = end
+    return cut
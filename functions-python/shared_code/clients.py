@@ -0,0 +1,317 @@
+import asyncio
+import logging
+import os
+import socket
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+from azure.core.credentials import AzureKeyCredential
+from azure.core.pipeline.transport import RequestsTransport
+from azure.storage.blob import BlobServiceClient
+
+# The search, OpenAI and aio SDKs are imported when their first client is
+# built, so a function only loads the SDKs it calls
+
+OPENAI_API_VERSION = "2024-02-15-preview"
+
+# One entry per client name: (config, client). A client is rebuilt when the
+# settings it was created from change, e.g. after a key rotation.
+_clients = {}
+_lock = threading.Lock()
+# aio clients replaced after a configuration change, as (loop, client); other
+# invocations may still be using them, so they are closed with their loop
+_retired = []
+
+
+def pool_settings():
+    """Read connection pool settings from the environment"""
+    pool_size = int(os.environ.get("AZURE_HTTP_POOL_SIZE", "20"))
+    keepalive_seconds = int(os.environ.get("AZURE_HTTP_KEEPALIVE_SECONDS", "120"))
+    timeout_seconds = float(os.environ.get("AZURE_HTTP_TIMEOUT_SECONDS", "60"))
+    return pool_size, keepalive_seconds, timeout_seconds
+
+
+def get_blob_service_client():
+    """Return the pooled BlobServiceClient for STORAGE_CONNECTION_STRING"""
+    connection_string = os.environ.get("STORAGE_CONNECTION_STRING")
+    settings = pool_settings()
+
+    def build():
+        return BlobServiceClient.from_connection_string(
+            connection_string,
+            transport=_requests_transport(settings)
+        )
+
+    return _get_or_build("blob", (connection_string, settings), build)
+
+
+def get_search_client(index_name="documents"):
+    """Return the pooled SearchClient for an index, or None if search is not configured"""
+    endpoint = os.environ.get("SEARCH_ENDPOINT")
+    key = os.environ.get("SEARCH_API_KEY")
+
+    if not endpoint or not key:
+        return None
+
+    settings = pool_settings()
+
+    def build():
+        from azure.search.documents import SearchClient
+        return SearchClient(
+            endpoint=endpoint,
+            index_name=index_name,
+            credential=AzureKeyCredential(key),
+            transport=_requests_transport(settings)
+        )
+
+    return _get_or_build(f"search:{index_name}", (endpoint, key, settings), build)
+
+
+def get_openai_client():
+    """Return the pooled AzureOpenAI client, or None if OpenAI is not configured"""
+    endpoint = os.environ.get("OPENAI_ENDPOINT")
+    key = os.environ.get("OPENAI_API_KEY")
+
+    if not endpoint or not key:
+        return None
+
+    settings = pool_settings()
+
+    def build():
+        from openai import AzureOpenAI
+        return AzureOpenAI(
+            azure_endpoint=endpoint,
+            api_key=key,
+            api_version=OPENAI_API_VERSION,
+            http_client=_httpx_client(settings)
+        )
+
+    return _get_or_build("openai", (endpoint, key, settings), build)
+
+
+def get_form_recognizer_client():
+    """Return the cached FormRecognizerClient, or None if Form Recognizer is not configured"""
+    endpoint = os.environ.get("FORM_RECOGNIZER_ENDPOINT")
+    key = os.environ.get("FORM_RECOGNIZER_KEY")
+
+    if not endpoint or not key:
+        return None
+
+    def build():
+        # Imported here so the query and lifecycle functions don't pay for it
+        from azure.cognitiveservices.vision.formrecognizer import FormRecognizerClient
+        return FormRecognizerClient(endpoint, AzureKeyCredential(key))
+
+    return _get_or_build("form_recognizer", (endpoint, key), build)
+
+
+def get_async_blob_service_client():
+    """Return the pooled aio BlobServiceClient for the running event loop"""
+    connection_string = os.environ.get("STORAGE_CONNECTION_STRING")
+    settings = pool_settings()
+
+    def build():
+        from azure.storage.blob.aio import BlobServiceClient as AsyncBlobServiceClient
+        return AsyncBlobServiceClient.from_connection_string(
+            connection_string,
+            transport=_aiohttp_transport(settings)
+        )
+
+    return _get_or_build("aio:blob", (connection_string, settings, _running_loop()), build)
+
+
+def get_async_search_client(index_name="documents"):
+    """Return the pooled aio SearchClient for the running event loop, or None if search is not configured"""
+    endpoint = os.environ.get("SEARCH_ENDPOINT")
+    key = os.environ.get("SEARCH_API_KEY")
+
+    if not endpoint or not key:
+        return None
+
+    settings = pool_settings()
+
+    def build():
+        from azure.search.documents.aio import SearchClient as AsyncSearchClient
+        return AsyncSearchClient(
+            endpoint=endpoint,
+            index_name=index_name,
+            credential=AzureKeyCredential(key),
+            transport=_aiohttp_transport(settings)
+        )
+
+    return _get_or_build(f"aio:search:{index_name}", (endpoint, key, settings, _running_loop()), build)
+
+
+def get_async_openai_client(max_retries=None):
+    """
+    Return the pooled AsyncAzureOpenAI client for the running event loop, or
+    None if OpenAI is not configured. max_retries overrides the SDK's retries,
+    e.g. 0 when the caller retries itself.
+    """
+    endpoint = os.environ.get("OPENAI_ENDPOINT")
+    key = os.environ.get("OPENAI_API_KEY")
+
+    if not endpoint or not key:
+        return None
+
+    settings = pool_settings()
+
+    def build():
+        from openai import AsyncAzureOpenAI
+        options = {} if max_retries is None else {"max_retries": max_retries}
+        return AsyncAzureOpenAI(
+            azure_endpoint=endpoint,
+            api_key=key,
+            api_version=OPENAI_API_VERSION,
+            http_client=_async_httpx_client(settings),
+            **options
+        )
+
+    name = "aio:openai" if max_retries is None else f"aio:openai:retries={max_retries}"
+    return _get_or_build(name, (endpoint, key, settings, _running_loop()), build)
+
+
+async def close_async_clients():
+    """Close the aio clients created on the running loop, e.g. before the loop shuts down"""
+    loop = _running_loop()
+    with _lock:
+        names = [name for name, (config, _) in _clients.items() if name.startswith("aio:") and config[-1] is loop]
+        closing = [_clients.pop(name)[1] for name in names]
+        closing.extend(client for client_loop, client in _retired if client_loop is loop)
+        _retired[:] = [(client_loop, client) for client_loop, client in _retired if client_loop is not loop]
+
+    for client in closing:
+        await client.close()
+
+
+def reset_clients():
+    """Drop every cached client so the next call builds fresh ones"""
+    with _lock:
+        _clients.clear()
+
+
+def _get_or_build(name, config, factory):
+    """Return the cached client for name, building it if missing or its config changed"""
+    entry = _clients.get(name)
+    if entry is not None and entry[0] == config:
+        return entry[1]
+
+    with _lock:
+        entry = _clients.get(name)
+        if entry is not None and entry[0] == config:
+            return entry[1]
+
+        if entry is not None:
+            logging.info(f"Configuration changed, rebuilding {name} client")
+            if name.startswith("aio:"):
+                _retire(entry[0][-1], entry[1])
+
+        client = factory()
+        _clients[name] = (config, client)
+        return client
+
+
+def _retire(loop, client):
+    """
+    Keep a replaced aio client for close_async_clients on its loop, since other
+    invocations may still hold it. One whose loop already finished can no
+    longer be closed cleanly, which close_async_clients should have done.
+    """
+    if loop is not None and not loop.is_closed():
+        _retired.append((loop, client))
+    else:
+        logging.warning(f"{type(client).__name__} outlived its event loop without close_async_clients")
+
+
+def _requests_transport(settings):
+    """Build an azure-core transport backed by a pooled requests session"""
+    pool_size, keepalive_seconds, timeout_seconds = settings
+
+    session = requests.Session()
+    adapter = _KeepAliveAdapter(
+        keepalive_seconds,
+        pool_connections=pool_size,
+        pool_maxsize=pool_size
+    )
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+
+    return RequestsTransport(
+        session=session,
+        session_owner=False,
+        connection_timeout=timeout_seconds,
+        read_timeout=timeout_seconds
+    )
+
+
+def _httpx_client(settings):
+    """Build a pooled httpx client for the OpenAI SDK"""
+    import httpx
+    pool_size, keepalive_seconds, timeout_seconds = settings
+
+    return httpx.Client(
+        limits=httpx.Limits(
+            max_connections=pool_size,
+            max_keepalive_connections=pool_size,
+            keepalive_expiry=keepalive_seconds
+        ),
+        timeout=timeout_seconds
+    )
+
+
+def _aiohttp_transport(settings):
+    """Build an azure-core aio transport backed by a pooled aiohttp session"""
+    import aiohttp
+    from azure.core.pipeline.transport import AioHttpTransport
+    pool_size, keepalive_seconds, timeout_seconds = settings
+
+    session = aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit=pool_size, keepalive_timeout=keepalive_seconds),
+        timeout=aiohttp.ClientTimeout(total=timeout_seconds)
+    )
+    # Owning the session lets close_async_clients release its connections
+    return AioHttpTransport(session=session, session_owner=True)
+
+
+def _async_httpx_client(settings):
+    """Build a pooled async httpx client for the OpenAI SDK"""
+    import httpx
+    pool_size, keepalive_seconds, timeout_seconds = settings
+
+    return httpx.AsyncClient(
+        limits=httpx.Limits(
+            max_connections=pool_size,
+            max_keepalive_connections=pool_size,
+            keepalive_expiry=keepalive_seconds
+        ),
+        timeout=timeout_seconds
+    )
+
+
+def _running_loop():
+    """aio clients are bound to the loop they were created on, so the loop is part of their config"""
+    return asyncio.get_running_loop()
+
+
+def _tcp_keepalive_options(keepalive_seconds):
+    """TCP keep-alive socket options so idle pooled sockets are not dropped by NAT"""
+    options = [(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)]
+    if hasattr(socket, "TCP_KEEPIDLE"):
+        options.append((socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, keepalive_seconds))
+    if hasattr(socket, "TCP_KEEPINTVL"):
+        options.append((socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, max(1, keepalive_seconds // 4)))
+    return options
+
+
+class _KeepAliveAdapter(HTTPAdapter):
+    """HTTPAdapter that enables TCP keep-alive on pooled connections"""
+
+    def __init__(self, keepalive_seconds, **kwargs):
+        self.keepalive_seconds = keepalive_seconds
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        from urllib3.connection import HTTPConnection
+        kwargs["socket_options"] = HTTPConnection.default_socket_options + _tcp_keepalive_options(self.keepalive_seconds)
+        super().init_poolmanager(*args, **kwargs)
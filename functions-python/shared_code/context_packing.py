@@ -0,0 +1,156 @@
+"""
+Token-budget-aware context builder for AIQueryProcessor.
+
+Documents are split into passages, passages are scored against the query and
+packed greedily by score until the token budget is spent. Repeated passages
+(boilerplate, headers, the same text in several documents) are sent once.
+"""
+import hashlib
+import logging
+import os
+import re
+import threading
+import time
+
+_encoding = None
+_encoding_lock = threading.Lock()
+
+_WORD = re.compile(r"\w{3,}")
+
+
+def get_encoding():
+    """Load the GPT-4 tokenizer once per process, or None if it is unavailable"""
+    global _encoding
+    if _encoding is None:
+        with _encoding_lock:
+            if _encoding is None:
+                try:
+                    import tiktoken
+                    _encoding = tiktoken.get_encoding("cl100k_base")
+                except Exception as e:
+                    # Without the tokenizer fall back to the ~4 characters per token rule
+                    logging.warning(f"Tokenizer unavailable, estimating token counts: {str(e)}")
+                    _encoding = False
+    return _encoding or None
+
+
+def count_tokens(text):
+    """Number of model tokens in text"""
+    encoding = get_encoding()
+    if encoding is None:
+        return (len(text) + 3) // 4
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def split_passages(content, max_tokens):
+    """Split content into paragraph passages of at most max_tokens tokens"""
+    passages = []
+    for paragraph in re.split(r"\n\s*\n", content):
+        paragraph = paragraph.strip()
+        if not paragraph:
+            continue
+
+        tokens = count_tokens(paragraph)
+        if tokens <= max_tokens:
+            passages.append((paragraph, tokens))
+            continue
+
+        # Long paragraphs are cut on sentence boundaries where possible
+        current, current_tokens = [], 0
+        for sentence in re.split(r"(?<=[.!?])\s+", paragraph):
+            sentence_tokens = count_tokens(sentence)
+            if current and current_tokens + sentence_tokens > max_tokens:
+                passages.append((" ".join(current), current_tokens))
+                current, current_tokens = [], 0
+            if sentence_tokens > max_tokens:
+                passages.extend(_split_by_tokens(sentence, max_tokens))
+                continue
+            current.append(sentence)
+            current_tokens += sentence_tokens
+        if current:
+            passages.append((" ".join(current), current_tokens))
+
+    return passages
+
+
+def _split_by_tokens(text, max_tokens):
+    encoding = get_encoding()
+    if encoding is None:
+        size = max_tokens * 4
+        return [(text[i:i + size], count_tokens(text[i:i + size])) for i in range(0, len(text), size)]
+
+    tokens = encoding.encode(text, disallowed_special=())
+    return [
+        (encoding.decode(tokens[i:i + max_tokens]), len(tokens[i:i + max_tokens]))
+        for i in range(0, len(tokens), max_tokens)
+    ]
+
+
+def pack_context(query, relevant_docs, token_budget=None, passage_tokens=None):
+    """
+    Build the document context for the prompt within token_budget tokens.
+    Returns the context string and a dict of packing statistics.
+    """
+    start = time.perf_counter()
+    if token_budget is None:
+        token_budget = int(os.environ.get("CONTEXT_TOKEN_BUDGET", "2000"))
+    if passage_tokens is None:
+        passage_tokens = int(os.environ.get("CONTEXT_PASSAGE_TOKENS", "200"))
+
+    query_terms = set(_WORD.findall(query.lower()))
+    max_score = max((doc.get("score") or 0 for doc in relevant_docs), default=0) or 1.0
+
+    candidates = []
+    seen = set()
+    candidate_tokens = 0
+    duplicates = 0
+    for doc_rank, doc in enumerate(relevant_docs):
+        doc_weight = (doc.get("score") or 0) / max_score
+        for passage_index, (passage, tokens) in enumerate(split_passages(doc.get("content", ""), passage_tokens)):
+            candidate_tokens += tokens
+            fingerprint = hashlib.sha1(" ".join(passage.lower().split()).encode("utf-8")).digest()
+            if fingerprint in seen:
+                duplicates += 1
+                continue
+            seen.add(fingerprint)
+
+            passage_terms = set(_WORD.findall(passage.lower()))
+            overlap = len(query_terms & passage_terms) / len(query_terms) if query_terms else 0.0
+            score = doc_weight * (0.5 + overlap)
+            candidates.append((score, doc_rank, passage_index, passage, tokens))
+
+    # Greedily take the best passages that still fit; each passage is charged
+    # a few extra tokens for its document header and separator
+    selected = []
+    used_tokens = 0
+    header_tokens = 8
+    for score, doc_rank, passage_index, passage, tokens in sorted(candidates, key=lambda c: (-c[0], c[1], c[2])):
+        if used_tokens + tokens + header_tokens > token_budget:
+            continue
+        selected.append((doc_rank, passage_index, passage))
+        used_tokens += tokens + header_tokens
+
+    # Present passages grouped by document in search rank and reading order
+    by_document = {}
+    for doc_rank, _, passage in sorted(selected):
+        by_document.setdefault(doc_rank, []).append(passage)
+
+    context_parts = []
+    for doc_rank, doc in enumerate(relevant_docs):
+        passages = by_document.get(doc_rank)
+        if passages:
+            filename = doc.get("filename", "Unknown")
+            context_parts.append(f"Document {len(context_parts) + 1} ({filename}):\n" + "\n...\n".join(passages) + "\n")
+
+    stats = {
+        "context_tokens": used_tokens,
+        "candidate_tokens": candidate_tokens,
+        "passages_selected": len(selected),
+        "passages_considered": len(candidates) + duplicates,
+        "duplicates_removed": duplicates,
+        "packing_ms": (time.perf_counter() - start) * 1000
+    }
+
+    if not context_parts:
+        return "No relevant documents found.", stats
+    return "\n".join(context_parts), stats
@@ -0,0 +1,257 @@
+"""
+Page-level text extraction for PDF and DOCX documents.
+
+PDF pages are extracted on a process pool shared by every document in the
+worker process, one task per page, and yielded in order as soon as they are
+ready so callers can assemble or stream the text in linear time. The pool
+workers also fingerprint the pages, in one task per contiguous run of pages,
+so only pages whose fingerprint is not known yet are extracted. With a
+PAGE_TIMEOUT_SECONDS limit every page goes through the pool, a single page of
+a small PDF too: the pool worker arms a timer when it starts the page, so the
+limit is measured per page however long it queued, and a page that overruns
+is skipped instead of stalling the whole document. The pool uses the spawn
+start method, as the functions' worker process already runs threads. PyPDF2
+and python-docx are imported with the first document that needs them, so
+other uploads and the other functions never load them.
+"""
+import hashlib
+import io
+import itertools
+import logging
+import multiprocessing
+import multiprocessing.util
+import os
+import signal
+import tempfile
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+# PdfReaders of the documents a pool worker has pages of, most recent last
+WORKER_READERS = 4
+_worker_readers = OrderedDict()
+
+_pool = None
+_pool_workers = None
+_pool_lock = threading.Lock()
+_documents = itertools.count()
+
+
+class PageTimeout(BaseException):
+    """A page took longer than PAGE_TIMEOUT_SECONDS in a pool worker; not an Exception, so PyPDF2 cannot swallow it"""
+
+
+def worker_budget():
+    """Default size of a process pool: this worker process's share of the host's CPUs"""
+    processes = int(os.environ.get("FUNCTIONS_WORKER_PROCESS_COUNT", "1"))
+    return max(1, (os.cpu_count() or 1) // max(1, processes))
+
+
+def extraction_settings():
+    """Pool size, minimum pages for the pool and per-page timeout from the environment"""
+    workers = int(os.environ.get("EXTRACTION_WORKERS", str(worker_budget())))
+    parallel_min_pages = int(os.environ.get("PDF_PARALLEL_MIN_PAGES", "16"))
+    page_timeout = float(os.environ.get("PAGE_TIMEOUT_SECONDS", "30"))
+    return max(1, workers), parallel_min_pages, page_timeout
+
+
+def get_pool():
+    """The process pool shared by every PDF extraction in this worker process"""
+    global _pool, _pool_workers
+    workers = extraction_settings()[0]
+    if _pool is None or _pool_workers != workers:
+        with _pool_lock:
+            if _pool is None or _pool_workers != workers:
+                if _pool is not None:
+                    _pool.shutdown(wait=False)
+                _pool = ProcessPoolExecutor(
+                    max_workers=workers, mp_context=multiprocessing.get_context("spawn"), initializer=_init_pdf_worker
+                )
+                _pool_workers = workers
+                # A multiprocessing child (a bulk worker) never runs the executor's atexit hook and would wait on
+                # the workers forever; shut down ahead of the call queue's own finalizer, which runs at priority 10
+                multiprocessing.util.Finalize(_pool, _pool.shutdown, exitpriority=20)
+    return _pool
+
+
+def reset_pool():
+    """Shut the pool down; the next PDF starts a new one"""
+    global _pool, _pool_workers
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
+        _pool_workers = None
+
+
+def iter_pdf_pages(source):
+    """Yield the text of each PDF page in order; source is PDF bytes or a seekable file"""
+    for _, text in iter_pdf_page_records(source):
+        yield text
+
+
+def iter_pdf_page_records(source, known_pages=None):
+    """
+    Yield (fingerprint, text) for each PDF page in order. Pages whose
+    fingerprint is in known_pages reuse that text instead of being extracted.
+    """
+    import PyPDF2
+
+    workers, parallel_min_pages, page_timeout = extraction_settings()
+    known_pages = known_pages or {}
+    stream = io.BytesIO(source) if isinstance(source, bytes) else source
+    reader = PyPDF2.PdfReader(stream)
+    page_count = len(reader.pages)
+
+    # Without a timeout, small documents are not worth sending to the pool
+    if page_timeout <= 0 and (workers <= 1 or page_count < parallel_min_pages):
+        for page in reader.pages:
+            fingerprint = page_fingerprint(page)
+            if fingerprint in known_pages:
+                yield fingerprint, known_pages[fingerprint]
+            else:
+                yield fingerprint, page.extract_text() or ""
+        return
+
+    path, copy = _document_path(stream)
+    document = f"{os.getpid()}-{next(_documents)}"
+    extracted = None
+    try:
+        fingerprints = _fingerprint_in_pool(document, path, page_count, workers)
+        missing = [index for index, fingerprint in enumerate(fingerprints) if fingerprint not in known_pages]
+        if page_timeout <= 0 and len(missing) < parallel_min_pages:
+            extracted = (reader.pages[index].extract_text() or "" for index in missing)
+        else:
+            extracted = _iter_pages_in_pool(document, path, missing, page_count, page_timeout)
+
+        for fingerprint in fingerprints:
+            if fingerprint in known_pages:
+                yield fingerprint, known_pages[fingerprint]
+            else:
+                yield fingerprint, next(extracted)
+    finally:
+        # Stops the pages still queued when the caller stops early
+        if extracted is not None:
+            extracted.close()
+        if copy is not None:
+            copy.close()
+
+
+def page_fingerprint(page):
+    """Hash of a page's content stream, stable across re-uploads of an unchanged page"""
+    contents = page.get_contents()
+    data = contents.get_data() if contents is not None else b""
+    return hashlib.sha256(data).hexdigest()
+
+
+def _document_path(stream):
+    """
+    (path, temporary file or None): workers open the document by path, a
+    spilled upload's own file or a copy of one held in memory
+    """
+    path = getattr(stream, "name", None)
+    if isinstance(path, str) and os.path.exists(path):
+        return path, None
+    copy = tempfile.NamedTemporaryFile(prefix="pdf-")
+    copy.write(stream.getbuffer())
+    copy.flush()
+    return copy.name, copy
+
+
+def _fingerprint_in_pool(document, path, page_count, workers):
+    """Fingerprints of every page, one task per worker's share of the pages"""
+    pool = get_pool()
+    size = -(-page_count // workers)
+    futures = [
+        pool.submit(_fingerprint_pdf_pages, document, path, start, min(start + size, page_count))
+        for start in range(0, page_count, size)
+    ]
+    fingerprints = []
+    try:
+        for future in futures:
+            fingerprints.extend(future.result())
+    except BrokenProcessPool:
+        reset_pool()
+        raise
+    finally:
+        for future in futures:
+            future.cancel()
+    return fingerprints
+
+
+def _iter_pages_in_pool(document, path, indexes, page_count, page_timeout):
+    pool = get_pool()
+    futures = [pool.submit(_extract_pdf_page, document, path, index, page_timeout) for index in indexes]
+    try:
+        for index, future in zip(indexes, futures):
+            try:
+                yield future.result()
+            except PageTimeout:
+                logging.warning(f"Page {index + 1} of {page_count} timed out after {page_timeout}s, skipping it")
+                yield ""
+            except BrokenProcessPool:
+                reset_pool()
+                raise
+            except Exception as e:
+                logging.warning(f"Could not extract page {index + 1} of {page_count}: {str(e)}")
+                yield ""
+    finally:
+        for future in futures:
+            future.cancel()
+
+
+def _init_pdf_worker():
+    # PyPDF2 is loaded as the worker starts rather than with its first page
+    import PyPDF2
+    signal.signal(signal.SIGALRM, _page_timed_out)
+
+
+def _page_timed_out(signum, frame):
+    raise PageTimeout()
+
+
+def _worker_reader(document, path):
+    import PyPDF2
+    reader = _worker_readers.get(document)
+    if reader is None:
+        reader = _worker_readers[document] = PyPDF2.PdfReader(open(path, "rb"))
+        while len(_worker_readers) > WORKER_READERS:
+            _, evicted = _worker_readers.popitem(last=False)
+            evicted.stream.close()
+    _worker_readers.move_to_end(document)
+    return reader
+
+
+def _fingerprint_pdf_pages(document, path, start, stop):
+    reader = _worker_reader(document, path)
+    return [page_fingerprint(reader.pages[index]) for index in range(start, stop)]
+
+
+def _extract_pdf_page(document, path, index, page_timeout):
+    reader = _worker_reader(document, path)
+    # Tasks run on the worker's main thread, where SIGALRM interrupts a stuck page
+    if page_timeout > 0:
+        signal.setitimer(signal.ITIMER_REAL, page_timeout)
+    try:
+        return reader.pages[index].extract_text() or ""
+    except PageTimeout:
+        # The reader may have been interrupted mid-parse; the next page reopens the file
+        _worker_readers.pop(document).stream.close()
+        raise
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+
+
+def iter_docx_paragraphs(source):
+    """Yield the text of each DOCX paragraph in order; source is DOCX bytes or a seekable file"""
+    import docx
+
+    document = docx.Document(io.BytesIO(source) if isinstance(source, bytes) else source)
+    for paragraph in document.paragraphs:
+        yield paragraph.text
+
+
+def join_text(pieces):
+    """Join extracted pieces one per line in linear time"""
+    return "\n".join(pieces).strip()
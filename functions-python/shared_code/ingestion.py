@@ -0,0 +1,125 @@
+"""
+Memory-bounded buffers for document ingestion.
+
+SpooledInput copies an uploaded blob stream once, in fixed-size chunks, into
+memory or - above a size threshold - a temporary file, and hands parsers a
+seekable view of it. SpooledText does the same for the extracted text so it
+can be streamed to the processed container and chunked for indexing without
+ever being held as one string.
+"""
+import codecs
+import hashlib
+import io
+import os
+import tempfile
+
+READ_CHUNK_SIZE = 1024 * 1024
+
+
+def spool_threshold():
+    """Bytes kept in memory before a buffer spills to a temporary file"""
+    return int(os.environ.get("INGEST_SPOOL_THRESHOLD_MB", "32")) * 1024 * 1024
+
+
+class SpooledInput:
+    """Seekable copy of an input stream, on disk when it is larger than the threshold"""
+
+    def __init__(self, stream, threshold=None, chunk_size=READ_CHUNK_SIZE):
+        threshold = spool_threshold() if threshold is None else threshold
+        self.size = 0
+        self.path = None
+        self._file = io.BytesIO()
+        digest = hashlib.sha256()
+
+        while True:
+            chunk = stream.read(chunk_size)
+            if not chunk:
+                break
+            if self.path is None and self.size + len(chunk) > threshold:
+                self._spill()
+            self._file.write(chunk)
+            digest.update(chunk)
+            self.size += len(chunk)
+
+        # Content hash of the upload, used to skip re-processing identical bytes
+        self.sha256 = digest.hexdigest()
+        self._file.seek(0)
+
+    def _spill(self):
+        spilled = tempfile.NamedTemporaryFile(prefix="ingest-")
+        spilled.write(self._file.getbuffer())
+        self._file = spilled
+        self.path = spilled.name
+
+    def reader(self):
+        """The buffer rewound to the start; parsers read it in place"""
+        self._file.seek(0)
+        return self._file
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class SpooledText:
+    """Extracted text written piece by piece, on disk when it is larger than the threshold"""
+
+    def __init__(self, pieces=(), threshold=None, separator="\n"):
+        threshold = spool_threshold() if threshold is None else threshold
+        self.length = 0
+        self.pieces = 0
+        self.separator = separator
+        self._file = tempfile.SpooledTemporaryFile(max_size=threshold, mode="w+", encoding="utf-8")
+        for piece in pieces:
+            self.write(piece)
+
+    def write(self, piece):
+        """Append a piece, separated from the previous one"""
+        if self.pieces:
+            self._file.write(self.separator)
+            self.length += len(self.separator)
+        self._file.write(piece)
+        self.length += len(piece)
+        self.pieces += 1
+
+    def iter_pieces(self, size=READ_CHUNK_SIZE):
+        """Yield the text in pieces of at most size characters"""
+        self._file.seek(0)
+        while True:
+            piece = self._file.read(size)
+            if not piece:
+                break
+            yield piece
+
+    def read_all(self):
+        self._file.seek(0)
+        return self._file.read()
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def iter_decoded(stream, encoding="utf-8", chunk_size=READ_CHUNK_SIZE):
+    """Decode a byte stream incrementally, yielding text pieces"""
+    return decode_chunks(iter(lambda: stream.read(chunk_size), b""), encoding)
+
+
+def decode_chunks(chunks, encoding="utf-8"):
+    """Decode an iterable of byte chunks, yielding text pieces"""
+    decoder = codecs.getincrementaldecoder(encoding)()
+    for chunk in chunks:
+        yield decoder.decode(chunk)
+    tail = decoder.decode(b"", final=True)
+    if tail:
+        yield tail
@@ -0,0 +1,221 @@
+"""
+Paginated, resumable lifecycle scan over the document containers.
+
+Every container is listed concurrently, one page at a time, with the next page
+fetched while the current one is applied. Each listed blob is passed to the
+container's rules, which decide whether it moves to another container or is
+deleted. Moves go through the tier mover on one shared semaphore and deletes
+are sent as blob batches of up to 256. After each page the container's
+continuation token is saved to a checkpoint blob, so a run that reaches
+LIFECYCLE_TIME_LIMIT_SECONDS stops cleanly and the next run picks up at the
+page it stopped on rather than re-listing the whole container.
+"""
+import asyncio
+import json
+import logging
+import os
+import time
+from datetime import datetime
+
+from azure.core.exceptions import ResourceNotFoundError
+
+from shared_code import clients, tiering
+
+# Most sub-requests the Blob batch API accepts in one call
+DELETE_BATCH_SIZE = 256
+
+CHECKPOINT_BLOB = "lifecycle/checkpoint.json"
+
+
+def lifecycle_settings():
+    """Listing page size and the time a run may take before it checkpoints and stops"""
+    page_size = int(os.environ.get("LIFECYCLE_PAGE_SIZE", "1000"))
+    time_limit = float(os.environ.get("LIFECYCLE_TIME_LIMIT_SECONDS", "240"))
+    return page_size, time_limit
+
+
+def run(rules):
+    """
+    Scan the containers in rules ({container: [decide, ...]}) from synchronous
+    code. Each decide(blob) returns ("move", target container), ("delete", None)
+    or None; the first rule with a decision wins. Returns per-container stats.
+    """
+    return asyncio.run(_run_and_close(rules))
+
+
+async def _run_and_close(rules):
+    try:
+        return await run_async(rules)
+    finally:
+        await clients.close_async_clients()
+
+
+async def run_async(rules):
+    page_size, time_limit = lifecycle_settings()
+    deadline = time.monotonic() + time_limit
+    blob_service_client = clients.get_async_blob_service_client()
+    checkpoint = Checkpoint(blob_service_client)
+    await checkpoint.load(rules)
+    move_slots = asyncio.Semaphore(tiering.mover_settings()[0])
+
+    stats = await asyncio.gather(*(
+        _scan_container(blob_service_client, container, decisions, checkpoint, move_slots, page_size, deadline)
+        for container, decisions in rules.items()
+    ))
+    stats = dict(zip(rules, stats))
+
+    if all(container_stats["complete"] for container_stats in stats.values()):
+        await checkpoint.clear()
+    else:
+        logging.info("Lifecycle run reached its time limit, the next run resumes from the checkpoint")
+    return stats
+
+
+async def _scan_container(blob_service_client, container, decisions, checkpoint, move_slots, page_size, deadline):
+    stats = {"listed": 0, "moved": 0, "deleted": 0, "failed": 0, "pages": 0, "complete": False}
+    state = checkpoint.state(container)
+    if state.get("done"):
+        stats["complete"] = True
+        return stats
+
+    container_client = blob_service_client.get_container_client(container)
+    pages = asyncio.Queue(maxsize=1)
+    lister = asyncio.ensure_future(_list_pages(container_client, state.get("token"), page_size, pages))
+
+    try:
+        while True:
+            if time.monotonic() >= deadline:
+                return stats
+            page = await pages.get()
+            if page is None:
+                break
+            if isinstance(page, Exception):
+                raise page
+            blobs, next_token = page
+
+            moves, deletes = decide_page(container, blobs, decisions)
+            results = await tiering.move_blobs_async(moves, move_slots) if moves else []
+            deleted, failed = await delete_in_batches(container_client, deletes)
+
+            stats["pages"] += 1
+            stats["listed"] += len(blobs)
+            stats["moved"] += sum(1 for result in results if result["status"] in ("moved", "retiered"))
+            stats["failed"] += sum(1 for result in results if result["error"]) + failed
+            stats["deleted"] += deleted
+
+            if next_token is None:
+                break
+            # Only advanced once the page is applied, so a stopped run never skips blobs
+            await checkpoint.save(container, next_token)
+
+        stats["complete"] = True
+        await checkpoint.save(container, None, done=True)
+        return stats
+    except ResourceNotFoundError:
+        logging.info(f"Lifecycle container {container} does not exist")
+        stats["complete"] = True
+        await checkpoint.save(container, None, done=True)
+        return stats
+    except Exception as e:
+        # Other containers carry on; this one resumes from its last page next run
+        logging.error(f"Lifecycle scan of {container} failed: {str(e)}")
+        return stats
+    finally:
+        lister.cancel()
+
+
+async def _list_pages(container_client, token, page_size, pages):
+    """List one page ahead of the consumer; None marks the end, an exception a failed listing"""
+    try:
+        pager = container_client.list_blobs(results_per_page=page_size).by_page(continuation_token=token)
+        async for page in pager:
+            blobs = [blob async for blob in page]
+            await pages.put((blobs, pager.continuation_token))
+        await pages.put(None)
+    except Exception as e:
+        await pages.put(e)
+
+
+def decide_page(container, blobs, decisions):
+    """Split a page of blobs into tier moves and deletes using the container's rules"""
+    moves = []
+    deletes = []
+    for blob in blobs:
+        for decide in decisions:
+            decision = decide(blob)
+            if decision is None:
+                continue
+            action, target = decision
+            if action == "delete":
+                deletes.append(blob.name)
+            else:
+                moves.append(tiering.plan_move(blob.name, container, target, blob.blob_tier))
+            break
+    return moves, deletes
+
+
+async def delete_in_batches(container_client, names):
+    """Delete blobs with the batch API, DELETE_BATCH_SIZE per request; returns (deleted, failed)"""
+    deleted = 0
+    failed = 0
+    for i in range(0, len(names), DELETE_BATCH_SIZE):
+        batch = names[i:i + DELETE_BATCH_SIZE]
+        try:
+            responses = await container_client.delete_blobs(*batch, raise_on_any_failure=False)
+            async for response in responses:
+                # A blob that is already gone counts as deleted
+                if response.status_code in (202, 404):
+                    deleted += 1
+                else:
+                    failed += 1
+                    logging.warning(f"Batch delete returned {response.status_code} for {response.request.url}")
+        except Exception as e:
+            failed += len(batch)
+            logging.error(f"Batch delete of {len(batch)} blobs failed: {str(e)}")
+    if deleted:
+        logging.info(f"Deleted {deleted} blobs in {container_client.container_name}")
+    return deleted, failed
+
+
+class Checkpoint:
+    """Per-container continuation tokens of the current lifecycle cycle, in the metadata container"""
+
+    def __init__(self, blob_service_client):
+        container_name = os.environ.get("METADATA_CONTAINER_NAME", "metadata")
+        self._container_client = blob_service_client.get_container_client(container_name)
+        self._data = {"containers": {}}
+        self._lock = asyncio.Lock()
+
+    async def load(self, rules):
+        try:
+            downloader = await self._container_client.download_blob(CHECKPOINT_BLOB)
+            self._data = json.loads(await downloader.readall())
+            resumed = [name for name, state in self._data["containers"].items() if state.get("token") or state.get("done")]
+            if resumed:
+                logging.info(f"Resuming lifecycle run started {self._data.get('started')} for {', '.join(resumed)}")
+        except ResourceNotFoundError:
+            self._data = {"containers": {}, "started": datetime.utcnow().isoformat()}
+        for container in rules:
+            self._data["containers"].setdefault(container, {"token": None, "done": False})
+
+    def state(self, container):
+        return self._data["containers"][container]
+
+    async def save(self, container, token, done=False):
+        async with self._lock:
+            self._data["containers"][container] = {"token": token, "done": done}
+            self._data["updated"] = datetime.utcnow().isoformat()
+            data = json.dumps(self._data).encode("utf-8")
+            try:
+                await self._container_client.upload_blob(CHECKPOINT_BLOB, data, overwrite=True)
+            except ResourceNotFoundError:
+                await self._container_client.create_container()
+                await self._container_client.upload_blob(CHECKPOINT_BLOB, data, overwrite=True)
+
+    async def clear(self):
+        """Every container finished: the next run starts a fresh cycle"""
+        async with self._lock:
+            try:
+                await self._container_client.delete_blob(CHECKPOINT_BLOB)
+            except ResourceNotFoundError:
+                pass
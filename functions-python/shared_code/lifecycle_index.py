@@ -0,0 +1,323 @@
+"""
+Incremental lifecycle index.
+
+Instead of listing every container on every tick, the timer keeps an index of
+each document blob: its container, tier, when it entered that container, when
+it was last accessed and when its next transition is due. Uploads and accesses
+are written as JSON lines to the journal stream of the telemetry writer by
+whichever function sees them; the timer is the only writer of the index itself, so it
+folds in new journal lines, pops the entries that are due from a heap ordered
+by due time and applies just those transitions. A full listing reconciles the
+index every LIFECYCLE_RECONCILE_HOURS to pick up anything the journal missed.
+Journal blobs of sealed hours are deleted only after the index holding their
+events has been saved.
+"""
+import asyncio
+import heapq
+import json
+import logging
+import os
+import time
+
+from azure.core import MatchConditions
+from azure.core.exceptions import ResourceExistsError, ResourceModifiedError, ResourceNotFoundError
+
+from shared_code import clients, lifecycle, telemetry, tiering
+
+INDEX_BLOB = "lifecycle/index.json"
+JOURNAL_PREFIX = "lifecycle/journal/"
+
+# Index and etag from the last tick; the timer is the only writer, so it rarely needs re-reading
+_cached = None
+
+
+def index_settings():
+    """Hours between reconciling listings, most transitions per tick and retry delay for failed ones"""
+    reconcile_hours = float(os.environ.get("LIFECYCLE_RECONCILE_HOURS", "24"))
+    max_due = int(os.environ.get("LIFECYCLE_INDEX_MAX_DUE", "5000"))
+    retry_minutes = float(os.environ.get("LIFECYCLE_RETRY_MINUTES", "15"))
+    return reconcile_hours, max_due, retry_minutes
+
+
+def _metadata_container(blob_service_client):
+    return blob_service_client.get_container_client(os.environ.get("METADATA_CONTAINER_NAME", "metadata"))
+
+
+def managed_containers():
+    """The hot, documents and archive containers whose blobs the index tracks"""
+    return {
+        os.environ.get("HOT_CONTAINER_NAME", "hot-documents"),
+        "documents",
+        os.environ.get("ARCHIVE_CONTAINER_NAME", "archive")
+    }
+
+
+def record_events(event_type, names, container=None, when=None):
+    """Journal upload, access or moved events for the timer to fold into the index, as of when (default now)"""
+    when = time.time() if when is None else when
+    for name in names:
+        telemetry.write(JOURNAL_PREFIX, {"type": event_type, "name": name, "container": container, "time": when})
+
+    # Keep current_locations right until the next tick replays the event
+    if event_type == "moved" and _cached is not None:
+        for name in names:
+            if name in _cached[1].entries:
+                _cached[1].entries[name]["container"] = container
+
+
+def compute_due(entry, policy):
+    """
+    When the entry's next transition is due, as epoch seconds. Moves count
+    from the later of entering the container and the last access; deletes
+    from entering it. Matches the "more than N whole days" rule of the scan.
+    """
+    rule = policy.get(entry["container"])
+    if rule is None:
+        return None
+    action, _, days = rule
+    base = entry["entered"] if action == "delete" else max(entry["entered"], entry.get("last_access") or 0)
+    return base + (days + 1) * 86400
+
+
+class LifecycleIndex:
+    """Blob entries keyed by name, with a heap of (due, name) for the ones that have a transition"""
+
+    def __init__(self, data=None):
+        data = data or {}
+        self.entries = data.get("entries", {})
+        self.journal = data.get("journal", {})
+        self.reconciled = data.get("reconciled")
+        self._rebuild_heap()
+
+    def to_json(self):
+        return json.dumps({"entries": self.entries, "journal": self.journal, "reconciled": self.reconciled})
+
+    def upsert(self, name, policy, **fields):
+        entry = self.entries.setdefault(name, {"container": None, "tier": None, "entered": 0, "last_access": None})
+        entry.update(fields)
+        entry["due"] = compute_due(entry, policy)
+        if entry["due"] is not None:
+            heapq.heappush(self._heap, (entry["due"], name))
+        if len(self._heap) > 2 * len(self.entries) + 1024:
+            self._rebuild_heap()
+
+    def _rebuild_heap(self):
+        """Drop the superseded items that updates leave behind"""
+        self._heap = [(entry["due"], name) for name, entry in self.entries.items() if entry.get("due")]
+        heapq.heapify(self._heap)
+
+    def remove(self, name):
+        # Its heap items are dropped lazily when popped
+        self.entries.pop(name, None)
+
+    def pop_due(self, now, limit):
+        """Names whose transition is due, earliest first"""
+        due = []
+        seen = set()
+        while self._heap and self._heap[0][0] <= now and len(due) < limit:
+            when, name = heapq.heappop(self._heap)
+            entry = self.entries.get(name)
+            # Skip heap items left behind by an update or removal
+            if entry is not None and entry.get("due") == when and name not in seen:
+                seen.add(name)
+                due.append(name)
+        return due
+
+    def defer(self, name, when):
+        """Push an entry's transition back, e.g. to retry a failed move"""
+        self.entries[name]["due"] = when
+        heapq.heappush(self._heap, (when, name))
+
+    def apply_event(self, event, policy):
+        name = event["name"]
+        if event["type"] == "upload":
+            self.upsert(name, policy, container=event.get("container") or "documents", tier=None,
+                        entered=event["time"], last_access=event["time"])
+        elif event["type"] == "moved":
+            self.upsert(name, policy, container=event["container"], tier=None, entered=event["time"])
+        elif event["type"] == "access" and name in self.entries:
+            last_access = max(self.entries[name].get("last_access") or 0, event["time"])
+            self.upsert(name, policy, last_access=last_access)
+
+
+def current_locations():
+    """Container of each indexed blob as of the last saved tick, or None when there is no index"""
+    if _cached is None:
+        return None
+    return {name: entry["container"] for name, entry in _cached[1].entries.items()}
+
+
+def tick(policy):
+    """
+    Run one incremental lifecycle pass. policy maps each container to
+    (action, target container, threshold days). Returns counts of the work done.
+    """
+    return asyncio.run(_tick_and_close(policy))
+
+
+async def _tick_and_close(policy):
+    try:
+        return await tick_async(policy)
+    finally:
+        await clients.close_async_clients()
+
+
+async def tick_async(policy):
+    global _cached
+    reconcile_hours, max_due, retry_minutes = index_settings()
+    blob_service_client = clients.get_async_blob_service_client()
+    metadata_container = _metadata_container(blob_service_client)
+    stats = {"events": 0, "due": 0, "moved": 0, "deleted": 0, "failed": 0, "reconciled": False}
+
+    index, etag = await _load(metadata_container)
+    # Only a saved index is reused, never one a failed tick left half-applied
+    _cached = None
+    now = time.time()
+
+    if index.reconciled is None or now - index.reconciled >= reconcile_hours * 3600:
+        await reconcile(blob_service_client, index, policy)
+        stats["reconciled"] = True
+
+    stats["events"], finished = await _fold_journal(metadata_container, index, policy)
+
+    due = index.pop_due(now, max_due)
+    stats["due"] = len(due)
+    if due:
+        await _apply_due(blob_service_client, index, policy, due, now, retry_minutes, stats)
+
+    try:
+        etag = await _save(metadata_container, index, etag)
+    except ResourceModifiedError:
+        # Someone else wrote the index since it was read; their copy wins and this tick is redone
+        logging.warning("Lifecycle index changed during the tick, discarding this tick's changes")
+        _cached = None
+        return stats
+
+    # The events of finished journal blobs are in the saved index now, so the blobs can go
+    await _delete_journal_blobs(metadata_container, index, finished)
+    _cached = (etag, index)
+    return stats
+
+
+async def _load(metadata_container):
+    blob_client = metadata_container.get_blob_client(INDEX_BLOB)
+    try:
+        properties = await blob_client.get_blob_properties()
+    except ResourceNotFoundError:
+        return LifecycleIndex(), None
+
+    if _cached is not None and _cached[0] == properties.etag:
+        return _cached[1], _cached[0]
+    downloader = await blob_client.download_blob()
+    return LifecycleIndex(json.loads(await downloader.readall())), downloader.properties.etag
+
+
+async def _save(metadata_container, index, etag):
+    blob_client = metadata_container.get_blob_client(INDEX_BLOB)
+    data = index.to_json().encode("utf-8")
+    if etag:
+        conditions = {"etag": etag, "match_condition": MatchConditions.IfNotModified}
+    else:
+        conditions = {"match_condition": MatchConditions.IfMissing}
+    try:
+        result = await blob_client.upload_blob(data, overwrite=True, **conditions)
+    except ResourceNotFoundError:
+        await metadata_container.create_container()
+        result = await blob_client.upload_blob(data, overwrite=True, **conditions)
+    except ResourceExistsError:
+        raise ResourceModifiedError("Lifecycle index was created by another writer")
+    return result["etag"]
+
+
+async def _fold_journal(metadata_container, index, policy):
+    """
+    Apply journal lines written since the last tick; returns the number of
+    events and the journal blobs that are finished, for deletion once the
+    index is saved
+    """
+    events = 0
+    finished = []
+    async for blob in metadata_container.list_blobs(name_starts_with=JOURNAL_PREFIX):
+        records, offset = await telemetry.read_lines(
+            metadata_container, blob.name, index.journal.get(blob.name, 0), blob.size
+        )
+        for record in records:
+            index.apply_event(record, policy)
+        events += len(records)
+        index.journal[blob.name] = offset
+
+        # Sealed hours take no more appends, so they are finished once fully read
+        hour = telemetry.blob_hour(blob.name, JOURNAL_PREFIX)
+        if hour and telemetry.is_sealed(hour) and offset >= blob.size:
+            finished.append(blob.name)
+    return events, finished
+
+
+async def _delete_journal_blobs(metadata_container, index, names):
+    """Delete fully folded journal blobs; one that stays is read again from its saved offset"""
+    for name in names:
+        try:
+            await metadata_container.delete_blob(name)
+        except ResourceNotFoundError:
+            pass
+        except Exception as e:
+            logging.warning(f"Failed to delete lifecycle journal blob {name}, retried next tick: {str(e)}")
+            continue
+        index.journal.pop(name, None)
+
+
+async def _apply_due(blob_service_client, index, policy, due, now, retry_minutes, stats):
+    moves = []
+    deletes = {}
+    for name in due:
+        entry = index.entries[name]
+        action, target, _ = policy[entry["container"]]
+        if action == "delete":
+            deletes.setdefault(entry["container"], []).append(name)
+        else:
+            moves.append(tiering.plan_move(name, entry["container"], target, entry.get("tier")))
+
+    for result in await tiering.move_blobs_async(moves) if moves else []:
+        if result["error"]:
+            stats["failed"] += 1
+            index.defer(result["name"], now + retry_minutes * 60)
+        else:
+            stats["moved"] += 1
+            index.upsert(result["name"], policy, container=result["target"], tier=result["tier"], entered=now)
+
+    for container, names in deletes.items():
+        deleted, failed = await lifecycle.delete_in_batches(blob_service_client.get_container_client(container), names)
+        stats["deleted"] += deleted
+        stats["failed"] += failed
+        if failed:
+            # Batch results are not matched back to names; the next reconcile restores survivors
+            logging.warning(f"{failed} lifecycle deletes in {container} failed")
+        for name in names:
+            index.remove(name)
+
+
+async def reconcile(blob_service_client, index, policy):
+    """Rebuild the index's view of every lifecycle container from a full listing"""
+    listings = await asyncio.gather(*(
+        _list_container(blob_service_client.get_container_client(container)) for container in policy
+    ))
+    seen = set()
+    for container, blobs in zip(policy, listings):
+        for blob in blobs:
+            seen.add(blob.name)
+            entry = index.entries.get(blob.name, {})
+            entered = blob.last_modified.timestamp() if blob.last_modified else time.time()
+            index.upsert(blob.name, policy, container=container, tier=blob.blob_tier, entered=entered,
+                         last_access=entry.get("last_access"))
+
+    for name in [name for name in index.entries if name not in seen]:
+        index.remove(name)
+    index.reconciled = time.time()
+    logging.info(f"Reconciled lifecycle index: {len(seen)} blobs in {len(policy)} containers")
+
+
+async def _list_container(container_client):
+    try:
+        return [blob async for blob in container_client.list_blobs()]
+    except ResourceNotFoundError:
+        return []
@@ -0,0 +1,737 @@
+"""
+Embedded retrieval over the processed document text.
+
+A BM25 inverted index and a matrix of normalised chunk embeddings, kept in a
+directory as .npy arrays that every worker memory-maps, so a snapshot loads in
+milliseconds and is shared through the page cache instead of copied per
+process. DocumentUploadProcessor appends each (re)indexed file to a JSON Lines
+journal next to the snapshot; readers replay the journal lines they have not
+seen into a small in-memory segment on their next query, and the writer folds
+the journal into a new snapshot generation once it reaches
+LOCAL_SEARCH_JOURNAL_BYTES. Writers serialise on a lock file, readers never
+lock. Point LOCAL_SEARCH_DIR at storage shared by the function instances (for
+example under $HOME on App Service plans) for them to see one index.
+
+The index is on by default only when SEARCH_ENDPOINT is not set. It is seeded
+from the processed container a page at a time, within
+LOCAL_SEARCH_SEED_SECONDS per call, with the listing's continuation token
+saved next to the index so the next call carries on where this one stopped.
+
+Results have the shape of AIQueryProcessor.to_relevant_doc. Queries with a
+vector are ranked by reciprocal rank fusion of the BM25 and cosine rankings,
+as Azure Cognitive Search ranks hybrid queries.
+"""
+import base64
+import json
+import logging
+import math
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+import numpy as np
+
+from shared_code import chunking, clients, manifest
+
+TOKEN_PATTERN = re.compile(r"\w+")
+MAX_TERM_CHARS = 32
+BM25_K1 = 1.2
+BM25_B = 0.75
+# Rank constant of reciprocal rank fusion, as used by Azure Cognitive Search
+RRF_K = 60
+# Candidates each ranking contributes to a hybrid query, at least
+HYBRID_CANDIDATES = 50
+
+CURRENT_FILE = "CURRENT"
+LOCK_FILE = "LOCK"
+JOURNAL_FILE = "journal.jsonl"
+SEED_CHECKPOINT_FILE = "seed.json"
+LOCK_STALE_SECONDS = 300
+LOCK_TIMEOUT_SECONDS = 60
+
+_index = None
+_index_lock = threading.Lock()
+_write_lock = threading.Lock()
+
+
+def local_search_settings():
+    """Mode (fallback, primary or off), index directory and journal size that triggers compaction"""
+    # Without a search service the local index is the only one; with one it is opt-in
+    default_mode = "off" if os.environ.get("SEARCH_ENDPOINT") else "fallback"
+    mode = os.environ.get("LOCAL_SEARCH_MODE", default_mode).lower()
+    directory = os.environ.get("LOCAL_SEARCH_DIR") or os.path.join(tempfile.gettempdir(), "local_search")
+    journal_bytes = int(os.environ.get("LOCAL_SEARCH_JOURNAL_BYTES", str(4 * 1024 * 1024)))
+    return mode, directory, journal_bytes
+
+
+def seed_settings():
+    """Processed blobs listed per page and the time one seeding call may take"""
+    page_size = int(os.environ.get("LOCAL_SEARCH_SEED_PAGE_SIZE", "100"))
+    time_budget = float(os.environ.get("LOCAL_SEARCH_SEED_SECONDS", "60"))
+    return max(1, page_size), time_budget
+
+
+def enabled():
+    return local_search_settings()[0] != "off"
+
+
+def is_primary():
+    return local_search_settings()[0] == "primary"
+
+
+def tokenize(text):
+    return [term[:MAX_TERM_CHARS] for term in TOKEN_PATTERN.findall(text.lower())]
+
+
+def generation_dir(directory, generation):
+    return os.path.join(directory, f"gen-{generation:08d}")
+
+
+def current_state(directory):
+    """{"generation", "seeded"} from the CURRENT file, or None before the first snapshot"""
+    try:
+        with open(os.path.join(directory, CURRENT_FILE), encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def current_generation(directory):
+    state = current_state(directory)
+    return None if state is None else state["generation"]
+
+
+def is_seeded(directory):
+    """Whether the index has been built from the processed container, not only from uploads since"""
+    state = current_state(directory)
+    return state is not None and state.get("seeded", False)
+
+
+class Snapshot:
+    """One immutable, memory-mapped generation of the index"""
+
+    ARRAYS = ("vocab", "postings_offsets", "postings_chunks", "postings_tf", "chunk_file", "chunk_index",
+              "chunk_length", "text_offsets", "text", "vectors", "has_vector")
+
+    def __init__(self, files, arrays):
+        self.files = files
+        for name in self.ARRAYS:
+            setattr(self, name, arrays.get(name))
+        self.size = len(self.chunk_file)
+        self.total_length = float(self.chunk_length.sum()) if self.size else 0.0
+
+    @classmethod
+    def load(cls, path):
+        with open(os.path.join(path, "files.json"), encoding="utf-8") as f:
+            files = json.load(f)
+        arrays = {}
+        for name in cls.ARRAYS:
+            array_path = os.path.join(path, f"{name}.npy")
+            if os.path.exists(array_path):
+                arrays[name] = np.load(array_path, mmap_mode="r")
+        return cls(files, arrays)
+
+    @staticmethod
+    def write(path, files, arrays):
+        """Write a snapshot into path through a temporary directory"""
+        staging = tempfile.mkdtemp(prefix=".staging-", dir=os.path.dirname(path))
+        try:
+            for name, array in arrays.items():
+                np.save(os.path.join(staging, f"{name}.npy"), array)
+            with open(os.path.join(staging, "files.json"), "w", encoding="utf-8") as f:
+                json.dump(files, f)
+            open(os.path.join(staging, JOURNAL_FILE), "wb").close()
+            os.replace(staging, path)
+        except Exception:
+            shutil.rmtree(staging, ignore_errors=True)
+            raise
+
+    def arrays(self):
+        return {name: getattr(self, name) for name in self.ARRAYS if getattr(self, name) is not None}
+
+    def postings(self, term):
+        """(chunk ids, term frequencies) of term"""
+        position = int(np.searchsorted(self.vocab, term))
+        if position >= len(self.vocab) or self.vocab[position] != term:
+            return None, None
+        start, end = self.postings_offsets[position], self.postings_offsets[position + 1]
+        return self.postings_chunks[start:end], self.postings_tf[start:end]
+
+    def content(self, chunk_id):
+        start, end = self.text_offsets[chunk_id], self.text_offsets[chunk_id + 1]
+        return self.text[start:end].tobytes().decode("utf-8")
+
+
+def build_arrays(chunks, dimensions=None):
+    """
+    Snapshot arrays for chunks, (file id, chunk index, content, vector or None)
+    tuples. Vectors of other than dimensions (default: the first vector's) are left out.
+    """
+    postings = {}
+    lengths = np.zeros(len(chunks), dtype=np.float32)
+    texts = []
+    if dimensions is None:
+        dimensions = next((len(vector) for _, _, _, vector in chunks if vector is not None), 0)
+    vectors = np.zeros((len(chunks), dimensions), dtype=np.float32) if dimensions else None
+
+    for chunk_id, (_, _, content, vector) in enumerate(chunks):
+        terms = Counter(tokenize(content))
+        lengths[chunk_id] = sum(terms.values())
+        for term, tf in terms.items():
+            postings.setdefault(term, []).append((chunk_id, tf))
+        texts.append(content.encode("utf-8"))
+        if vectors is not None and vector is not None and len(vector) == dimensions:
+            vectors[chunk_id] = vector
+
+    vocab = sorted(postings)
+    offsets = np.zeros(len(vocab) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(postings[term]) for term in vocab])
+    flat = [entry for term in vocab for entry in postings[term]]
+    text_offsets = np.zeros(len(texts) + 1, dtype=np.int64)
+    text_offsets[1:] = np.cumsum([len(text) for text in texts])
+
+    arrays = {
+        "vocab": np.array(vocab, dtype=f"<U{MAX_TERM_CHARS}"),
+        "postings_offsets": offsets,
+        "postings_chunks": np.array([chunk_id for chunk_id, _ in flat], dtype=np.int32),
+        "postings_tf": np.array([tf for _, tf in flat], dtype=np.float32),
+        "chunk_file": np.array([file_id for file_id, _, _, _ in chunks], dtype=np.int32),
+        "chunk_index": np.array([index for _, index, _, _ in chunks], dtype=np.int32),
+        "chunk_length": lengths,
+        "text_offsets": text_offsets,
+        "text": np.frombuffer(b"".join(texts), dtype=np.uint8)
+    }
+    if vectors is not None:
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        arrays["vectors"] = vectors / np.where(norms > 0, norms, 1)
+        arrays["has_vector"] = norms[:, 0] > 0
+    return arrays
+
+
+def merge_arrays(base, keep, extra, base_files, extra_files):
+    """
+    (files, arrays) of the base chunks where keep is set followed by the extra
+    chunks, merged array by array so compaction never re-tokenizes the base
+    """
+    kept = np.flatnonzero(keep)
+    new_ids = np.full(len(keep), -1, dtype=np.int64)
+    new_ids[kept] = np.arange(len(kept))
+
+    # Postings as (term, chunk, tf) triples over the union vocabulary, regrouped by term
+    vocab = np.union1d(base["vocab"], extra["vocab"]).astype(f"<U{MAX_TERM_CHARS}")
+    base_terms = np.repeat(np.arange(len(base["vocab"])), np.diff(base["postings_offsets"]))
+    live = keep[base["postings_chunks"]]
+    extra_terms = np.repeat(np.arange(len(extra["vocab"])), np.diff(extra["postings_offsets"]))
+    terms = np.concatenate([
+        np.searchsorted(vocab, base["vocab"])[base_terms[live]],
+        np.searchsorted(vocab, extra["vocab"])[extra_terms]
+    ])
+    chunk_ids = np.concatenate([new_ids[base["postings_chunks"][live]], extra["postings_chunks"] + len(kept)])
+    tf = np.concatenate([base["postings_tf"][live], extra["postings_tf"]])
+    order = np.lexsort((chunk_ids, terms))
+    counts = np.bincount(terms, minlength=len(vocab))
+    # Terms only dead chunks used are dropped
+    used = counts > 0
+    offsets = np.zeros(int(used.sum()) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(counts[used])
+
+    # Text of the kept chunks gathered in one indexing operation
+    starts = base["text_offsets"][kept]
+    lengths = base["text_offsets"][kept + 1] - starts
+    new_starts = np.cumsum(lengths) - lengths
+    gather = np.arange(int(lengths.sum()), dtype=np.int64) + np.repeat(starts - new_starts, lengths)
+    text = np.concatenate([base["text"][gather], extra["text"]])
+    text_offsets = np.concatenate([new_starts, [lengths.sum()], extra["text_offsets"][1:] + lengths.sum()])
+
+    # Files that still have chunks, renumbered
+    chunk_file = np.concatenate([base["chunk_file"][kept], extra["chunk_file"] + len(base_files)])
+    used_files, chunk_file = np.unique(chunk_file, return_inverse=True)
+    all_files = base_files + extra_files
+
+    arrays = {
+        "vocab": vocab[used],
+        "postings_offsets": offsets,
+        "postings_chunks": chunk_ids[order].astype(np.int32),
+        "postings_tf": tf[order].astype(np.float32),
+        "chunk_file": chunk_file.astype(np.int32),
+        "chunk_index": np.concatenate([base["chunk_index"][kept], extra["chunk_index"]]).astype(np.int32),
+        "chunk_length": np.concatenate([base["chunk_length"][kept], extra["chunk_length"]]).astype(np.float32),
+        "text_offsets": text_offsets.astype(np.int64),
+        "text": text.astype(np.uint8)
+    }
+    if "vectors" in base or "vectors" in extra:
+        dimensions = (base.get("vectors") if "vectors" in base else extra["vectors"]).shape[1]
+        parts, present = [], []
+        for source, rows, count in ((base, kept, len(kept)), (extra, slice(None), len(extra["chunk_file"]))):
+            if "vectors" in source and source["vectors"].shape[1] == dimensions:
+                parts.append(np.asarray(source["vectors"][rows], dtype=np.float32))
+                present.append(np.asarray(source["has_vector"][rows], dtype=bool))
+            else:
+                parts.append(np.zeros((count, dimensions), dtype=np.float32))
+                present.append(np.zeros(count, dtype=bool))
+        arrays["vectors"] = np.concatenate(parts)
+        arrays["has_vector"] = np.concatenate(present)
+    return [all_files[i] for i in used_files], arrays
+
+
+class LocalIndex:
+    """A snapshot generation plus the journal entries appended after it"""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.generation = None
+        self.snapshot = None
+        self.snapshot_files = None
+        self.journal_offset = 0
+        self._lock = threading.Lock()
+        self._reset_segment()
+
+    def _reset_segment(self):
+        # Snapshot chunks of files deleted or re-indexed since the snapshot
+        self.dead_files = set()
+        self.dead = None
+        self.no_vector = None
+        # Journal chunks: dicts, or None once their file is deleted again
+        self.chunks = []
+        self.positions = {}
+        self.postings = {}
+        self._vectors = None
+
+    def refresh(self):
+        """Load a newer generation and replay journal lines written since the last refresh"""
+        generation = current_generation(self.directory)
+        if generation is None:
+            return False
+        with self._lock:
+            if generation != self.generation:
+                self.snapshot = Snapshot.load(generation_dir(self.directory, generation))
+                self.snapshot_files = None
+                self.generation = generation
+                self.journal_offset = 0
+                self._reset_segment()
+            self._replay()
+        return True
+
+    def _replay(self):
+        path = os.path.join(generation_dir(self.directory, self.generation), JOURNAL_FILE)
+        if os.path.getsize(path) <= self.journal_offset:
+            return
+        with open(path, "rb") as f:
+            f.seek(self.journal_offset)
+            data = f.read()
+        # A line still being appended is read on the next refresh
+        end = data.rfind(b"\n") + 1
+        for line in data[:end].splitlines():
+            if line:
+                self.apply(json.loads(line))
+        self.journal_offset += end
+
+    def apply(self, entry):
+        """Apply one journal entry: delete a file's chunks, or add chunks of a file"""
+        filename = entry["filename"]
+        if entry["op"] == "delete":
+            if filename not in self.dead_files:
+                self.dead_files.add(filename)
+                self.dead = self.no_vector = None
+            for position in self.positions.pop(filename, ()):
+                self.chunks[position] = None
+            self._vectors = None
+            return
+
+        for item in entry["chunks"]:
+            terms = Counter(tokenize(item["content"]))
+            position = len(self.chunks)
+            self.positions.setdefault(filename, []).append(position)
+            for term, tf in terms.items():
+                self.postings.setdefault(term, []).append((position, tf))
+            vector = item.get("vector")
+            if vector is not None:
+                vector = np.frombuffer(base64.b64decode(vector), dtype=np.float32)
+                norm = np.linalg.norm(vector)
+                vector = vector / norm if norm > 0 else None
+            self.chunks.append({
+                "filename": filename,
+                "upload_date": entry.get("upload_date", ""),
+                "chunk_index": item["chunk_index"],
+                "content": item["content"],
+                "length": sum(terms.values()),
+                "vector": vector
+            })
+        self._vectors = None
+
+    def has_file(self, filename):
+        """Whether filename has chunks in the snapshot or the journal"""
+        if filename in self.positions:
+            return True
+        if filename in self.dead_files:
+            return False
+        if self.snapshot_files is None:
+            self.snapshot_files = {info["filename"] for info in self.snapshot.files}
+        return filename in self.snapshot_files
+
+    def _dead_mask(self):
+        if self.dead is None:
+            dead_ids = [i for i, f in enumerate(self.snapshot.files) if f["filename"] in self.dead_files]
+            self.dead = np.isin(self.snapshot.chunk_file, dead_ids)
+        return self.dead
+
+    def live_chunks(self):
+        """Every current chunk as (filename, upload_date, chunk index, content, vector or None)"""
+        snapshot = self.snapshot
+        dead = self._dead_mask()
+        for chunk_id in range(snapshot.size):
+            if dead[chunk_id]:
+                continue
+            info = snapshot.files[int(snapshot.chunk_file[chunk_id])]
+            vector = None
+            if snapshot.vectors is not None and snapshot.has_vector[chunk_id]:
+                vector = np.array(snapshot.vectors[chunk_id])
+            yield info["filename"], info["upload_date"], int(snapshot.chunk_index[chunk_id]), \
+                snapshot.content(chunk_id), vector
+        for chunk in self.chunks:
+            if chunk is not None:
+                yield chunk["filename"], chunk["upload_date"], chunk["chunk_index"], chunk["content"], chunk["vector"]
+
+    def search(self, query, query_vector=None, top=5, skip=0, filter=None):
+        """Top chunks for the query, in the result shape of search_documents"""
+        if filter:
+            raise ValueError("Filters are not supported by the local index")
+        with self._lock:
+            wanted = top + skip
+            keyword = self._keyword_ranking(query, max(wanted, HYBRID_CANDIDATES if query_vector is not None else 0))
+            if query_vector is None:
+                ranked = keyword
+            else:
+                vector = self._vector_ranking(query_vector, max(wanted, HYBRID_CANDIDATES))
+                ranked = self._fuse(keyword, vector)
+            return [self._result(chunk_id, score) for chunk_id, score in ranked[skip:wanted]]
+
+    def _keyword_ranking(self, query, limit):
+        """[(chunk id, BM25 score)] best first; ids past the snapshot size are journal chunks"""
+        snapshot = self.snapshot
+        live_chunks = [chunk for chunk in self.chunks if chunk is not None]
+        dead = self._dead_mask()
+        count = snapshot.size - int(dead.sum()) + len(live_chunks)
+        if not count or not limit:
+            return []
+        average_length = (snapshot.total_length + sum(chunk["length"] for chunk in live_chunks)) / count or 1.0
+
+        ids, contributions = [], []
+        segment_scores = {}
+        for term in set(tokenize(query)):
+            chunk_ids, tf = snapshot.postings(term)
+            segment_postings = [(p, f) for p, f in self.postings.get(term, ()) if self.chunks[p] is not None]
+            df = (0 if chunk_ids is None else len(chunk_ids)) + len(segment_postings)
+            if not df:
+                continue
+            idf = math.log(1 + (count - df + 0.5) / (df + 0.5))
+            if chunk_ids is not None:
+                norm = BM25_K1 * (1 - BM25_B + BM25_B * snapshot.chunk_length[chunk_ids] / average_length)
+                ids.append(chunk_ids)
+                contributions.append(idf * tf * (BM25_K1 + 1) / (tf + norm))
+            for position, f in segment_postings:
+                norm = BM25_K1 * (1 - BM25_B + BM25_B * self.chunks[position]["length"] / average_length)
+                segment_scores[position] = segment_scores.get(position, 0.0) + idf * f * (BM25_K1 + 1) / (f + norm)
+
+        ranked = []
+        if ids:
+            ids = np.concatenate(ids)
+            candidates, inverse = np.unique(ids, return_inverse=True)
+            scores = np.bincount(inverse, weights=np.concatenate(contributions))
+            scores[dead[candidates]] = -np.inf
+            best = self._top(scores, limit)
+            ranked = [(int(candidates[i]), float(scores[i])) for i in best if scores[i] > -np.inf]
+        ranked.extend((snapshot.size + position, score) for position, score in segment_scores.items())
+        ranked.sort(key=lambda item: -item[1])
+        return ranked[:limit]
+
+    def _vector_ranking(self, query_vector, limit):
+        """[(chunk id, cosine similarity)] best first, over chunks that have embeddings"""
+        snapshot = self.snapshot
+        query = np.asarray(query_vector, dtype=np.float32)
+        norm = np.linalg.norm(query)
+        if not norm:
+            return []
+        query = query / norm
+
+        ranked = []
+        if snapshot.vectors is not None and snapshot.vectors.shape[1] == len(query):
+            # A plain array, so scores are not indexed through np.memmap one at a time
+            scores = np.asarray(snapshot.vectors @ query)
+            if self.no_vector is None:
+                self.no_vector = self._dead_mask() | ~snapshot.has_vector
+            scores[self.no_vector] = -np.inf
+            best = self._top(scores, limit)
+            ranked = [(int(i), float(score)) for i, score in zip(best, scores[best]) if score > -np.inf]
+
+        if self._vectors is None:
+            positions = [p for p, chunk in enumerate(self.chunks)
+                         if chunk is not None and chunk["vector"] is not None and len(chunk["vector"]) == len(query)]
+            matrix = np.array([self.chunks[p]["vector"] for p in positions], dtype=np.float32).reshape(-1, len(query))
+            self._vectors = (positions, matrix)
+        positions, matrix = self._vectors
+        if positions:
+            scores = matrix @ query
+            ranked.extend((snapshot.size + positions[i], float(scores[i])) for i in self._top(scores, limit))
+        ranked.sort(key=lambda item: -item[1])
+        return ranked[:limit]
+
+    @staticmethod
+    def _top(scores, limit):
+        """Indices of the limit highest scores, best first"""
+        if len(scores) > limit:
+            best = np.argpartition(-scores, limit - 1)[:limit]
+        else:
+            best = np.arange(len(scores))
+        return best[np.argsort(-scores[best], kind="stable")]
+
+    @staticmethod
+    def _fuse(*rankings):
+        """Reciprocal rank fusion of rankings"""
+        fused = {}
+        for ranking in rankings:
+            for rank, (chunk_id, _) in enumerate(ranking):
+                fused[chunk_id] = fused.get(chunk_id, 0.0) + 1.0 / (RRF_K + rank + 1)
+        return sorted(fused.items(), key=lambda item: -item[1])
+
+    def _result(self, chunk_id, score):
+        snapshot = self.snapshot
+        if chunk_id < snapshot.size:
+            info = snapshot.files[int(snapshot.chunk_file[chunk_id])]
+            return {
+                "filename": info["filename"],
+                "content": snapshot.content(chunk_id),
+                "upload_date": info["upload_date"],
+                "chunk_index": int(snapshot.chunk_index[chunk_id]),
+                "score": score
+            }
+        chunk = self.chunks[chunk_id - snapshot.size]
+        return {
+            "filename": chunk["filename"],
+            "content": chunk["content"],
+            "upload_date": chunk["upload_date"],
+            "chunk_index": chunk["chunk_index"],
+            "score": score
+        }
+
+
+def get_index():
+    """The process-wide local index, refreshed from disk, or None if disabled or never built"""
+    global _index
+    mode, directory, _ = local_search_settings()
+    if mode == "off":
+        return None
+    with _index_lock:
+        if _index is None or _index.directory != directory:
+            _index = LocalIndex(directory)
+        index = _index
+    return index if index.refresh() else None
+
+
+def reset_index():
+    global _index
+    with _index_lock:
+        _index = None
+
+
+@contextmanager
+def _locked(directory):
+    """Hold the index's lock file, breaking one left by a writer that died"""
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, LOCK_FILE)
+    deadline = time.monotonic() + LOCK_TIMEOUT_SECONDS
+    with _write_lock:
+        while True:
+            try:
+                os.close(os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+                break
+            except FileExistsError:
+                try:
+                    if time.time() - os.path.getmtime(path) > LOCK_STALE_SECONDS:
+                        os.remove(path)
+                        continue
+                except FileNotFoundError:
+                    continue
+                if time.monotonic() > deadline:
+                    raise TimeoutError(f"Timed out waiting for the local search lock in {directory}")
+                time.sleep(0.05)
+        try:
+            yield
+        finally:
+            os.remove(path)
+
+
+def _append(entries, missing_only=False):
+    """
+    Append journal entries, starting an empty index first if needed, and
+    compact a full journal. With missing_only, entries for files the index
+    already has are dropped under the lock. Returns the entries appended.
+    """
+    _, directory, journal_bytes = local_search_settings()
+    with _locked(directory):
+        generation = current_generation(directory)
+        if generation is None:
+            generation = _publish(directory, 0, [], build_arrays([]), seeded=False)
+        if missing_only:
+            index = LocalIndex(directory)
+            index.refresh()
+            entries = [entry for entry in entries if not index.has_file(entry["filename"])]
+        if not entries:
+            return 0
+        path = os.path.join(generation_dir(directory, generation), JOURNAL_FILE)
+        with open(path, "ab") as f:
+            f.write("".join(json.dumps(entry) + "\n" for entry in entries).encode("utf-8"))
+            size = f.tell()
+        if size >= journal_bytes:
+            _compact(directory, generation)
+    return len(entries)
+
+
+def remove_document(filename):
+    """Drop every chunk of filename, e.g. before it is re-indexed"""
+    _append([{"op": "delete", "filename": filename}])
+
+
+def add_chunks(filename, upload_date, docs):
+    """Add chunks of filename: dicts with chunk_index, content and optionally content_vector"""
+    chunks = []
+    for doc in docs:
+        item = {"chunk_index": doc["chunk_index"], "content": doc["content"]}
+        if doc.get("content_vector") is not None:
+            vector = np.asarray(doc["content_vector"], dtype=np.float32)
+            item["vector"] = base64.b64encode(vector.tobytes()).decode("ascii")
+        chunks.append(item)
+    _append([{"op": "add", "filename": filename, "upload_date": upload_date, "chunks": chunks}])
+
+
+def _journal_size(directory, generation):
+    if generation is None:
+        return 0
+    return os.path.getsize(os.path.join(generation_dir(directory, generation), JOURNAL_FILE))
+
+
+def _compact(directory, generation):
+    """Fold the snapshot and its journal into the next generation; the caller holds the lock"""
+    index = LocalIndex(directory)
+    index.refresh()
+    snapshot = index.snapshot
+    files, chunks, file_ids = [], [], {}
+    for chunk in index.chunks:
+        if chunk is None:
+            continue
+        if chunk["filename"] not in file_ids:
+            file_ids[chunk["filename"]] = len(files)
+            files.append({"filename": chunk["filename"], "upload_date": chunk["upload_date"]})
+        chunks.append((file_ids[chunk["filename"]], chunk["chunk_index"], chunk["content"], chunk["vector"]))
+
+    dimensions = snapshot.vectors.shape[1] if snapshot.vectors is not None else None
+    files, arrays = merge_arrays(
+        snapshot.arrays(), ~index._dead_mask(), build_arrays(chunks, dimensions), snapshot.files, files
+    )
+    _publish(directory, generation + 1, files, arrays, is_seeded(directory))
+    logging.info(
+        f"Compacted the local search index into generation {generation + 1} with {len(arrays['chunk_file'])} chunks"
+    )
+
+
+def _publish(directory, generation, files, arrays, seeded):
+    """Write a snapshot generation, point CURRENT at it and remove all but the previous one"""
+    path = generation_dir(directory, generation)
+    shutil.rmtree(path, ignore_errors=True)
+    Snapshot.write(path, files, arrays)
+    _write_current(directory, generation, seeded)
+
+    # Readers still on the previous generation keep its files until their next refresh
+    for name in os.listdir(directory):
+        if name.startswith("gen-") and name < os.path.basename(generation_dir(directory, generation - 1)):
+            shutil.rmtree(os.path.join(directory, name), ignore_errors=True)
+    return generation
+
+
+def _write_current(directory, generation, seeded):
+    current = os.path.join(directory, f"{CURRENT_FILE}.tmp")
+    with open(current, "w", encoding="utf-8") as f:
+        json.dump({"generation": generation, "seeded": seeded}, f)
+    os.replace(current, os.path.join(directory, CURRENT_FILE))
+
+
+def rebuild():
+    """
+    Seed the index from the processed text blobs, without embeddings, for
+    documents uploaded before it existed. Pages through the processed
+    container until LOCAL_SEARCH_SEED_SECONDS runs out, saving the listing's
+    continuation token after every page; returns True once the whole
+    container has been read and the index is marked seeded. Files already in
+    the index, from uploads or an earlier page, keep their indexed chunks and
+    embeddings.
+    """
+    _, directory, _ = local_search_settings()
+    page_size, time_budget = seed_settings()
+    deadline = time.monotonic() + time_budget
+    checkpoint = _load_seed_checkpoint(directory)
+    container_client = clients.get_blob_service_client().get_container_client(manifest.PROCESSED_CONTAINER)
+    pages = container_client.list_blobs(results_per_page=page_size).by_page(continuation_token=checkpoint["token"])
+
+    for page in pages:
+        entries = []
+        for blob in page:
+            if not blob.name.endswith(".txt") or blob.blob_tier == "Archive":
+                continue
+            try:
+                text = container_client.download_blob(blob.name).readall().decode("utf-8")
+            except Exception as e:
+                logging.warning(f"Skipping {blob.name} in the local search rebuild: {str(e)}")
+                continue
+            entries.append({
+                "op": "add",
+                "filename": blob.name[:-len(".txt")],
+                "upload_date": blob.last_modified.isoformat(),
+                "chunks": [
+                    {"chunk_index": index, "content": chunk} for index, chunk in enumerate(chunking.iter_chunks(text))
+                ]
+            })
+        # An upload indexed while this page was read is newer than its processed text
+        checkpoint["documents"] += _append(entries, missing_only=True) if entries else 0
+        checkpoint["token"] = pages.continuation_token
+        if not checkpoint["token"]:
+            break
+        _save_seed_checkpoint(directory, checkpoint)
+        if time.monotonic() >= deadline:
+            logging.info(
+                f"Seeded {checkpoint['documents']} processed documents into the local search index so far, "
+                "continuing on the next run"
+            )
+            return False
+
+    with _locked(directory):
+        generation = current_generation(directory)
+        if generation is None:
+            generation = _publish(directory, 0, [], build_arrays([]), seeded=True)
+        _write_current(directory, generation, seeded=True)
+    try:
+        os.remove(os.path.join(directory, SEED_CHECKPOINT_FILE))
+    except FileNotFoundError:
+        pass
+    logging.info(f"Seeded the local search index from {checkpoint['documents']} processed documents")
+    return True
+
+
+def _load_seed_checkpoint(directory):
+    try:
+        with open(os.path.join(directory, SEED_CHECKPOINT_FILE), encoding="utf-8") as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {"token": None, "documents": 0}
+
+
+def _save_seed_checkpoint(directory, checkpoint):
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"{SEED_CHECKPOINT_FILE}.tmp")
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(checkpoint, f)
+    os.replace(path, os.path.join(directory, SEED_CHECKPOINT_FILE))
@@ -0,0 +1,181 @@
+"""
+Content-addressed manifest of processed documents.
+
+Every upload is keyed by the sha256 of its bytes. The processed text blob of a
+file carries the hash it was built from and whether it was indexed, so an
+unchanged re-upload is detected with a single properties call. A manifest entry
+per hash, in the metadata container, lists the files sharing that content so
+identical files under other names reuse one extraction, and the page texts of
+each PDF are kept by page fingerprint so a changed PDF only re-extracts the
+pages that differ.
+"""
+import json
+import logging
+import os
+import threading
+from datetime import datetime
+
+from azure.core.exceptions import ResourceNotFoundError
+
+from shared_code import clients, ingestion
+
+PROCESSED_CONTAINER = "processed"
+
+_stats_lock = threading.Lock()
+_stats = {
+    "files_seen": 0,
+    "files_skipped": 0,
+    "files_reused": 0,
+    "pages_seen": 0,
+    "pages_reused": 0
+}
+
+
+def processed_blob_name(filename):
+    return f"{filename}.txt"
+
+
+def entry_blob_name(sha):
+    return f"manifests/content/{sha}.json"
+
+
+def pages_blob_name(sha):
+    return f"manifests/pages/{sha}.jsonl"
+
+
+def _metadata_container():
+    blob_service_client = clients.get_blob_service_client()
+    return blob_service_client.get_container_client(os.environ.get("METADATA_CONTAINER_NAME", "metadata"))
+
+
+def _upload(container_client, blob_name, make_data):
+    """Upload the data make_data returns, creating the container on first use"""
+    try:
+        container_client.upload_blob(blob_name, make_data(), overwrite=True)
+    except ResourceNotFoundError:
+        container_client.create_container()
+        container_client.upload_blob(blob_name, make_data(), overwrite=True)
+
+
+def processed_state(filename):
+    """Metadata of the processed text blob of filename, or None if it was never processed"""
+    try:
+        blob_client = clients.get_blob_service_client().get_blob_client(
+            PROCESSED_CONTAINER, processed_blob_name(filename)
+        )
+        return blob_client.get_blob_properties().metadata
+    except ResourceNotFoundError:
+        return None
+
+
+def is_unchanged(state, sha):
+    """True when the processed state was built and indexed from these exact bytes"""
+    return bool(state) and state.get("content_sha256") == sha and state.get("indexed") == "true"
+
+
+def mark_indexed(filename, sha):
+    """Record on the processed blob that its content made it into the search index"""
+    blob_client = clients.get_blob_service_client().get_blob_client(
+        PROCESSED_CONTAINER, processed_blob_name(filename)
+    )
+    blob_client.set_blob_metadata({"content_sha256": sha, "indexed": "true"})
+
+
+def load_entry(sha):
+    """Manifest entry for a content hash, or None"""
+    try:
+        data = _metadata_container().download_blob(entry_blob_name(sha)).readall()
+        return json.loads(data)
+    except ResourceNotFoundError:
+        return None
+
+
+def save_entry(sha, filename, size, indexed):
+    """Add filename to the manifest entry of its content hash"""
+    now = datetime.utcnow().isoformat()
+    entry = load_entry(sha) or {"content_sha256": sha, "size": size, "names": [], "created": now}
+    if filename not in entry["names"]:
+        entry["names"].append(filename)
+    entry["indexed"] = indexed
+    entry["updated"] = now
+    _upload(_metadata_container(), entry_blob_name(sha), lambda: json.dumps(entry).encode("utf-8"))
+
+
+def load_processed_text(sha, entry):
+    """
+    Processed text of another file with the same content, as a SpooledText,
+    or None if none of the files in the entry still holds text for this hash
+    """
+    container_client = clients.get_blob_service_client().get_container_client(PROCESSED_CONTAINER)
+    for name in entry.get("names", []):
+        try:
+            downloader = container_client.download_blob(processed_blob_name(name))
+        except ResourceNotFoundError:
+            continue
+        # The file may have been re-uploaded with other content since
+        if downloader.properties.metadata.get("content_sha256") != sha:
+            continue
+        content = ingestion.SpooledText(separator="")
+        for piece in ingestion.decode_chunks(downloader.chunks()):
+            content.write(piece)
+        return content
+    return None
+
+
+def load_page_texts(sha):
+    """Page texts of a previously processed PDF keyed by page fingerprint"""
+    if not sha:
+        return {}
+    try:
+        downloader = _metadata_container().download_blob(pages_blob_name(sha))
+    except ResourceNotFoundError:
+        return {}
+
+    pages = {}
+    for line in "".join(ingestion.decode_chunks(downloader.chunks())).splitlines():
+        if line:
+            record = json.loads(line)
+            pages[record["page"]] = record["text"]
+    return pages
+
+
+def save_page_texts(sha, pages):
+    """Store the page records of a PDF, a SpooledText of JSON lines"""
+    _upload(
+        _metadata_container(),
+        pages_blob_name(sha),
+        lambda: (piece.encode("utf-8") for piece in pages.iter_pieces())
+    )
+
+
+def record(skipped=False, reused=False, pages_seen=0, pages_reused=0):
+    """Count one processed file towards the skip ratios"""
+    with _stats_lock:
+        _stats["files_seen"] += 1
+        _stats["files_skipped"] += int(skipped)
+        _stats["files_reused"] += int(reused)
+        _stats["pages_seen"] += pages_seen
+        _stats["pages_reused"] += pages_reused
+        snapshot = dict(_stats)
+    logging.info(
+        f"Manifest: skipped {snapshot['files_skipped']}/{snapshot['files_seen']} files "
+        f"({_ratio(snapshot['files_skipped'], snapshot['files_seen']):.0%}), "
+        f"shared {snapshot['files_reused']} extractions, "
+        f"reused {snapshot['pages_reused']}/{snapshot['pages_seen']} pages "
+        f"({_ratio(snapshot['pages_reused'], snapshot['pages_seen']):.0%})"
+    )
+    return snapshot
+
+
+def stats():
+    """Counters and skip ratios for this process"""
+    with _stats_lock:
+        snapshot = dict(_stats)
+    snapshot["file_skip_ratio"] = _ratio(snapshot["files_skipped"], snapshot["files_seen"])
+    snapshot["extraction_reuse_ratio"] = _ratio(snapshot["files_reused"], snapshot["files_seen"])
+    snapshot["page_reuse_ratio"] = _ratio(snapshot["pages_reused"], snapshot["pages_seen"])
+    return snapshot
+
+
+def _ratio(part, whole):
+    return part / whole if whole else 0.0
@@ -0,0 +1,136 @@
+"""
+In-process latency histograms per stage.
+
+Each stage (for example `search`, or `search_cached` for cache hits) counts
+its latencies in fixed buckets growing by a quarter each, from 0.1ms to about
+a minute, so recording is constant time and memory stays fixed however many
+requests a worker serves. Percentiles are read from the bucket bounds. Time
+saved by caches is kept per stage next to the histogram, and a summary of
+every stage is logged at most every METRICS_LOG_INTERVAL_SECONDS.
+"""
+import bisect
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+BUCKET_BOUNDS_MS = tuple(0.1 * 1.25 ** i for i in range(60))
+
+_histograms = {}
+_saved_ms = {}
+_counters = {}
+_lock = threading.Lock()
+_last_logged = time.monotonic()
+
+
+class Histogram:
+    """Counts of latencies per bucket, with the exact count, sum and maximum"""
+
+    def __init__(self):
+        self.buckets = [0] * (len(BUCKET_BOUNDS_MS) + 1)
+        self.count = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+
+    def record(self, elapsed_ms):
+        self.buckets[bisect.bisect_left(BUCKET_BOUNDS_MS, elapsed_ms)] += 1
+        self.count += 1
+        self.total_ms += elapsed_ms
+        self.max_ms = max(self.max_ms, elapsed_ms)
+
+    def percentile(self, p):
+        """Upper bound of the bucket holding the p-th percentile, capped at the maximum seen"""
+        if not self.count:
+            return 0.0
+        rank = p / 100 * self.count
+        seen = 0
+        for index, count in enumerate(self.buckets):
+            seen += count
+            if seen >= rank and count:
+                bound = BUCKET_BOUNDS_MS[index] if index < len(BUCKET_BOUNDS_MS) else self.max_ms
+                return min(bound, self.max_ms)
+        return self.max_ms
+
+    def snapshot(self):
+        return {
+            "count": self.count,
+            "mean_ms": self.total_ms / self.count if self.count else 0.0,
+            "p50_ms": self.percentile(50),
+            "p95_ms": self.percentile(95),
+            "p99_ms": self.percentile(99),
+            "max_ms": self.max_ms
+        }
+
+
+def observe(stage, elapsed_ms):
+    with _lock:
+        histogram = _histograms.get(stage)
+        if histogram is None:
+            histogram = _histograms[stage] = Histogram()
+        histogram.record(elapsed_ms)
+
+
+@contextmanager
+def timer(stage):
+    """Record the time spent in the with block under stage"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(stage, (time.perf_counter() - start) * 1000)
+
+
+def record_saved(stage, saved_ms):
+    """Latency a cache hit avoided for stage"""
+    with _lock:
+        _saved_ms[stage] = _saved_ms.get(stage, 0.0) + saved_ms
+
+
+def count(name, n=1):
+    """Count an event that has no latency, e.g. a coalesced request"""
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + n
+
+
+def counters():
+    with _lock:
+        return dict(_counters)
+
+
+def snapshot():
+    """{stage: histogram snapshot plus saved_ms} for every stage seen"""
+    with _lock:
+        stages = {stage: histogram.snapshot() for stage, histogram in _histograms.items()}
+        for stage, saved in _saved_ms.items():
+            stages.setdefault(stage, Histogram().snapshot())["saved_ms"] = saved
+    return stages
+
+
+def summary():
+    return "; ".join([
+        f"{stage} n={stats['count']} p50={stats['p50_ms']:.1f}ms p95={stats['p95_ms']:.1f}ms "
+        f"max={stats['max_ms']:.1f}ms" + (f" saved={stats['saved_ms']:.0f}ms" if "saved_ms" in stats else "")
+        for stage, stats in sorted(snapshot().items())
+    ] + [f"{name}={value}" for name, value in sorted(counters().items())])
+
+
+def maybe_log_summary():
+    """Log the summary if METRICS_LOG_INTERVAL_SECONDS have passed since the last one"""
+    global _last_logged
+    interval = float(os.environ.get("METRICS_LOG_INTERVAL_SECONDS", "300"))
+    now = time.monotonic()
+    with _lock:
+        if now - _last_logged < interval:
+            return
+        _last_logged = now
+    logging.info(f"Stage latencies: {summary()}")
+
+
+def reset():
+    global _last_logged
+    with _lock:
+        _histograms.clear()
+        _saved_ms.clear()
+        _counters.clear()
+        _last_logged = time.monotonic()
@@ -0,0 +1,192 @@
+"""
+OCR for uploaded images on a shared, bounded process pool.
+
+Each frame of an image (every page of a multi-frame TIFF) is converted to
+greyscale, rescaled to OCR_TARGET_DPI and binarised before Tesseract sees it,
+then recognised on the worker pool. Frames of one document run in parallel and
+are yielded in page order. Every tenant may only have OCR_TENANT_CONCURRENCY
+frames on the pool at a time, so one large batch cannot starve other users.
+Pillow and pytesseract are imported with the first image.
+"""
+import logging
+import multiprocessing
+import multiprocessing.util
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from shared_code import extraction
+
+# Page width assumed when an image carries no DPI information (US letter)
+ASSUMED_PAGE_WIDTH_INCHES = 8.5
+
+_pool = None
+_pool_workers = None
+_pool_lock = threading.Lock()
+
+_tenant_limits = {}
+_tenant_lock = threading.Lock()
+
+
+def ocr_settings():
+    """Pool size, target DPI, binarisation, per-tenant limit and per-frame timeout from the environment"""
+    workers = int(os.environ.get("OCR_WORKERS", str(extraction.worker_budget())))
+    target_dpi = int(os.environ.get("OCR_TARGET_DPI", "300"))
+    binarize = os.environ.get("OCR_BINARIZE", "true").lower() == "true"
+    tenant_concurrency = int(os.environ.get("OCR_TENANT_CONCURRENCY", "2"))
+    frame_timeout = float(os.environ.get("OCR_FRAME_TIMEOUT_SECONDS", "60"))
+    return max(1, workers), target_dpi, binarize, max(1, tenant_concurrency), frame_timeout
+
+
+def tenant_of(filename):
+    """Tenant of an uploaded blob: its first path segment, or "default" for top-level blobs"""
+    return filename.split("/", 1)[0] if "/" in filename else "default"
+
+
+def get_pool():
+    """The process pool shared by every OCR call in this worker process"""
+    global _pool, _pool_workers
+    workers = ocr_settings()[0]
+    if _pool is None or _pool_workers != workers:
+        with _pool_lock:
+            if _pool is None or _pool_workers != workers:
+                if _pool is not None:
+                    _pool.shutdown(wait=False)
+                # Spawned rather than forked: the worker process already runs threads
+                _pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+                _pool_workers = workers
+                # A multiprocessing child (a bulk worker) never runs the executor's atexit hook and would wait on
+                # the workers forever; shut down ahead of the call queue's own finalizer, which runs at priority 10
+                multiprocessing.util.Finalize(_pool, _pool.shutdown, exitpriority=20)
+    return _pool
+
+
+def reset_pool():
+    """Shut the pool down; the next OCR call starts a new one"""
+    global _pool, _pool_workers
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
+        _pool_workers = None
+
+
+def _tenant_limit(tenant, concurrency):
+    with _tenant_lock:
+        limit = _tenant_limits.get(tenant)
+        if limit is None or limit[0] != concurrency:
+            limit = (concurrency, threading.BoundedSemaphore(concurrency))
+            _tenant_limits[tenant] = limit
+        return limit[1]
+
+
+def source_dpi(image):
+    """DPI the image was scanned at, estimated from its width when not recorded"""
+    dpi = image.info.get("dpi")
+    if dpi and dpi[0]:
+        return float(dpi[0])
+    return image.width / ASSUMED_PAGE_WIDTH_INCHES
+
+
+def preprocess(frame, target_dpi, binarize=True):
+    """
+    Greyscale, rescale to target_dpi and optionally binarise one frame.
+    Returns the (mode, size, pixels, dpi) sent to a pool worker.
+    """
+    from PIL import Image, ImageOps
+
+    dpi = source_dpi(frame)
+    image = ImageOps.grayscale(frame.convert("RGB") if frame.mode in ("P", "RGBA", "LA", "CMYK") else frame)
+
+    # Scans well above the target only cost Tesseract time; small ones lose characters
+    scale = target_dpi / dpi
+    if abs(scale - 1) > 0.1:
+        scale = min(max(scale, 0.1), 2.0)
+        size = (max(1, round(image.width * scale)), max(1, round(image.height * scale)))
+        image = image.resize(size, Image.LANCZOS if scale < 1 else Image.BICUBIC, reducing_gap=3.0)
+        dpi = dpi * scale
+
+    if binarize:
+        image = ImageOps.autocontrast(image, cutoff=1)
+        image = image.point(lambda value: 255 if value > 160 else 0, mode="1")
+
+    return image.mode, image.size, image.tobytes(), round(dpi)
+
+
+def iter_frames(stream):
+    """Yield every frame of an image; single-frame formats yield one"""
+    from PIL import Image, ImageSequence
+
+    image = Image.open(stream)
+    for frame in ImageSequence.Iterator(image):
+        # The frame must be copied before the iterator seeks to the next one
+        yield frame.copy()
+
+
+def iter_image_text(stream, tenant="default"):
+    """Yield the OCR text of each frame of an image in order"""
+    _, target_dpi, binarize, tenant_concurrency, frame_timeout = ocr_settings()
+    limit = _tenant_limit(tenant, tenant_concurrency)
+    pool = get_pool()
+    pending = deque()
+    frames = 0
+    start = time.perf_counter()
+
+    try:
+        for frame in iter_frames(stream):
+            prepared = preprocess(frame, target_dpi, binarize)
+            frames += 1
+
+            # Blocks while this tenant already has its share of frames on the pool
+            limit.acquire()
+            try:
+                future = pool.submit(_recognize, prepared, frame_timeout)
+            except Exception:
+                limit.release()
+                raise
+            future.add_done_callback(lambda _: limit.release())
+            pending.append((frames, future))
+
+            while pending and pending[0][1].done():
+                yield _frame_text(*pending.popleft())
+
+        while pending:
+            yield _frame_text(*pending.popleft())
+    except BrokenProcessPool:
+        reset_pool()
+        raise
+    finally:
+        for _, future in pending:
+            future.cancel()
+
+    logging.info(f"OCR of {frames} frames for tenant {tenant} took {(time.perf_counter() - start) * 1000:.0f}ms")
+
+
+def _frame_text(number, future):
+    try:
+        return future.result()
+    except BrokenProcessPool:
+        raise
+    except RuntimeError as e:
+        # Tesseract errors and timeouts only lose this frame
+        logging.warning(f"OCR failed for frame {number}: {str(e)}")
+        return ""
+
+
+def _recognize(prepared, timeout):
+    from PIL import Image
+    import pytesseract
+
+    mode, size, pixels, dpi = prepared
+    image = Image.frombytes(mode, size, pixels)
+    # Tesseract runs as a subprocess, so the timeout kills a stuck page
+    try:
+        return pytesseract.image_to_string(image, config=f"--dpi {dpi}", timeout=timeout).strip()
+    except pytesseract.TesseractNotFoundError as e:
+        # pytesseract's exceptions do not survive pickling back to the caller
+        raise OSError(str(e))
+    except pytesseract.TesseractError as e:
+        raise RuntimeError(str(e))
@@ -0,0 +1,201 @@
+"""
+Client-side rate limiting for Azure OpenAI chat completions.
+
+Each call takes one request from an OPENAI_RPM bucket and its estimated tokens
+(prompt plus max_tokens, as Azure counts them) from an OPENAI_TPM bucket, both
+refilled continuously and holding at most OPENAI_RATE_BURST_SECONDS of quota,
+since Azure enforces per-minute quotas over windows of a few seconds. Callers that do not fit wait in arrival order instead of
+being sent to fail, for at most OPENAI_QUEUE_TIMEOUT_SECONDS. A 429 pauses every
+caller for the Retry-After the service sent and the call is retried, as are
+timeouts and 5xx errors with exponential backoff, up to OPENAI_MAX_RETRIES.
+A call's token estimate is taken once, however often it is retried, and
+settled against the usage the response reports.
+The quotas are per worker process: divide the deployment's quota by the number
+of processes that share it. A quota of 0 leaves that bucket unlimited.
+"""
+import asyncio
+import logging
+import os
+import random
+import threading
+import time
+import weakref
+
+from shared_code import context_packing, metrics, tracing
+
+_limiters = weakref.WeakKeyDictionary()
+_lock = threading.Lock()
+
+
+class QueueTimeout(Exception):
+    """The rate limit queue did not admit a call within OPENAI_QUEUE_TIMEOUT_SECONDS"""
+
+
+def rate_limit_settings():
+    """Requests and tokens per minute, burst length, retries, and the longest a call may queue"""
+    requests_per_minute = float(os.environ.get("OPENAI_RPM", "0"))
+    tokens_per_minute = float(os.environ.get("OPENAI_TPM", "0"))
+    burst_seconds = float(os.environ.get("OPENAI_RATE_BURST_SECONDS", "10"))
+    max_retries = int(os.environ.get("OPENAI_MAX_RETRIES", "5"))
+    queue_timeout = float(os.environ.get("OPENAI_QUEUE_TIMEOUT_SECONDS", "120"))
+    return requests_per_minute, tokens_per_minute, burst_seconds, max_retries, queue_timeout
+
+
+class TokenBucket:
+    """Holds up to burst_seconds of quota and refills it continuously; rate 0 means unlimited"""
+
+    def __init__(self, per_minute, burst_seconds):
+        self.rate = per_minute / 60.0
+        self.capacity = max(self.rate * burst_seconds, 1.0)
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount, now):
+        """Seconds until amount is available, 0 if it is now"""
+        if not self.rate:
+            return 0.0
+        self._refill(now)
+        amount = min(amount, self.capacity)
+        return max(0.0, (amount - self.level) / self.rate)
+
+    def take(self, amount, now):
+        if self.rate:
+            self._refill(now)
+            self.level -= min(amount, self.capacity)
+
+    def adjust(self, amount):
+        """Return (negative) or charge tokens once the real usage is known"""
+        if self.rate:
+            self.level = min(self.capacity, self.level - amount)
+
+
+class RateLimiter:
+    """FIFO admission through the request and token buckets, paused after a 429"""
+
+    def __init__(self, requests_per_minute, tokens_per_minute, burst_seconds, queue_timeout):
+        self.settings = (requests_per_minute, tokens_per_minute, burst_seconds, queue_timeout)
+        self.requests = TokenBucket(requests_per_minute, burst_seconds)
+        self.tokens = TokenBucket(tokens_per_minute, burst_seconds)
+        self.queue_timeout = queue_timeout
+        self.paused_until = 0.0
+        self.waiting = 0
+        # asyncio.Lock wakes its waiters in arrival order
+        self._turn = asyncio.Lock()
+
+    async def acquire(self, tokens):
+        """Wait for this call's turn and quota; raises QueueTimeout past the deadline"""
+        start = time.monotonic()
+        deadline = start + self.queue_timeout
+        self.waiting += 1
+        try:
+            async with self._turn:
+                while True:
+                    now = time.monotonic()
+                    wait = max(self.paused_until - now, self.requests.wait_time(1, now),
+                               self.tokens.wait_time(tokens, now))
+                    if wait <= 0:
+                        self.requests.take(1, now)
+                        self.tokens.take(tokens, now)
+                        break
+                    if now + wait > deadline:
+                        raise QueueTimeout(f"Waited {now - start:.1f}s for the OpenAI rate limit, {self.waiting} queued")
+                    await asyncio.sleep(wait)
+        finally:
+            self.waiting -= 1
+        metrics.observe("openai_queue", (time.monotonic() - start) * 1000)
+
+    def pause(self, seconds):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+
+def get_limiter():
+    """The rate limiter for the running event loop, rebuilt when the settings change"""
+    requests_per_minute, tokens_per_minute, burst_seconds, _, queue_timeout = rate_limit_settings()
+    settings = (requests_per_minute, tokens_per_minute, burst_seconds, queue_timeout)
+    loop = asyncio.get_running_loop()
+    with _lock:
+        limiter = _limiters.get(loop)
+        if limiter is None or limiter.settings != settings:
+            limiter = _limiters[loop] = RateLimiter(*settings)
+    return limiter
+
+
+def estimate_tokens(options):
+    """Tokens Azure counts against the quota before answering: prompt plus max_tokens"""
+    prompt = sum(context_packing.count_tokens(message["content"]) for message in options.get("messages", []))
+    return prompt + options.get("max_tokens", 16)
+
+
+def retry_after(error):
+    """Seconds the service asked to wait, from the retry-after-ms or retry-after header"""
+    headers = getattr(getattr(error, "response", None), "headers", None) or {}
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        if headers.get("retry-after"):
+            return float(headers["retry-after"])
+    except ValueError:
+        pass
+    return None
+
+
+async def create_chat_completion(client, **options):
+    """
+    client.chat.completions.create through the rate limiter, retrying 429s
+    after Retry-After and transient failures with backoff. The client should
+    not retry itself (clients.get_async_openai_client(max_retries=0)), or its
+    retries would skip the queue.
+    """
+    # Loaded with the client by now; imported here so importing this module does not load the SDK
+    import openai
+
+    max_retries = rate_limit_settings()[3]
+    limiter = get_limiter()
+    estimate = estimate_tokens(options)
+
+    # The estimate is charged once per call, when it is first admitted; retries only take a request
+    charge = estimate
+    # A call whose last attempt was answered with a 429 has used no quota, so its estimate is returned
+    rejected = False
+    settled = False
+    attempt = 0
+    try:
+        while True:
+            await limiter.acquire(charge)
+            charge = 0
+            try:
+                response = await client.chat.completions.create(**options)
+            except openai.RateLimitError as e:
+                rejected = True
+                if attempt >= max_retries:
+                    raise
+                delay = retry_after(e) or min(60.0, 2 ** attempt)
+                limiter.pause(delay)
+                metrics.count("openai_429")
+                logging.warning(f"OpenAI rate limited, pausing calls for {delay:.1f}s (attempt {attempt + 1})")
+            except (openai.APIConnectionError, openai.InternalServerError) as e:
+                rejected = False
+                if attempt >= max_retries:
+                    raise
+                delay = min(30.0, 2 ** attempt) * (0.5 + random.random() / 2)
+                logging.warning(f"OpenAI call failed, retrying in {delay:.1f}s: {str(e)}")
+                await asyncio.sleep(delay)
+            else:
+                # Settle the estimate against what the call really used
+                usage = getattr(response, "usage", None)
+                if usage is not None and usage.total_tokens:
+                    limiter.tokens.adjust(usage.total_tokens - estimate)
+                    tracing.annotate(tokens=usage.total_tokens, prompt_tokens=usage.prompt_tokens)
+                else:
+                    tracing.annotate(estimated_tokens=estimate)
+                tracing.annotate(attempts=attempt + 1)
+                settled = True
+                return response
+            attempt += 1
+    finally:
+        if rejected and not settled:
+            limiter.tokens.adjust(-estimate)
@@ -0,0 +1,134 @@
+"""
+Retrieval cache for AIQueryProcessor.
+
+Search results are cached for RETRIEVAL_CACHE_TTL_SECONDS under the
+normalised query, filter, top, skip, whether the search was hybrid, and the
+index generation: a counter that index_document bumps after every (re)index,
+so results from before a document changed are never served again. The
+generation is read before searching, so results fetched while a bump happens
+are stored under the old generation and never hit. Query embeddings do not
+depend on the index and are cached for EMBEDDING_CACHE_TTL_SECONDS. Entries
+use the same backends as the answer cache, with LRU eviction for the memory
+and file ones. A bump made by the upload function only reaches query
+workers that share the backend, so search results are not cached on the
+default memory backend. The file backend is shared by the worker processes of
+one instance only: its SQLite file lives in the instance's temp directory, so
+on a scaled-out app an upload handled elsewhere leaves its results stale for
+up to RETRIEVAL_CACHE_TTL_SECONDS. Only redis is shared across instances.
+Embeddings are cached on every backend.
+"""
+import hashlib
+import logging
+import os
+import threading
+
+from shared_code import answer_cache
+
+GENERATION_KEY = "retrieval:generation"
+
+# Backends whose index generation is seen by more than one process: file
+# within an instance, redis across instances
+SHARED_BACKENDS = ("file", "redis")
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_retrieval_cache():
+    """Return the process-wide retrieval cache configured from the environment, or None if disabled"""
+    global _cache
+    backend_name = os.environ.get("RETRIEVAL_CACHE_BACKEND", "memory").lower()
+    if backend_name == "none":
+        return None
+
+    if _cache is None or _cache.backend_name != backend_name:
+        with _cache_lock:
+            if _cache is None or _cache.backend_name != backend_name:
+                _cache = RetrievalCache(
+                    answer_cache.build_backend(backend_name, "RETRIEVAL_CACHE"),
+                    backend_name,
+                    ttl_seconds=int(os.environ.get("RETRIEVAL_CACHE_TTL_SECONDS", "60")),
+                    embedding_ttl_seconds=int(os.environ.get("EMBEDDING_CACHE_TTL_SECONDS", "86400"))
+                )
+    return _cache
+
+
+def bump_generation():
+    """Make every cached search result stale, e.g. after the index changed"""
+    cache = get_retrieval_cache()
+    if cache is None or not cache.caches_results:
+        return
+    try:
+        cache.backend.incr(GENERATION_KEY)
+    except Exception as e:
+        logging.warning(f"Failed to bump the retrieval cache generation: {str(e)}")
+
+
+def _digest(*parts):
+    return hashlib.sha256("\x1f".join(parts).encode("utf-8")).hexdigest()
+
+
+class RetrievalCache:
+    """Search results keyed by query, options and index generation, and query embeddings keyed by query"""
+
+    def __init__(self, backend, backend_name, ttl_seconds=60, embedding_ttl_seconds=86400):
+        self.backend = backend
+        self.backend_name = backend_name
+        self.ttl_seconds = ttl_seconds
+        self.embedding_ttl_seconds = embedding_ttl_seconds
+        self.caches_results = backend_name in SHARED_BACKENDS
+
+    def results_key(self, query, top, skip=0, filter=None, hybrid=False):
+        """
+        Cache key for a search at the current index generation, or None if
+        results are not cached on this backend or the generation is unavailable
+        """
+        if not self.caches_results:
+            return None
+        try:
+            generation = self.backend.counter(GENERATION_KEY)
+        except Exception as e:
+            logging.warning(f"Failed to read the retrieval cache generation: {str(e)}")
+            return None
+        return "results:" + _digest(
+            answer_cache.normalize_query(query), str(top), str(skip or 0), filter or "",
+            "hybrid" if hybrid else "text", str(generation)
+        )
+
+    def get_results(self, key):
+        """The cached {"docs", "search_ms"} entry for key, or None"""
+        if key is None:
+            return None
+        try:
+            return self.backend.get(key)
+        except Exception as e:
+            logging.warning(f"Retrieval cache lookup failed: {str(e)}")
+            return None
+
+    def store_results(self, key, relevant_docs, search_ms):
+        if key is None:
+            return
+        try:
+            self.backend.set(key, {"docs": relevant_docs, "search_ms": search_ms}, self.ttl_seconds)
+        except Exception as e:
+            logging.warning(f"Retrieval cache store failed: {str(e)}")
+
+    def embedding_key(self, query, deployment):
+        return "embedding:" + _digest(answer_cache.normalize_query(query), deployment)
+
+    def get_embedding(self, query, deployment):
+        """The cached {"embedding", "embed_ms"} entry for the query, or None"""
+        try:
+            return self.backend.get(self.embedding_key(query, deployment))
+        except Exception as e:
+            logging.warning(f"Embedding cache lookup failed: {str(e)}")
+            return None
+
+    def store_embedding(self, query, deployment, embedding, embed_ms):
+        try:
+            self.backend.set(
+                self.embedding_key(query, deployment), {"embedding": embedding, "embed_ms": embed_ms},
+                self.embedding_ttl_seconds
+            )
+        except Exception as e:
+            logging.warning(f"Embedding cache store failed: {str(e)}")
@@ -0,0 +1,48 @@
+"""
+Request coalescing for AIQueryProcessor.
+
+Concurrent calls with the same key share one in-flight task: the first caller
+starts it and every caller that arrives before it finishes awaits the same
+result, so a burst of identical questions costs one search and one completion.
+The task is shielded from the callers, so a caller that disconnects does not
+cancel the work the others are waiting on. Only calls that overlap are
+coalesced; later repeats are the caches' job.
+"""
+import asyncio
+import os
+import threading
+import weakref
+
+from shared_code import metrics
+
+_flights = weakref.WeakKeyDictionary()
+_lock = threading.Lock()
+
+
+def single_flight_enabled():
+    return os.environ.get("SINGLE_FLIGHT_ENABLED", "true").lower() == "true"
+
+
+def _in_flight():
+    """{key: task} for the running event loop"""
+    loop = asyncio.get_running_loop()
+    with _lock:
+        tasks = _flights.get(loop)
+        if tasks is None:
+            tasks = _flights[loop] = {}
+    return tasks
+
+
+async def run(key, make_coroutine):
+    """Await make_coroutine(), or the identical call already in flight under key"""
+    if not single_flight_enabled():
+        return await make_coroutine()
+
+    tasks = _in_flight()
+    task = tasks.get(key)
+    if task is None:
+        task = tasks[key] = asyncio.ensure_future(make_coroutine())
+        task.add_done_callback(lambda done: tasks.pop(key, None) if tasks.get(key) is done else None)
+    else:
+        metrics.count(f"coalesced_{key[0]}")
+    return await asyncio.shield(task)
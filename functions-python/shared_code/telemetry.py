@@ -0,0 +1,286 @@
+"""
+Buffered JSON Lines telemetry.
+
+Tracking events (queries, document accesses, lifecycle journal entries) used
+to be written as one blob each after a container check: three requests per
+event, and two events in the same second overwrote each other. write() now
+only adds the event to an in-memory buffer for its stream and hour. A
+background thread appends each buffer to blob storage as a single append block
+once it holds TELEMETRY_FLUSH_BYTES or its oldest event is
+TELEMETRY_FLUSH_SECONDS old, and whatever is left is flushed when the process
+exits. Every process appends to its own blob per stream and hour,
+`{stream}{YYYYMMDDHH}/{instance}.jsonl`, so writers never contend for a blob,
+no blob nears the append block limit and readers know when an hour is final.
+"""
+import atexit
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+
+from azure.core.exceptions import ResourceExistsError, ResourceNotFoundError
+
+from shared_code import clients
+
+ACCESS_STREAM = "access_logs/"
+QUERY_STREAM = "queries/"
+
+# Limits of one append block and of the blocks in one append blob
+MAX_BLOCK_BYTES = 4 * 1024 * 1024
+MAX_BLOCKS = 50000
+
+# An hour's blobs take no more appends once the hour ended this long ago
+SEAL_SECONDS = 600
+
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def telemetry_settings():
+    """Buffer size and age that trigger a flush, and the most a process holds while storage is unreachable"""
+    flush_bytes = int(os.environ.get("TELEMETRY_FLUSH_BYTES", str(256 * 1024)))
+    flush_seconds = float(os.environ.get("TELEMETRY_FLUSH_SECONDS", "5"))
+    max_buffer_bytes = int(os.environ.get("TELEMETRY_MAX_BUFFER_BYTES", str(16 * 1024 * 1024)))
+    return min(flush_bytes, MAX_BLOCK_BYTES), flush_seconds, max_buffer_bytes
+
+
+def hour_of(timestamp=None):
+    return datetime.utcfromtimestamp(time.time() if timestamp is None else timestamp).strftime("%Y%m%d%H")
+
+
+def blob_hour(blob_name, stream):
+    """The YYYYMMDDHH partition of a blob in stream, or None for a blob that is not partitioned by hour"""
+    hour = blob_name[len(stream):len(stream) + 10]
+    return hour if len(hour) == 10 and hour.isdigit() and blob_name[len(stream) + 10:][:1] in ("/", ".") else None
+
+
+def is_sealed(hour, now=None):
+    """Whether an hour's blobs are final: it ended more than SEAL_SECONDS ago"""
+    end = datetime.strptime(hour, "%Y%m%d%H").replace(tzinfo=timezone.utc).timestamp() + 3600
+    return (time.time() if now is None else now) >= end + SEAL_SECONDS
+
+
+class TelemetryWriter:
+    """Per-stream, per-hour line buffers flushed to append blobs by a daemon thread"""
+
+    def __init__(self, container_name=None, instance=None):
+        self.container_name = container_name or os.environ.get("METADATA_CONTAINER_NAME", "metadata")
+        self.instance = instance or uuid.uuid4().hex[:12]
+        self.flush_bytes, self.flush_seconds, self.max_buffer_bytes = telemetry_settings()
+        self.stats = {"written": 0, "flushed": 0, "appends": 0, "dropped": 0, "failed_flushes": 0}
+        # {(stream, hour): {"lines": [bytes], "bytes": int, "since": monotonic time of the oldest line}}
+        self._buffers = {}
+        self._buffered_bytes = 0
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+        self._closed = False
+        self._container_ready = False
+        # Blocks appended per blob this process created, and the current part per (stream, hour)
+        self._blocks = {}
+        self._parts = {}
+
+    def write(self, stream, record):
+        """Buffer one event; never blocks on storage"""
+        line = (json.dumps(record) + "\n").encode("utf-8")
+        key = (stream, hour_of())
+        with self._lock:
+            buffer = self._buffers.get(key)
+            if buffer is None:
+                buffer = self._buffers[key] = {"lines": [], "bytes": 0, "since": time.monotonic()}
+            buffer["lines"].append(line)
+            buffer["bytes"] += len(line)
+            self._buffered_bytes += len(line)
+            self.stats["written"] += 1
+            if self._buffered_bytes > self.max_buffer_bytes:
+                self._drop_oldest()
+            full = buffer["bytes"] >= self.flush_bytes
+
+        self._start()
+        if full:
+            self._wake.set()
+
+    def _drop_oldest(self):
+        """Storage has been unreachable for a while: lose the oldest events rather than grow without bound"""
+        dropped = 0
+        for key in sorted(self._buffers, key=lambda key: self._buffers[key]["since"]):
+            buffer = self._buffers[key]
+            while buffer["lines"] and self._buffered_bytes > self.max_buffer_bytes:
+                line = buffer["lines"].pop(0)
+                buffer["bytes"] -= len(line)
+                self._buffered_bytes -= len(line)
+                dropped += 1
+            if not buffer["lines"]:
+                del self._buffers[key]
+            if self._buffered_bytes <= self.max_buffer_bytes:
+                break
+        self.stats["dropped"] += dropped
+        logging.warning(f"Telemetry buffer full, dropped {dropped} events")
+
+    def _start(self):
+        if self._thread is None and not self._closed:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name="telemetry-flush", daemon=True)
+                    self._thread.start()
+
+    def _run(self):
+        while not self._closed:
+            self._wake.wait(self.flush_seconds / 2)
+            self._wake.clear()
+            self.flush(due_only=True)
+
+    def flush(self, due_only=False):
+        """Append buffered events to their blobs; returns the number of events written"""
+        with self._flush_lock:
+            now = time.monotonic()
+            current_hour = hour_of()
+            with self._lock:
+                due = [
+                    key for key, buffer in self._buffers.items()
+                    if not due_only or buffer["bytes"] >= self.flush_bytes
+                    or now - buffer["since"] >= self.flush_seconds or key[1] != current_hour
+                ]
+                batches = [(key, self._buffers.pop(key)) for key in due]
+                self._buffered_bytes -= sum(buffer["bytes"] for _, buffer in batches)
+
+            flushed = 0
+            for (stream, hour), buffer in batches:
+                # Readers treat sealed hours as final, so late events go to the current hour
+                hour = current_hour if is_sealed(hour) else hour
+                try:
+                    self._append(stream, hour, buffer["lines"])
+                    flushed += len(buffer["lines"])
+                except Exception as e:
+                    self.stats["failed_flushes"] += 1
+                    logging.warning(f"Failed to flush {len(buffer['lines'])} telemetry events to {stream}: {str(e)}")
+                    self._requeue((stream, hour), buffer)
+
+            self.stats["flushed"] += flushed
+            return flushed
+
+    def _requeue(self, key, buffer):
+        """Put a failed batch back ahead of anything buffered since, for the next flush"""
+        with self._lock:
+            newer = self._buffers.get(key)
+            if newer is not None:
+                buffer["lines"].extend(newer["lines"])
+                buffer["bytes"] += newer["bytes"]
+                self._buffered_bytes -= newer["bytes"]
+            self._buffers[key] = buffer
+            self._buffered_bytes += buffer["bytes"]
+            if self._buffered_bytes > self.max_buffer_bytes:
+                self._drop_oldest()
+
+    def _append(self, stream, hour, lines):
+        container_client = clients.get_blob_service_client().get_container_client(self.container_name)
+        for block in _blocks_of(lines):
+            name = self._blob_name(stream, hour)
+            blob_client = container_client.get_blob_client(name)
+            if name not in self._blocks:
+                self._create(container_client, blob_client)
+                self._blocks[name] = 0
+            try:
+                blob_client.append_block(block)
+            except ResourceNotFoundError:
+                # Deleted by a reader, e.g. after a long outage; start it again
+                self._create(container_client, blob_client)
+                blob_client.append_block(block)
+            self._blocks[name] += 1
+            self.stats["appends"] += 1
+
+    def _blob_name(self, stream, hour):
+        part = self._parts.get((stream, hour), 0)
+        name = f"{stream}{hour}/{self.instance}{f'-{part}' if part else ''}.jsonl"
+        if self._blocks.get(name, 0) >= MAX_BLOCKS:
+            self._parts[(stream, hour)] = part + 1
+            return self._blob_name(stream, hour)
+        return name
+
+    def _create(self, container_client, blob_client):
+        # Checked once per process rather than once per event
+        if not self._container_ready:
+            try:
+                container_client.create_container()
+            except ResourceExistsError:
+                pass
+            self._container_ready = True
+        try:
+            blob_client.create_append_blob(if_none_match="*")
+        except ResourceExistsError:
+            pass
+
+    def close(self):
+        """Flush everything and stop the background thread"""
+        self._closed = True
+        self._wake.set()
+        self.flush()
+
+
+def _blocks_of(lines):
+    """Join lines into append blocks of at most MAX_BLOCK_BYTES, never splitting a line"""
+    block = []
+    size = 0
+    for line in lines:
+        if block and size + len(line) > MAX_BLOCK_BYTES:
+            yield b"".join(block)
+            block, size = [], 0
+        block.append(line)
+        size += len(line)
+    if block:
+        yield b"".join(block)
+
+
+def get_writer():
+    global _writer
+    if _writer is None:
+        with _writer_lock:
+            if _writer is None:
+                _writer = TelemetryWriter()
+                atexit.register(_writer.close)
+    return _writer
+
+
+def write(stream, record):
+    get_writer().write(stream, record)
+
+
+def flush():
+    """Write out buffered events now, e.g. before reading them back in the same process"""
+    if _writer is not None:
+        return _writer.flush()
+    return 0
+
+
+def reset_writer():
+    """Flush and drop the process writer, e.g. after changing settings in a benchmark"""
+    global _writer
+    if _writer is not None:
+        _writer.close()
+        atexit.unregister(_writer.close)
+        _writer = None
+
+
+async def read_lines(container_client, blob_name, offset, size):
+    """
+    Records appended to a JSON Lines blob between offset and size, and the
+    offset after the last complete line. Appends always end in a newline, so a
+    partial line can only come from reading mid-append and is read next time.
+    """
+    if size <= offset:
+        return [], offset
+    downloader = await container_client.download_blob(blob_name, offset=offset, length=size - offset)
+    data = await downloader.readall()
+    complete = data[:data.rfind(b"\n") + 1]
+    records = []
+    for line in complete.splitlines():
+        if line:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                logging.warning(f"Skipping malformed telemetry line in {blob_name}")
+    return records, offset + len(complete)
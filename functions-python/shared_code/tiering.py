@@ -0,0 +1,182 @@
+"""
+Moves blobs between storage tiers.
+
+A move within one container is a single server-side set_standard_blob_tier
+call; with the default, distinct container names every move is a copy. A move
+to another container starts a server-side copy that also sets the target's
+access tier, polls it with exponential backoff until it finishes or
+COPY_TIMEOUT_SECONDS runs out, and only then deletes the source. Moves run
+concurrently on the async Blob client, at most LIFECYCLE_MOVE_CONCURRENCY at a
+time, and each one reports its own result instead of failing the batch.
+
+The archive container keeps its blobs at ARCHIVE_BLOB_TIER, Cold by default,
+so archived documents stay readable. Archive is an explicit opt-in: blobs in
+that tier are offline until rehydrated.
+"""
+import asyncio
+import logging
+import os
+import time
+
+from azure.storage.blob import StandardBlobTier
+
+from shared_code import clients, tracing
+
+# Colder tiers sort higher; moves only ever go to a colder tier
+TIER_ORDER = {"Hot": 0, "Cool": 1, "Cold": 2, "Archive": 3}
+
+
+class CopyPending(Exception):
+    """A server-side copy was still pending at COPY_TIMEOUT_SECONDS and has been aborted"""
+
+
+def mover_settings():
+    """Concurrency, first and longest poll interval and copy timeout from the environment"""
+    concurrency = int(os.environ.get("LIFECYCLE_MOVE_CONCURRENCY", "16"))
+    poll_initial = float(os.environ.get("COPY_POLL_INITIAL_SECONDS", "0.5"))
+    poll_max = float(os.environ.get("COPY_POLL_MAX_SECONDS", "30"))
+    copy_timeout = float(os.environ.get("COPY_TIMEOUT_SECONDS", "600"))
+    return max(1, concurrency), poll_initial, poll_max, copy_timeout
+
+
+def archive_tier():
+    """Access tier of the archive container, from the environment; Archive only when asked for"""
+    tier = os.environ.get("ARCHIVE_BLOB_TIER", "Cold").capitalize()
+    if tier not in TIER_ORDER or tier == "Hot":
+        logging.warning(f"Unsupported ARCHIVE_BLOB_TIER {tier}, using Cold")
+        return "Cold"
+    return tier
+
+
+def container_tier(container_name):
+    """Access tier that blobs in a lifecycle container are kept at"""
+    if container_name == os.environ.get("ARCHIVE_CONTAINER_NAME", "archive"):
+        return archive_tier()
+    if container_name == os.environ.get("HOT_CONTAINER_NAME", "hot-documents"):
+        return "Hot"
+    return "Cool"
+
+
+def plan_move(blob_name, source_container, target_container, current_tier=None):
+    """A move request for move_blobs; current_tier lets no-op tier changes be skipped"""
+    return {
+        "name": blob_name,
+        "source": source_container,
+        "target": target_container,
+        "tier": container_tier(target_container),
+        "current_tier": current_tier
+    }
+
+
+@tracing.traced()
+def move_blobs(moves):
+    """Apply moves concurrently from synchronous code; returns one result per move"""
+    results = asyncio.run(_move_all(moves))
+    tracing.annotate(moves=len(moves), failed=sum(1 for result in results if result["error"]))
+    return results
+
+
+async def move_blobs_async(moves, semaphore=None):
+    """
+    Apply moves concurrently on the running loop; returns one result per move.
+    Callers running several batches at once can share one semaphore between them.
+    """
+    concurrency, poll_initial, poll_max, copy_timeout = mover_settings()
+    blob_service_client = clients.get_async_blob_service_client()
+    semaphore = semaphore or asyncio.Semaphore(concurrency)
+    return await asyncio.gather(*(
+        _move_one(blob_service_client, move, semaphore, poll_initial, poll_max, copy_timeout)
+        for move in moves
+    ))
+
+
+async def _move_all(moves):
+    try:
+        return await move_blobs_async(moves)
+    finally:
+        # The aio transport must close before asyncio.run closes its loop
+        await clients.close_async_clients()
+
+
+async def _move_one(blob_service_client, move, semaphore, poll_initial, poll_max, copy_timeout):
+    result = {
+        "name": move["name"],
+        "source": move["source"],
+        "target": move["target"],
+        "tier": move["tier"],
+        "status": None,
+        "polls": 0,
+        "error": None
+    }
+    start = time.perf_counter()
+
+    async with semaphore:
+        try:
+            if move["source"] == move["target"]:
+                result["status"] = await _set_tier(blob_service_client, move)
+            else:
+                result["polls"] = await _copy_and_delete(
+                    blob_service_client, move, poll_initial, poll_max, copy_timeout
+                )
+                result["status"] = "moved"
+        except CopyPending:
+            result["status"] = "timeout"
+            result["error"] = f"Copy still pending after {copy_timeout}s"
+        except Exception as e:
+            result["status"] = "failed"
+            # Transport timeouts carry no message, and an empty error would read as success
+            result["error"] = str(e) or type(e).__name__
+
+    result["elapsed_ms"] = (time.perf_counter() - start) * 1000
+    if result["error"]:
+        logging.error(f"Failed to move blob {move['name']} to {move['target']}: {result['error']}")
+    return result
+
+
+async def _set_tier(blob_service_client, move):
+    current = TIER_ORDER.get(move.get("current_tier") or "Hot", 0)
+    if current >= TIER_ORDER[move["tier"]]:
+        return "unchanged"
+    blob_client = blob_service_client.get_blob_client(move["source"], move["name"])
+    await blob_client.set_standard_blob_tier(StandardBlobTier(move["tier"]))
+    return "retiered"
+
+
+async def _copy_and_delete(blob_service_client, move, poll_initial, poll_max, copy_timeout):
+    """Copy server-side, wait for the copy with backoff, then delete the source; returns the poll count"""
+    source_blob_client = blob_service_client.get_blob_client(move["source"], move["name"])
+    target_blob_client = blob_service_client.get_blob_client(move["target"], move["name"])
+
+    copy = await target_blob_client.start_copy_from_url(
+        source_blob_client.url, standard_blob_tier=StandardBlobTier(move["tier"])
+    )
+    status, copy_id = copy.get("copy_status"), copy.get("copy_id")
+    description = None
+    deadline = time.monotonic() + copy_timeout
+    delay = poll_initial
+    polls = 0
+
+    # Copies within an account usually finish synchronously and are never polled
+    while status == "pending":
+        if time.monotonic() + delay > deadline:
+            await target_blob_client.abort_copy(copy_id)
+            raise CopyPending()
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, poll_max)
+        properties = await target_blob_client.get_blob_properties()
+        polls += 1
+        status, description = properties.copy.status, properties.copy.status_description
+
+    if status != "success":
+        raise Exception(f"Copy {status}: {description or 'no details'}")
+
+    await source_blob_client.delete_blob()
+    return polls
+
+
+def summarize(results):
+    """Count of results per status"""
+    counts = {}
+    for result in results:
+        counts[result["status"]] = counts.get(result["status"], 0) + 1
+    return counts
@@ -0,0 +1,301 @@
+"""
+Per-stage tracing for the three functions.
+
+Stage functions are wrapped with @traced (or a `with span(...)` block): each
+call records its latency in the metrics histogram of its stage, adds any
+`bytes` and `tokens` it annotated to the stage's counters, and, for the
+TRACE_SAMPLE_RATE share of invocations, is exported as a span with its
+parent, duration, outcome and attributes. TRACE_EXPORTER picks where spans go:
+`json` appends one JSON object per span to TRACE_JSON_PATH, or to the hourly
+`traces/` telemetry stream when no path is set, whose hours the access tracker
+deletes after TRACE_RETENTION_DAYS; `otel` hands them to the
+OpenTelemetry tracer provider the host configured (the opentelemetry-api
+package is only needed then); `none` keeps only the histograms.
+
+TRACE_PROFILE_SAMPLE_RATE of invocations also run under cProfile, and with
+TRACE_PROFILE_MEMORY under tracemalloc, and attach the top TRACE_PROFILE_TOP
+functions and allocation sites to their root span. The profiler sees the whole
+thread, so for the async query function it includes other requests' work.
+A span that is not exported costs two clock reads and a histogram update.
+"""
+import contextvars
+import cProfile
+import functools
+import inspect
+import io
+import json
+import logging
+import os
+import pstats
+import random
+import threading
+import time
+import tracemalloc
+
+from shared_code import metrics, telemetry
+
+TRACE_STREAM = "traces/"
+
+# Settings are re-read from the environment at most this often, off the per-span path
+SETTINGS_SECONDS = 5
+
+# Attributes summed into the stage's counters, e.g. extract_document_text_bytes
+COUNTED_ATTRIBUTES = ("bytes", "tokens")
+
+_current = contextvars.ContextVar("tracing_span", default=None)
+_profiling = threading.Lock()
+_json_file = None
+_json_lock = threading.Lock()
+_otel_tracer = None
+_otel_missing = False
+_settings = (0.0, None)
+
+
+def tracing_settings():
+    """Exporter, share of invocations exported, share profiled, whether profiles trace memory, and profile lines"""
+    exporter = os.environ.get("TRACE_EXPORTER", "none").lower()
+    sample_rate = float(os.environ.get("TRACE_SAMPLE_RATE", "1"))
+    profile_rate = float(os.environ.get("TRACE_PROFILE_SAMPLE_RATE", "0"))
+    profile_memory = os.environ.get("TRACE_PROFILE_MEMORY", "false").lower() == "true"
+    profile_top = int(os.environ.get("TRACE_PROFILE_TOP", "20"))
+    return exporter, sample_rate, profile_rate, profile_memory, profile_top
+
+
+def _current_settings():
+    """tracing_settings(), cached for SETTINGS_SECONDS"""
+    global _settings
+    expires, settings = _settings
+    now = time.monotonic()
+    if now >= expires:
+        settings = tracing_settings()
+        _settings = (now + SETTINGS_SECONDS, settings)
+    return settings
+
+
+class Span:
+    """One timed call of a stage; a span without a parent decides sampling and profiling for its children"""
+
+    __slots__ = ("name", "attributes", "parent", "exporter", "trace_id", "span_id", "started_at", "start",
+                 "profiler", "profile_top", "otel", "_token")
+
+    def __init__(self, name, attributes):
+        self.name = name
+        self.attributes = attributes
+        self.profiler = None
+        self.otel = None
+
+    def __enter__(self):
+        parent = self.parent = _current.get()
+        if parent is None:
+            exporter, sample_rate, profile_rate, profile_memory, profile_top = _current_settings()
+            self.exporter = exporter if exporter != "none" and random.random() < sample_rate else None
+            self.trace_id = f"{random.getrandbits(128):032x}" if self.exporter else None
+            if profile_rate and random.random() < profile_rate:
+                self._start_profile(profile_memory, profile_top)
+        else:
+            self.exporter = parent.exporter
+            self.trace_id = parent.trace_id
+
+        if self.exporter:
+            self.span_id = f"{random.getrandbits(64):016x}"
+            self.started_at = time.time()
+            if self.exporter == "otel":
+                self.otel = _start_otel_span(self)
+        self._token = _current.set(self)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, kind, error, traceback):
+        elapsed_ms = (time.perf_counter() - self.start) * 1000
+        try:
+            _current.reset(self._token)
+        except ValueError:
+            # An async generator closed from another context
+            pass
+
+        metrics.observe(self.name, elapsed_ms)
+        for key in COUNTED_ATTRIBUTES:
+            if key in self.attributes:
+                metrics.count(f"{self.name}_{key}", self.attributes[key])
+
+        if self.profiler is not None:
+            self._stop_profile()
+        if self.exporter:
+            _export(self, elapsed_ms, error)
+        return False
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def add(self, key, n):
+        self.attributes[key] = self.attributes.get(key, 0) + n
+
+    def _start_profile(self, profile_memory, profile_top):
+        # One profile at a time: cProfile cannot nest and tracemalloc is process-wide
+        if not _profiling.acquire(blocking=False):
+            return
+        self.profile_top = profile_top
+        self.profiler = (cProfile.Profile(), profile_memory and not tracemalloc.is_tracing())
+        if self.profiler[1]:
+            tracemalloc.start()
+        self.profiler[0].enable()
+
+    def _stop_profile(self):
+        profiler, traced_memory = self.profiler
+        profiler.disable()
+        try:
+            output = io.StringIO()
+            pstats.Stats(profiler, stream=output).sort_stats("cumulative").print_stats(self.profile_top)
+            self.attributes["profile"] = output.getvalue()
+            if traced_memory:
+                snapshot = tracemalloc.take_snapshot()
+                self.attributes["memory_peak_bytes"] = tracemalloc.get_traced_memory()[1]
+                self.attributes["memory_top"] = "\n".join(
+                    str(stat) for stat in snapshot.statistics("lineno")[:self.profile_top]
+                )
+            if not self.exporter:
+                logging.info(f"Profile of {self.name}:\n{self.attributes['profile']}")
+        finally:
+            if traced_memory:
+                tracemalloc.stop()
+            self.profiler = None
+            _profiling.release()
+
+
+def span(name, **attributes):
+    """Time the with block as a stage: `with tracing.span("ocr_frame", bytes=n) as s:`"""
+    return Span(name, attributes)
+
+
+def traced(name=None):
+    """Decorator running every call of a function, coroutine function or async generator in a span"""
+    def decorate(function):
+        stage = name or function.__name__
+
+        if inspect.isasyncgenfunction(function):
+            @functools.wraps(function)
+            async def wrapper(*args, **kwargs):
+                with Span(stage, {}):
+                    async for item in function(*args, **kwargs):
+                        yield item
+        elif inspect.iscoroutinefunction(function):
+            @functools.wraps(function)
+            async def wrapper(*args, **kwargs):
+                with Span(stage, {}):
+                    return await function(*args, **kwargs)
+        else:
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                with Span(stage, {}):
+                    return function(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def current_span():
+    return _current.get()
+
+
+def annotate(**attributes):
+    """Set attributes on the current span, if any"""
+    current = _current.get()
+    if current is not None:
+        current.attributes.update(attributes)
+
+
+def add(key, n):
+    """Add n to a numeric attribute of the current span, e.g. bytes written"""
+    current = _current.get()
+    if current is not None:
+        current.add(key, n)
+
+
+def span_record(current, elapsed_ms, error=None):
+    """The JSON object exported for a finished span"""
+    record = {
+        "trace_id": current.trace_id,
+        "span_id": current.span_id,
+        "parent_id": current.parent.span_id if current.parent is not None else None,
+        "name": current.name,
+        "start": current.started_at,
+        "duration_ms": round(elapsed_ms, 3),
+        "status": "error" if error is not None else "ok"
+    }
+    if error is not None:
+        record["error"] = f"{type(error).__name__}: {error}"
+    record.update(current.attributes)
+    return record
+
+
+def _export(current, elapsed_ms, error):
+    try:
+        if current.exporter == "json":
+            _write_json(span_record(current, elapsed_ms, error), current.parent is None)
+        elif current.otel is not None:
+            _end_otel_span(current, error)
+    except Exception as e:
+        logging.warning(f"Failed to export span {current.name}: {str(e)}")
+
+
+def _write_json(record, root=False):
+    """Append the span to TRACE_JSON_PATH, written out when its root span ends, or buffer it for the traces/ stream"""
+    global _json_file
+    path = os.environ.get("TRACE_JSON_PATH")
+    if not path:
+        telemetry.write(TRACE_STREAM, record)
+        return
+
+    line = json.dumps(record, default=str) + "\n"
+    with _json_lock:
+        if _json_file is None or _json_file.name != path:
+            if _json_file is not None:
+                _json_file.close()
+            _json_file = open(path, "a", encoding="utf-8")
+        _json_file.write(line)
+        if root:
+            _json_file.flush()
+
+
+def _get_otel_tracer():
+    """The host's OpenTelemetry tracer, or None (warned once) when opentelemetry-api is not installed"""
+    global _otel_tracer, _otel_missing
+    if _otel_tracer is None and not _otel_missing:
+        try:
+            # Imported here so opentelemetry is only needed when this exporter is selected
+            from opentelemetry import trace
+            _otel_tracer = trace.get_tracer("functions-python")
+        except ImportError:
+            _otel_missing = True
+            logging.warning("TRACE_EXPORTER is otel but opentelemetry-api is not installed, spans are not exported")
+    return _otel_tracer
+
+
+def _start_otel_span(current):
+    tracer = _get_otel_tracer()
+    if tracer is None:
+        return None
+
+    from opentelemetry import trace
+    parent = current.parent.otel if current.parent is not None else None
+    context = trace.set_span_in_context(parent) if parent is not None else None
+    return tracer.start_span(current.name, context=context, start_time=int(current.started_at * 1e9))
+
+
+def _end_otel_span(current, error):
+    from opentelemetry.trace import Status, StatusCode
+    for key, value in current.attributes.items():
+        current.otel.set_attribute(key, value if isinstance(value, (bool, int, float, str)) else str(value))
+    if error is not None:
+        current.otel.record_exception(error)
+        current.otel.set_status(Status(StatusCode.ERROR, str(error)))
+    current.otel.end()
+
+
+def reset():
+    """Re-read the settings and close the JSON file; used by benchmarks between runs"""
+    global _json_file, _settings
+    _settings = (0.0, None)
+    with _json_lock:
+        if _json_file is not None:
+            _json_file.close()
+            _json_file = None
@@ -0,0 +1,53 @@
+"""
+Optional warm-up before the first request.
+
+Parsers and SDKs are imported on first use, so a cold worker only loads what
+its first request needs, but that request still pays for it. With
+WARMUP_ENABLED=true each function starts a background thread when it is
+loaded that imports the modules and builds the clients its requests will use,
+overlapping that work with the rest of the host's start-up. A request that
+arrives first simply waits on the import lock for anything still loading.
+Each step's time is recorded as a `warmup_<step>` stage; a failed step is
+logged and skipped.
+"""
+import importlib
+import logging
+import os
+import threading
+import time
+
+from shared_code import metrics
+
+
+def warmup_enabled():
+    return os.environ.get("WARMUP_ENABLED", "false").lower() == "true"
+
+
+def import_modules(*names):
+    for name in names:
+        importlib.import_module(name)
+
+
+def run(steps):
+    """Run each {name: callable} step in order, timing it; returns {name: milliseconds}"""
+    timings = {}
+    for name, step in steps.items():
+        start = time.perf_counter()
+        try:
+            step()
+        except Exception as e:
+            logging.warning(f"Warm-up step {name} failed: {str(e)}")
+            continue
+        timings[name] = (time.perf_counter() - start) * 1000
+        metrics.observe(f"warmup_{name}", timings[name])
+    logging.info("Warmed up " + ", ".join(f"{name} in {ms:.0f}ms" for name, ms in timings.items()))
+    return timings
+
+
+def start(steps):
+    """Run the steps on a daemon thread when WARMUP_ENABLED is true; returns the thread, or None"""
+    if not warmup_enabled():
+        return None
+    thread = threading.Thread(target=run, args=(steps,), name="warmup", daemon=True)
+    thread.start()
+    return thread